@@ -0,0 +1,142 @@
+## Lazy, shared AWS clients for the utility lambdas.
+## Modules used to build boto3 clients and resources at import time, each on the default session.
+## Here every client and resource is created on first use from one shared session, with a
+## connection pool sized for the worker pool, TCP keep-alive and explicit timeouts. Creation time
+## and first-call latency go into the invocation metrics so cold-start regressions are visible.
+##
+## Measure the import time of every handler in a fresh interpreter with:
+##   python AwsClients.py
+
+import os
+import subprocess
+import sys
+import threading
+import time
+from botocore.config import Config
+from InvocationMetrics import metrics
+from ThrottleControl import NO_RETRY_CONFIG
+from UserWorkerPool import MAX_USER_WORKERS
+
+# urllib3 opens pool connections on demand, so sizing the pool for the largest worker count costs nothing
+MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', str(max(10, MAX_USER_WORKERS))))
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('AWS_CONNECT_TIMEOUT_SECONDS', '2'))
+READ_TIMEOUT_SECONDS = float(os.environ.get('AWS_READ_TIMEOUT_SECONDS', '30'))
+
+CLIENT_CONFIG = NO_RETRY_CONFIG.merge(Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    connect_timeout=CONNECT_TIMEOUT_SECONDS,
+    read_timeout=READ_TIMEOUT_SECONDS,
+    tcp_keepalive=True
+))
+
+# Modules measured by "python AwsClients.py"
+HANDLER_MODULES = (
+    'DisassociateFacesAndDeleteUsers',
+    'DisassociateFacesDeleteUsersDeleteFaces',
+    'DisassociateAndDeleteFacesAfterListingFromCollection',
+    'DisassociateFacesAndDeleteSpecificToDynamoDBAttribute',
+    'DynamoDBBackFillingUserIdRecordstoNewUserId',
+    'BackfillingThumbnailsOnUserIdBasis',
+    'ShardOrchestrator'
+)
+
+session = None
+clients = {}
+first_call_pending = set()
+clients_lock = threading.Lock()
+
+def get_session():
+    # boto3 itself is only imported once the first client is needed
+    global session
+    if session is None:
+        import boto3
+        session = boto3.session.Session()
+    return session
+
+def create(kind, service_name):
+    started_at = time.perf_counter()
+    if kind == 'resource':
+        created = get_session().resource(service_name, config=CLIENT_CONFIG)
+    else:
+        created = get_session().client(service_name, config=CLIENT_CONFIG)
+    metrics.record_latency(f"client.create.{kind}.{service_name}", time.perf_counter() - started_at)
+    return created
+
+def get(kind, service_name):
+    key = (kind, service_name)
+    if key not in clients:
+        with clients_lock:
+            if key not in clients:
+                clients[key] = create(kind, service_name)
+                first_call_pending.add(key)
+    return clients[key]
+
+def get_client(service_name):
+    return get('client', service_name)
+
+def get_resource(service_name):
+    return get('resource', service_name)
+
+def register(kind, service_name, target):
+    # Puts an already built client (or a fake) in place of the lazily created one
+    with clients_lock:
+        clients[(kind, service_name)] = target
+        first_call_pending.discard((kind, service_name))
+
+def reset_clients():
+    with clients_lock:
+        clients.clear()
+        first_call_pending.clear()
+
+def is_api_operation(name):
+    # Table() and the paginator/waiter helpers never reach the network
+    return not name[:1].isupper() and name not in ('get_paginator', 'can_paginate', 'get_waiter', 'close')
+
+class LazyClient:
+    # Stands in for a client or resource at module level; nothing is created until an attribute is used
+    def __init__(self, service_name, kind='client'):
+        self._service_name = service_name
+        self._kind = kind
+
+    def __getattr__(self, name):
+        key = (self._kind, self._service_name)
+        attribute = getattr(get(self._kind, self._service_name), name)
+        if key not in first_call_pending or not callable(attribute) or not is_api_operation(name):
+            return attribute
+
+        def first_call(*args, **kwargs):
+            # The first request also pays for DNS, TCP and TLS setup
+            started_at = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                if key in first_call_pending:
+                    first_call_pending.discard(key)
+                    metrics.record_latency(f"client.first_call.{self._kind}.{self._service_name}", time.perf_counter() - started_at)
+        return first_call
+
+def lazy_client(service_name):
+    return LazyClient(service_name, 'client')
+
+def lazy_resource(service_name):
+    return LazyClient(service_name, 'resource')
+
+def measure_import_time(module_name):
+    # A fresh interpreter per module, so nothing is already cached in sys.modules
+    code = (
+        "import time\n"
+        "started_at = time.perf_counter()\n"
+        f"import {module_name}\n"
+        "print(round((time.perf_counter() - started_at) * 1000, 1))\n"
+    )
+    environment = dict(os.environ)
+    environment.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=environment,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if output.returncode != 0:
+        return {'module': module_name, 'error': output.stderr.strip().splitlines()[-1]}
+    return {'module': module_name, 'import_ms': float(output.stdout.strip().splitlines()[-1])}
+
+if __name__ == '__main__':
+    for handler_module in (sys.argv[1:] or HANDLER_MODULES):
+        print(measure_import_time(handler_module))
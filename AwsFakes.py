@@ -0,0 +1,440 @@
+## In-process fakes of the Rekognition, DynamoDB and S3 APIs the utility lambdas call.
+## They keep just enough state and response shape for the handlers to run end to end offline, and
+## every call can be given a fixed latency and a random throttle rate so OfflineBenchmark.py can
+## compare handler changes reproducibly without touching production.
+
+import random
+import re
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import Counter
+from io import BytesIO
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+def client_error(code, operation_name, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+class FakeService:
+    def __init__(self, name, latency_seconds=0.0, throttle_rate=0.0, throttle_code='ThrottlingException', seed=0):
+        self.name = name
+        self.latency_seconds = latency_seconds
+        self.throttle_rate = throttle_rate
+        self.throttle_code = throttle_code
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.lock = threading.RLock()
+
+    def api_call(self, operation_name):
+        # Every fake operation starts here: count it, wait the configured latency, maybe throttle
+        with self.lock:
+            self.calls[operation_name] += 1
+            throttle = self.random.random() < self.throttle_rate
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        if throttle:
+            with self.lock:
+                self.throttled[operation_name] += 1
+            raise client_error(self.throttle_code, operation_name, 'Rate exceeded')
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'throttled': dict(self.throttled)
+            }
+
+class FakeRekognition(FakeService):
+    def __init__(self, **kwargs):
+        super().__init__('rekognition', **kwargs)
+        # collection_id -> {face_id: user_id or None}, in indexing order
+        self.collections = {}
+        self.users = {}
+
+    def add_face(self, collection_id, face_id, user_id=None):
+        self.collections.setdefault(collection_id, {})[face_id] = user_id
+        if user_id is not None:
+            self.users.setdefault(collection_id, set()).add(user_id)
+
+    def list_faces(self, CollectionId, MaxResults=1000, NextToken=None, UserId=None, FaceIds=None):
+        self.api_call('ListFaces')
+        face_id_filter = set(FaceIds) if FaceIds is not None else None
+        with self.lock:
+            faces = [
+                {'FaceId': face_id, 'UserId': user_id} if user_id else {'FaceId': face_id}
+                for face_id, user_id in self.collections.get(CollectionId, {}).items()
+                if (UserId is None or user_id == UserId) and (face_id_filter is None or face_id in face_id_filter)
+            ]
+        start = int(NextToken or 0)
+        response = {'Faces': faces[start:start + MaxResults], 'FaceModelVersion': '7.0'}
+        if start + MaxResults < len(faces):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def describe_collection(self, CollectionId):
+        self.api_call('DescribeCollection')
+        with self.lock:
+            return {
+                'FaceCount': len(self.collections.get(CollectionId, {})),
+                'UserCount': len(self.users.get(CollectionId, set())),
+                'FaceModelVersion': '7.0'
+            }
+
+    def disassociate_faces(self, CollectionId, UserId, FaceIds, ClientRequestToken=None):
+        self.api_call('DisassociateFaces')
+        if len(FaceIds) > 100:
+            raise client_error('ValidationException', 'DisassociateFaces', 'FaceIds has more than 100 items')
+        disassociated = []
+        unsuccessful = []
+        with self.lock:
+            faces = self.collections.get(CollectionId, {})
+            for face_id in FaceIds:
+                if face_id not in faces or faces[face_id] is None:
+                    unsuccessful.append({'FaceId': face_id, 'UserId': UserId, 'Reasons': ['FACE_NOT_FOUND']})
+                elif faces[face_id] != UserId:
+                    unsuccessful.append({'FaceId': face_id, 'UserId': UserId, 'Reasons': ['ASSOCIATED_TO_A_DIFFERENT_USER']})
+                else:
+                    faces[face_id] = None
+                    disassociated.append({'FaceId': face_id})
+        return {
+            'DisassociatedFaces': disassociated,
+            'UnsuccessfulFaceDisassociations': unsuccessful,
+            'UserStatus': 'ACTIVE'
+        }
+
+    def delete_user(self, CollectionId, UserId, ClientRequestToken=None):
+        self.api_call('DeleteUser')
+        with self.lock:
+            users = self.users.get(CollectionId, set())
+            if UserId not in users:
+                raise client_error('ResourceNotFoundException', 'DeleteUser', f"User {UserId} not found")
+            users.discard(UserId)
+            # Deleting a user also drops its face associations
+            faces = self.collections.get(CollectionId, {})
+            for face_id, user_id in faces.items():
+                if user_id == UserId:
+                    faces[face_id] = None
+        return {}
+
+    def delete_faces(self, CollectionId, FaceIds):
+        self.api_call('DeleteFaces')
+        if len(FaceIds) > 4096:
+            raise client_error('ValidationException', 'DeleteFaces', 'FaceIds has more than 4096 items')
+        deleted = []
+        unsuccessful = []
+        with self.lock:
+            faces = self.collections.get(CollectionId, {})
+            for face_id in FaceIds:
+                if face_id not in faces:
+                    unsuccessful.append({'FaceId': face_id, 'Reasons': ['FACE_NOT_FOUND']})
+                elif faces[face_id] is not None:
+                    unsuccessful.append({'FaceId': face_id, 'UserId': faces[face_id], 'Reasons': ['ASSOCIATED_TO_AN_EXISTING_USER']})
+                else:
+                    del faces[face_id]
+                    deleted.append(face_id)
+        return {'DeletedFaces': deleted, 'UnsuccessfulFaceDeletions': unsuccessful}
+
+class FakeTableData:
+    def __init__(self, key_attribute):
+        self.key_attribute = key_attribute
+        self.items = {}
+        self.sorted_keys = None
+
+    def put(self, item):
+        key = item[self.key_attribute]
+        if key not in self.items:
+            self.sorted_keys = None
+        self.items[key] = item
+
+    def ordered_keys(self):
+        if self.sorted_keys is None:
+            self.sorted_keys = sorted(self.items)
+        return self.sorted_keys
+
+class FakeDynamoDB(FakeService):
+    # One backend shared by the client and resource views, so both count against the same service
+    def __init__(self, page_size=100, unprocessed_rate=0.0, **kwargs):
+        kwargs.setdefault('throttle_code', 'ProvisionedThroughputExceededException')
+        super().__init__('dynamodb', **kwargs)
+        self.page_size = page_size
+        self.unprocessed_rate = unprocessed_rate
+        self.tables = {}
+
+    def create_table(self, table_name, key_attribute):
+        # Global secondary indexes are not modelled separately: queries filter on the key attributes
+        self.tables[table_name] = FakeTableData(key_attribute)
+        return self.tables[table_name]
+
+    def table(self, table_name):
+        if table_name not in self.tables:
+            raise client_error('ResourceNotFoundException', 'DynamoDB', f"Table {table_name} not found")
+        return self.tables[table_name]
+
+    def select_page(self, table, matches, exclusive_start_key, limit, segment=None, total_segments=None):
+        # Pages walk the table in key order; the start key is a position, so rows rewritten
+        # between pages behave the way they do on a real table
+        keys = table.ordered_keys()
+        start = 0
+        if exclusive_start_key:
+            start = bisect_right(keys, exclusive_start_key[table.key_attribute])
+        page = []
+        last_key = None
+        for position in range(start, len(keys)):
+            key = keys[position]
+            if segment is not None and zlib.crc32(str(key).encode()) % total_segments != segment:
+                continue
+            item = table.items.get(key)
+            if item is None or not matches(item):
+                continue
+            page.append(item)
+            last_key = key
+            if len(page) >= limit:
+                # Like DynamoDB, a full page always carries a LastEvaluatedKey unless the table ended
+                return page, ({table.key_attribute: last_key} if position + 1 < len(keys) else None)
+        return page, None
+
+    def query_native(self, table_name, conditions, exclusive_start_key=None, limit=None, projection=None):
+        table = self.table(table_name)
+        with self.lock:
+            page, last_key = self.select_page(
+                table,
+                lambda item: all(item.get(name) == value for name, value in conditions.items()),
+                exclusive_start_key,
+                min(limit or self.page_size, self.page_size)
+            )
+            page = [project(item, projection) for item in page]
+        return page, last_key
+
+    def scan_native(self, table_name, exclusive_start_key=None, segment=None, total_segments=None, limit=None):
+        table = self.table(table_name)
+        with self.lock:
+            page, last_key = self.select_page(
+                table, lambda item: True, exclusive_start_key,
+                min(limit or self.page_size, self.page_size), segment, total_segments
+            )
+            page = [dict(item) for item in page]
+        return page, last_key
+
+    def write_batch(self, request_items):
+        unprocessed = {}
+        with self.lock:
+            for table_name, requests in request_items.items():
+                table = self.table(table_name)
+                for request in requests:
+                    if self.random.random() < self.unprocessed_rate:
+                        unprocessed.setdefault(table_name, []).append(request)
+                    elif 'PutRequest' in request:
+                        table.put(request['PutRequest']['Item'])
+                    elif 'DeleteRequest' in request:
+                        table.items.pop(request['DeleteRequest']['Key'][table.key_attribute], None)
+        return unprocessed
+
+    def get_batch(self, request_items):
+        responses = {}
+        unprocessed = {}
+        with self.lock:
+            for table_name, request in request_items.items():
+                table = self.table(table_name)
+                for key in request['Keys']:
+                    if self.random.random() < self.unprocessed_rate:
+                        unprocessed.setdefault(table_name, dict(request, Keys=[]))['Keys'].append(key)
+                        continue
+                    item = table.items.get(key[table.key_attribute])
+                    if item is not None:
+                        responses.setdefault(table_name, []).append(project(item, parse_projection(request)))
+        return responses, unprocessed
+
+    def client(self):
+        return FakeDynamoDBClient(self)
+
+    def resource(self):
+        return FakeDynamoDBResource(self)
+
+def parse_projection(params):
+    expression = params.get('ProjectionExpression')
+    if not expression:
+        return None
+    names = params.get('ExpressionAttributeNames', {})
+    return [names.get(name.strip(), name.strip()) for name in expression.split(',')]
+
+def project(item, projection):
+    if projection is None:
+        return dict(item)
+    return {name: item[name] for name in projection if name in item}
+
+def parse_key_condition(params):
+    # Equality conditions only, e.g. "folder_name = :folder AND #user_id = :user_id"
+    names = params.get('ExpressionAttributeNames', {})
+    values = params.get('ExpressionAttributeValues', {})
+    conditions = {}
+    for name, placeholder in re.findall(r'(#?\w+)\s*=\s*(:\w+)', params['KeyConditionExpression']):
+        conditions[names.get(name, name)] = deserializer.deserialize(values[placeholder])
+    return conditions
+
+def condition_equalities(condition):
+    # Flattens boto3.dynamodb.conditions Key(...).eq(...) & Key(...).eq(...) into {name: value}
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        conditions = {}
+        for part in expression['values']:
+            conditions.update(condition_equalities(part))
+        return conditions
+    if expression['operator'] == '=':
+        key, value = expression['values']
+        return {key.name: value}
+    raise NotImplementedError(f"Fake DynamoDB only supports equality key conditions, got {expression['operator']}")
+
+def serialize_item(item):
+    return {name: serializer.serialize(value) for name, value in item.items()}
+
+def deserialize_item(item):
+    return {name: deserializer.deserialize(value) for name, value in item.items()}
+
+class FakeDynamoDBClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def query(self, **params):
+        self.backend.api_call('Query')
+        start_key = deserialize_item(params['ExclusiveStartKey']) if params.get('ExclusiveStartKey') else None
+        page, last_key = self.backend.query_native(
+            params['TableName'], parse_key_condition(params), start_key, params.get('Limit'), parse_projection(params)
+        )
+        response = {'Items': [serialize_item(item) for item in page], 'Count': len(page)}
+        if last_key:
+            response['LastEvaluatedKey'] = serialize_item(last_key)
+        return response
+
+    def scan(self, **params):
+        self.backend.api_call('Scan')
+        start_key = deserialize_item(params['ExclusiveStartKey']) if params.get('ExclusiveStartKey') else None
+        page, last_key = self.backend.scan_native(
+            params['TableName'], start_key, params.get('Segment'), params.get('TotalSegments'), params.get('Limit')
+        )
+        response = {'Items': [serialize_item(item) for item in page], 'Count': len(page)}
+        if last_key:
+            response['LastEvaluatedKey'] = serialize_item(last_key)
+        return response
+
+    def batch_write_item(self, RequestItems):
+        self.backend.api_call('BatchWriteItem')
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise client_error('ValidationException', 'BatchWriteItem', 'Too many items requested')
+        native = {
+            table_name: [
+                {'PutRequest': {'Item': deserialize_item(request['PutRequest']['Item'])}} if 'PutRequest' in request
+                else {'DeleteRequest': {'Key': deserialize_item(request['DeleteRequest']['Key'])}}
+                for request in requests
+            ]
+            for table_name, requests in RequestItems.items()
+        }
+        unprocessed = self.backend.write_batch(native)
+        return {'UnprocessedItems': {
+            table_name: [
+                {'PutRequest': {'Item': serialize_item(request['PutRequest']['Item'])}} if 'PutRequest' in request
+                else {'DeleteRequest': {'Key': serialize_item(request['DeleteRequest']['Key'])}}
+                for request in requests
+            ]
+            for table_name, requests in unprocessed.items()
+        }}
+
+    def put_item(self, TableName, Item, **params):
+        self.backend.api_call('PutItem')
+        with self.backend.lock:
+            self.backend.table(TableName).put(deserialize_item(Item))
+        return {}
+
+    def get_item(self, TableName, Key, **params):
+        self.backend.api_call('GetItem')
+        table = self.backend.table(TableName)
+        with self.backend.lock:
+            item = table.items.get(deserialize_item(Key)[table.key_attribute])
+        return {'Item': serialize_item(item)} if item is not None else {}
+
+    def delete_item(self, TableName, Key, **params):
+        self.backend.api_call('DeleteItem')
+        table = self.backend.table(TableName)
+        with self.backend.lock:
+            table.items.pop(deserialize_item(Key)[table.key_attribute], None)
+        return {}
+
+class FakeTable:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def query(self, KeyConditionExpression, IndexName=None, ExclusiveStartKey=None, Limit=None, **params):
+        self.backend.api_call('Query')
+        page, last_key = self.backend.query_native(
+            self.name, condition_equalities(KeyConditionExpression), ExclusiveStartKey, Limit, parse_projection(params)
+        )
+        response = {'Items': page, 'Count': len(page)}
+        if last_key:
+            response['LastEvaluatedKey'] = last_key
+        return response
+
+    def put_item(self, Item, **params):
+        self.backend.api_call('PutItem')
+        with self.backend.lock:
+            self.backend.table(self.name).put(dict(Item))
+        return {}
+
+    def get_item(self, Key, **params):
+        self.backend.api_call('GetItem')
+        table = self.backend.table(self.name)
+        with self.backend.lock:
+            item = table.items.get(Key[table.key_attribute])
+        return {'Item': dict(item)} if item is not None else {}
+
+class FakeDynamoDBResource:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def Table(self, name):
+        return FakeTable(self.backend, name)
+
+    def batch_get_item(self, RequestItems):
+        self.backend.api_call('BatchGetItem')
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise client_error('ValidationException', 'BatchGetItem', 'Too many items requested')
+        responses, unprocessed = self.backend.get_batch(RequestItems)
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+class FakeStreamingBody:
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def read(self, amount=None):
+        return self.stream.read() if amount is None else self.stream.read(amount)
+
+    def close(self):
+        self.stream.close()
+
+class FakeS3(FakeService):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('throttle_code', 'SlowDown')
+        super().__init__('s3', **kwargs)
+        self.objects = {}
+
+    def add_object(self, bucket, key, data):
+        self.objects[(bucket, key)] = data
+
+    def get_object(self, Bucket, Key, **params):
+        self.api_call('GetObject')
+        data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise client_error('NoSuchKey', 'GetObject', f"{Key} does not exist")
+        return {'ContentLength': len(data), 'Body': FakeStreamingBody(data)}
+
+    def put_object(self, Bucket, Key, Body, **params):
+        self.api_call('PutObject')
+        data = Body.read() if hasattr(Body, 'read') else Body
+        with self.lock:
+            self.objects[(Bucket, Key)] = data
+        return {'ETag': f'"{zlib.crc32(data):08x}"'}
@@ -1,165 +1,309 @@
 import json
-import boto3
-from io import BytesIO
-from PIL import Image
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
 from urllib.parse import urlparse
+from ThumbnailImageDecoding import fetch_image_bytes
+from ThumbnailEncoding import load_encoding_options
+from ThumbnailImageWorkers import get_image_workers, render_thumbnails
+from FaceQualityScoring import load_thresholds, select_best_face
+from LambdaCheckpointing import Checkpoint, time_is_running_out, continue_later
+from ThrottleControl import ThrottledClient
+from InvocationMetrics import metrics, debug, instrumented_handler
+from AwsClients import lazy_client, lazy_resource
+from CompletionLedger import get_ledger, unit_key
 
-# Initialize boto3 clients
-dynamodb = boto3.resource('dynamodb')
-s3 = boto3.client('s3')
+# Initialize boto3 clients, created on first use from the shared session in AwsClients
+dynamodb = ThrottledClient(lazy_resource('dynamodb'), 'dynamodb', operations={'batch_get_item'})
+s3 = ThrottledClient(lazy_client('s3'), 's3')
+
+# Table methods that go through the throttle-aware wrapper
+TABLE_OPERATIONS = {'query', 'get_item', 'put_item'}
 
 # DynamoDB table names
 INDEXED_DATA_TABLE = 'indexed_data'
 REKOGNITION_USERS_DATA_TABLE = 'RekognitionUsersData'
+
+# Completion ledger operation for users left without a thumbnail because none of their faces qualified;
+# users that got one are already skipped through RekognitionUsersData
+LEDGER_NO_FACE_OPERATION = 'thumbnail_no_valid_face'
+
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
 #bucket_name = 'flashbackusercollection'
 
 # S3 bucket to store cropped images
 S3_BUCKET = 'rekognitionuserfaces'
 
-def store_face_thumbnail(img, S3_BUCKET, bounding_box, user_id):
+# Source photos fetched, rendered and uploaded at once. Each holds its photo's bytes until its
+# thumbnails are uploaded; two per image worker keep the workers busy while the others wait on S3.
+IMAGE_IO_THREADS = int(os.environ.get('IMAGE_IO_THREADS', '0'))
+
+def get_table(table_name):
+    return ThrottledClient(dynamodb.Table(table_name), 'dynamodb', operations=TABLE_OPERATIONS)
+
+def store_face_thumbnail(variants, S3_BUCKET, user_id):
+    # Uploads every size variant rendered for the user, returns {size: url} largest first
     try:
-        print(f"Cropping thumbnail with bounding box metrics")
-        left = max(0, int(bounding_box['Left'] * img.width) - 25)
-        top = max(0, int(bounding_box['Top'] * img.height) - 25)
-        right = min(img.width, int((bounding_box['Left'] + bounding_box['Width']) * img.width) + 25)
-        bottom = min(img.height, int((bounding_box['Top'] + bounding_box['Height']) * img.height) + 25)
-        thumbnail = img.crop((left, top, right, bottom))
-        
-        # Resize if the image is too large
-        max_size_bytes = 5 * 1024 * 1024  # 5 MB
-        thumbnail_buffer = BytesIO()
-        thumbnail.save(thumbnail_buffer, format='JPEG')
-        thumbnail_buffer.seek(0)
-        if len(thumbnail_buffer.getvalue()) > max_size_bytes:
-            thumbnail.thumbnail((1024, 1024))
-            thumbnail_buffer = BytesIO()
-            thumbnail.save(thumbnail_buffer, format='JPEG')
-            thumbnail_buffer.seek(0)
-        
-        thumbnail_key = f"thumbnails/{user_id}.jpg"
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=thumbnail_key,
-            Body=thumbnail_buffer,
-            ContentType='image/jpeg'
-        )
-        thumbnail_url = f"https://{S3_BUCKET}.s3.amazonaws.com/{thumbnail_key}"
-        return thumbnail_url
+        thumbnail_urls = {}
+        for variant in variants:
+            thumbnail_key = f"thumbnails/{user_id}_{variant['size']}.{variant['extension']}"
+            s3.put_object(
+                Bucket=S3_BUCKET,
+                Key=thumbnail_key,
+                Body=variant['body'],
+                ContentType=variant['content_type']
+            )
+            metrics.increment('thumbnails.bytes_encoded', variant['bytes'])
+            thumbnail_urls[variant['size']] = f"https://{S3_BUCKET}.s3.amazonaws.com/{thumbnail_key}"
+        return thumbnail_urls
     except Exception as e:
         print(f"An error occurred while storing face thumbnail: {e}")
     return None
 
-def store_user_data(user_id, img, bounding_box):
+def store_user_data(user_id, variants):
+    # Returns whether the thumbnails and the user item were stored
     try:
-        print(f"Found a valid item, initiating thumbnail cropping")
-        face_thumbnail_url = store_face_thumbnail(img, S3_BUCKET, bounding_box, user_id)
+        debug(f"Found a valid item, uploading {len(variants)} thumbnail variants")
+        with metrics.stage('upload'):
+            face_thumbnail_urls = store_face_thumbnail(variants, S3_BUCKET, user_id)
+        if not face_thumbnail_urls:
+            # Without a thumbnail the item would only make later runs skip the user
+            return False
         record_creation_timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        # face_url keeps pointing at the largest variant, face_urls lets clients pick a smaller one
         item = {
             'user_id': user_id,
-            'face_url': face_thumbnail_url,
+            'face_url': next(iter(face_thumbnail_urls.values())),
+            'face_urls': {str(size): url for size, url in face_thumbnail_urls.items()},
             'recorded_timestamp(UTC)': record_creation_timestamp
         }
-        dynamodb.Table(REKOGNITION_USERS_DATA_TABLE).put_item(Item=item)
-        print(f"Stored user data: UserId={user_id}, FaceURL={face_thumbnail_url}")
+        get_table(REKOGNITION_USERS_DATA_TABLE).put_item(Item=item)
+        metrics.increment('thumbnails.stored')
+        debug(f"Stored user data: UserId={user_id}, FaceURLs={face_thumbnail_urls}")
+        return True
     except Exception as e:
         print(f"An error occurred while storing user data: {e}")
-
-def is_valid_entry(item):
-    try:
-        occluded_value = item.get('FaceOccluded_Value', None)
-        confidence = item.get('Confidence', 0)
-        pose = json.loads(item.get('Pose', '{}'))
-        roll = pose.get('Roll', 0)
-        yaw = pose.get('Yaw', 0)
-        pitch = pose.get('Pitch', 0)
-        eyes_open_value = item.get('EyesOpen_Value', None)
-        eyes_open_confidence = item.get('EyesOpen_Confidence', 0)
-        quality = json.loads(item.get('Quality', '{}'))
-        brightness = quality.get('Brightness', 0)
-        sharpness = quality.get('Sharpness', 0)
-
-        if occluded_value is None or eyes_open_value is None:
-            return False
-
-        print(f"Occluded value: {occluded_value}, confidence: {confidence}, eyes_open: {eyes_open_value} with eyes_open_confidence: {eyes_open_confidence} pose: [Roll: {roll}, Pitch: {pitch}, Yaw: {yaw}], brightness: {brightness} and sharpness: {sharpness}")
-
-        return (
-            not occluded_value and
-            confidence > 98 and
-            eyes_open_value and
-            eyes_open_confidence > 95 and
-            brightness > 40 and
-            sharpness > 18 and
-            (-20.0 <= roll <= 20.0) and
-            (-15.0 <= yaw <= 15.0) and
-            (-15.0 <= pitch <= 15.0)
-        )
-    except KeyError as e:
-        print(f"Key error: {e}")
-        return False
-    except json.JSONDecodeError as e:
-        print(f"JSON decode error: {e}")
         return False
 
+def get_existing_user_ids(user_ids, max_attempts=5):
+    # Key-only BatchGetItem against RekognitionUsersData, 100 keys per request
+    existing_user_ids = set()
+    for start in range(0, len(user_ids), BATCH_GET_MAX_KEYS):
+        request_items = {
+            REKOGNITION_USERS_DATA_TABLE: {
+                'Keys': [{'user_id': user_id} for user_id in user_ids[start:start + BATCH_GET_MAX_KEYS]],
+                'ProjectionExpression': 'user_id'
+            }
+        }
+        attempt = 1
+        while request_items:
+            response = dynamodb.batch_get_item(RequestItems=request_items)
+            for item in response.get('Responses', {}).get(REKOGNITION_USERS_DATA_TABLE, []):
+                existing_user_ids.add(item['user_id'])
+            request_items = response.get('UnprocessedKeys') or {}
+            if request_items:
+                if attempt >= max_attempts:
+                    raise RuntimeError(f"Keys still unprocessed after {attempt} BatchGetItem attempts")
+                time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+                attempt += 1
+    return existing_user_ids
 
-def lambda_handler(event, context):
-    user_ids = event.get('user_ids', [])
+def filter_users_without_thumbnail(user_ids):
+    # None when the users could not be checked
+    user_ids = list(dict.fromkeys(user_ids))
+    try:
+        existing_user_ids = get_existing_user_ids(user_ids)
+    except (ClientError, RuntimeError) as e:
+        print(f"An error occurred while checking user_ids in RekognitionUsersData: {e}")
+        return None
+    print(f"{len(existing_user_ids)} of {len(user_ids)} users are already present in the RekognitionUsersData, skipping them")
+    return [user_id for user_id in user_ids if user_id not in existing_user_ids]
+
+def select_user_face(user_id, folder_name, thresholds):
+    # Query the indexed_data table for the user_id
+    indexed_data_table = get_table(INDEXED_DATA_TABLE)
+    # The boto3 resource layer is only imported once a query is actually made
+    from boto3.dynamodb.conditions import Key
+    query_params = {
+        'IndexName': 'folder_name-user_id-index',
+        'KeyConditionExpression': Key('user_id').eq(user_id) & Key('folder_name').eq(folder_name)
+    }
+    best_item = None
+    best_score = None
     
+    # Score every page as a batch and keep the highest-quality face across all pages
+    while True:
+        response = indexed_data_table.query(**query_params)
+        item, score = select_best_face(response['Items'], thresholds)
+        if item is not None and (best_score is None or score > best_score):
+            best_item, best_score = item, score
+        if 'LastEvaluatedKey' in response:
+            query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        else:
+            break
+    return best_item, best_score
+
+def plan_thumbnail_work(user_ids, folder_name, thresholds, checkpoint, context, ledger, ledger_operation):
+    # Pick every user's face first, then group them by the photo they come from
+    faces_by_image = {}
+    no_valid_face = []
     for user_id in user_ids:
-        print(f"Processing the userId: {user_id}")
-        # Check if user_id is present in RekognitionUsersData table
-        try:
-            rekognition_users_data_table = dynamodb.Table(REKOGNITION_USERS_DATA_TABLE)
-            user_response = rekognition_users_data_table.get_item(Key={'user_id': user_id})
-            if 'Item' in user_response:
-                # Skip if user_id is already present
-                print(f"The user is already present in the RekognitionUsersData, Hence, skipping to next userId")
-                continue
-        except ClientError as e:
-            # Handle exception if needed
-            print(f"An error occurred while checking user_id in RekognitionUsersData: {e}")
+        if checkpoint.is_user_done(user_id):
             continue
-        
-        folder_name = 'Sithara_Thadem_Birthaday_09062024'
-        # Query the indexed_data table for the user_id
-        indexed_data_table = dynamodb.Table(INDEXED_DATA_TABLE)
+        if time_is_running_out(context):
+            ledger.mark_completed(ledger_operation, no_valid_face)
+            return faces_by_image, True
+        debug(f"Processing the userId: {user_id}")
         try:
-            response = indexed_data_table.query(
-                IndexName='folder_name-user_id-index',
-                KeyConditionExpression=Key('user_id').eq(user_id) & Key('folder_name').eq(folder_name)
-            )
-            
-            for item in response['Items']:
-                # Check if the current entry meets the criteria
-                if is_valid_entry(item):
-                    # Fetch the image and crop the face using bounding box
-                    image_url = item['s3_url']
-                    bounding_box = item['bounding_box']
-                    try:
-                        parsed_url = urlparse(image_url)
-                        bucket_name = parsed_url.netloc.split('.')[0]
-                        key = parsed_url.path.lstrip('/')
-                        print(f"processing the image: {key} from the bucket {bucket_name}")
-                        image_buffer = BytesIO(s3.get_object(Bucket=bucket_name, Key=key)['Body'].read())
-                        with Image.open(image_buffer) as img:
-                            store_user_data(user_id, img, bounding_box)
-                    except Exception as e:
-                        print(f"An error occurred while processing image: {e}")
-                    break  # Stop processing once a valid entry is found
+            with metrics.stage('select_face'):
+                best_item, best_score = select_user_face(user_id, folder_name, thresholds)
         except ClientError as e:
             print(f"An error occurred while querying indexed_data table for user_id {user_id}: {e}")
+            checkpoint.mark_user_done(user_id, failed=True)
+            continue
+        if best_item is None:
+            debug(f"No face of user {user_id} meets the quality thresholds, skipping")
+            metrics.increment('users.no_valid_face')
+            checkpoint.mark_user_done(user_id)
+            no_valid_face.append(user_id)
             continue
+        faces_by_image.setdefault(best_item['s3_url'], []).append((user_id, best_item['bounding_box'], best_score))
+    ledger.mark_completed(ledger_operation, no_valid_face)
+    return faces_by_image, False
+
+def process_source_image(image_url, faces, encoding, image_workers):
+    # Runs on an I/O thread: fetch the photo once, let an image worker decode it and render every
+    # picked user's variants, then upload them while the worker moves on to the next photo.
+    # Returns the users of the photo whose thumbnail was not stored.
+    failed_user_ids = set()
+    try:
+        parsed_url = urlparse(image_url)
+        bucket_name = parsed_url.netloc.split('.')[0]
+        key = parsed_url.path.lstrip('/')
+        debug(f"processing the image: {key} from the bucket {bucket_name} for {len(faces)} users")
+        # Capped fetch, the worker then decodes only at the scale the largest crop needs
+        with metrics.stage('fetch_image'):
+            image_bytes = fetch_image_bytes(s3, bucket_name, key)
+        metrics.increment('images.bytes_fetched', len(image_bytes))
+        with metrics.stage('render'):
+            rendered = image_workers.submit(
+                render_thumbnails, image_bytes, [(user_id, bounding_box) for user_id, bounding_box, _ in faces], encoding
+            ).result()
+        del image_bytes
+        metrics.record_latency('stage.decode_image', rendered['decode_seconds'])
+        metrics.record_latency('stage.encode_variants', rendered['encode_seconds'])
+        for user_id, error in rendered['failures'].items():
+            print(f"An error occurred while rendering the thumbnail of user {user_id}: {error}")
+        for user_id, bounding_box, score in faces:
+            if user_id not in rendered['thumbnails']:
+                failed_user_ids.add(user_id)
+                continue
+            debug(f"Storing face of user {user_id} (face score {score:.2f})")
+            if not store_user_data(user_id, rendered['thumbnails'][user_id]):
+                failed_user_ids.add(user_id)
+    except Exception as e:
+        metrics.increment('images.failed')
+        print(f"An error occurred while processing image: {e}")
+        failed_user_ids.update(user_id for user_id, _, _ in faces)
+    return failed_user_ids
+
+def process_source_images(faces_by_image, encoding, checkpoint, context):
+    # Returns True when it stopped early for the Lambda deadline
+    image_workers = get_image_workers()
+    io_threads = IMAGE_IO_THREADS or 2 * image_workers.workers + 2
+    pending_images = iter(faces_by_image.items())
+    in_flight = {}
+    stopped = False
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        while True:
+            # Keep at most io_threads photos in flight so the deadline check happens before every submit
+            while len(in_flight) < io_threads and not stopped:
+                if time_is_running_out(context):
+                    stopped = True
+                    break
+                image = next(pending_images, None)
+                if image is None:
+                    break
+                image_url, faces = image
+                in_flight[executor.submit(process_source_image, image_url, faces, encoding, image_workers)] = faces
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                failed_user_ids = future.result()
+                for user_id, _, _ in in_flight.pop(future):
+                    checkpoint.mark_user_done(user_id, failed=user_id in failed_user_ids, save=False)
+            checkpoint.save_if_due()
+    return stopped
+
+@instrumented_handler('BackfillingThumbnailsOnUserIdBasis')
+def lambda_handler(event, context):
+    event_user_ids = list(dict.fromkeys(event.get('user_ids', [])))
+    thresholds = load_thresholds(event)
+    encoding = load_encoding_options(event)
+    folder_name = 'Sithara_Thadem_Birthaday_09062024'
+    
+    # Whether a user has a valid face depends on the thresholds, so they are part of the ledger operation
+    try:
+        ledger = get_ledger(event)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': str(e)
+        }
+    ledger_operation = unit_key(LEDGER_NO_FACE_OPERATION, folder_name, json.dumps(thresholds, sort_keys=True))
+    
+    # Drop the users that already have a thumbnail, or that an earlier run found no valid face for,
+    # before any query or crop work
+    with metrics.stage('prefilter'):
+        user_ids = filter_users_without_thumbnail(event_user_ids)
+        if user_ids is None:
+            return {
+                'statusCode': 500,
+                'body': json.dumps({'succeeded': [], 'failed': event_user_ids, 'pending': [], 'skipped': []})
+            }
+        no_valid_face = ledger.completed(ledger_operation, user_ids)
+        user_ids = [user_id for user_id in user_ids if user_id not in no_valid_face]
+    
+    # Resume from an earlier invocation when the event carries a continuation_token
+    checkpoint = Checkpoint.resume(event)
+    
+    faces_by_image, stopped = plan_thumbnail_work(user_ids, folder_name, thresholds, checkpoint, context, ledger, ledger_operation)
+    total_faces = sum(len(faces) for faces in faces_by_image.values())
+    print(f"Cropping {total_faces} thumbnails from {len(faces_by_image)} source images")
+    
+    if not stopped:
+        stopped = process_source_images(faces_by_image, encoding, checkpoint, context)
+    
+    if stopped:
+        pending = [user_id for user_id in user_ids if not checkpoint.is_user_done(user_id)]
+        return continue_later(checkpoint, event, context, {'pending': len(pending)})
+    checkpoint.finish()
 
-    # return {
-    #     'statusCode': 200,
-    #     'body': json.dumps('Processing completed successfully.')
-    # }
+    # Users with a thumbnail already, or without a valid face in an earlier run, are skipped;
+    # users without a valid face in this run count as succeeded
+    checked_user_ids = set(user_ids)
+    report = {
+        'succeeded': [user_id for user_id in user_ids if not checkpoint.is_user_failed(user_id)],
+        'failed': [user_id for user_id in user_ids if checkpoint.is_user_failed(user_id)],
+        'pending': [],
+        'skipped': [user_id for user_id in event_user_ids if user_id not in checked_user_ids]
+    }
+    return {
+        'statusCode': 200,
+        'body': json.dumps(report)
+    }
 
 
-#Manual payload
+#Manual payload ("thresholds" is optional, see FaceQualityScoring.DEFAULT_THRESHOLDS;
+# "thumbnail_variants" and "thumbnail_format" are optional, see ThumbnailEncoding)
 # {
-#   "user_ids": ["user1", "user2"]
+#   "user_ids": ["user1", "user2"],
+#   "thresholds": {"min_sharpness": 25},
+#   "thumbnail_variants": {"64": 6144, "256": 49152, "1024": 307200},
+#   "thumbnail_format": "WEBP"
 # }
@@ -0,0 +1,143 @@
+## Single-pass inventory of which FaceIds belong to which UserId in a Rekognition collection.
+## Large batches of users are served by one paginated ListFaces scan grouped by UserId, small batches
+## use the server-side UserId filter instead. A full scan can be kept as a gzipped JSON snapshot:
+## while it is fresh, later runs serve the users it has from it and only list or scan for the others,
+## refreshing those on top of it.
+
+import gzip
+import json
+import os
+import time
+from botocore.exceptions import ClientError
+
+# ListFaces returns at most 4096 faces per page
+LIST_FACES_PAGE_SIZE = 4096
+
+# Snapshots older than this are rebuilt with a full scan instead of being refreshed per user
+SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get('INVENTORY_SNAPSHOT_MAX_AGE_SECONDS', '86400'))
+
+def list_user_faces(rekognition, collection_id, user_id):
+    # Server-side UserId filter: costs one call per page of this user's faces only
+    face_ids = []
+    params = {
+        'CollectionId': collection_id,
+        'UserId': user_id,
+        'MaxResults': LIST_FACES_PAGE_SIZE
+    }
+    while True:
+        response = rekognition.list_faces(**params)
+        face_ids.extend(face['FaceId'] for face in response.get('Faces', []))
+        if 'NextToken' in response:
+            params['NextToken'] = response['NextToken']
+        else:
+            break
+    return face_ids
+
+def scan_collection(rekognition, collection_id):
+    # One pass over the whole collection, grouping every associated face by its UserId
+    users = {}
+    pages = 0
+    params = {
+        'CollectionId': collection_id,
+        'MaxResults': LIST_FACES_PAGE_SIZE
+    }
+    while True:
+        response = rekognition.list_faces(**params)
+        pages += 1
+        for face in response.get('Faces', []):
+            user_id = face.get('UserId')
+            if user_id:
+                users.setdefault(user_id, []).append(face['FaceId'])
+        if 'NextToken' in response:
+            params['NextToken'] = response['NextToken']
+        else:
+            break
+    print(f"Scanned collection {collection_id} in {pages} pages, found faces for {len(users)} users")
+    return users
+
+def get_collection_face_count(rekognition, collection_id):
+    try:
+        return rekognition.describe_collection(CollectionId=collection_id)['FaceCount']
+    except (ClientError, KeyError) as e:
+        print(f"Could not describe collection {collection_id}: {e}")
+        return None
+
+def use_server_side_filter(user_count, face_count):
+    # A full scan costs face_count / page size calls, the filter costs at least one call per user
+    if face_count is None:
+        return user_count <= 1
+    scan_pages = max(1, -(-face_count // LIST_FACES_PAGE_SIZE))
+    return user_count <= scan_pages
+
+def load_snapshot(snapshot_path, collection_id):
+    if not snapshot_path or not os.path.exists(snapshot_path):
+        return None
+    try:
+        with gzip.open(snapshot_path, 'rt') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable inventory snapshot {snapshot_path}: {e}")
+        return None
+    if snapshot.get('collection_id') != collection_id:
+        return None
+    if time.time() - snapshot.get('scanned_at', 0) > SNAPSHOT_MAX_AGE_SECONDS:
+        print(f"Inventory snapshot {snapshot_path} is older than {SNAPSHOT_MAX_AGE_SECONDS}s, rescanning")
+        return None
+    return snapshot
+
+def save_snapshot(snapshot_path, snapshot):
+    temp_path = f"{snapshot_path}.tmp"
+    with gzip.open(temp_path, 'wt') as snapshot_file:
+        json.dump(snapshot, snapshot_file, separators=(',', ':'))
+    os.replace(temp_path, snapshot_path)
+
+def build_collection_inventory(rekognition, collection_id, user_ids, snapshot_path=None):
+    # Returns {user_id: [face_id, ...]} for every requested user (empty list when it has no faces)
+    user_ids = list(dict.fromkeys(user_ids))
+    snapshot = load_snapshot(snapshot_path, collection_id)
+
+    # Users without faces are not in the snapshot, and neither are the ones handlers have forgotten
+    # since, so only those are looked up
+    if snapshot is not None:
+        missing_user_ids = [user_id for user_id in user_ids if user_id not in snapshot['users']]
+        print(f"Served faces for {len(user_ids) - len(missing_user_ids)} users from the inventory snapshot")
+        if not missing_user_ids:
+            return {user_id: snapshot['users'][user_id] for user_id in user_ids}
+    else:
+        missing_user_ids = user_ids
+    face_count = get_collection_face_count(rekognition, collection_id)
+
+    if use_server_side_filter(len(missing_user_ids), face_count):
+        # Refresh only the missing users, on top of the snapshot when there is one
+        users = snapshot['users'] if snapshot is not None else {}
+        for user_id in missing_user_ids:
+            face_ids = list_user_faces(rekognition, collection_id, user_id)
+            if face_ids:
+                users[user_id] = face_ids
+            else:
+                users.pop(user_id, None)
+        scanned_at = snapshot['scanned_at'] if snapshot is not None else None
+        print(f"Refreshed faces for {len(missing_user_ids)} users with the server-side UserId filter")
+    else:
+        users = scan_collection(rekognition, collection_id)
+        scanned_at = time.time()
+
+    # Only a full scan, or a snapshot refreshed on top of one, describes every user in the collection
+    if snapshot_path and scanned_at is not None:
+        save_snapshot(snapshot_path, {
+            'collection_id': collection_id,
+            'scanned_at': scanned_at,
+            'face_count': face_count,
+            'users': users
+        })
+
+    return {user_id: users.get(user_id, []) for user_id in user_ids}
+
+def forget_users(snapshot_path, collection_id, user_ids):
+    # Drop users from the snapshot once a handler has removed their faces or deleted them
+    snapshot = load_snapshot(snapshot_path, collection_id)
+    if snapshot is None:
+        return
+    for user_id in user_ids:
+        snapshot['users'].pop(user_id, None)
+    save_snapshot(snapshot_path, snapshot)
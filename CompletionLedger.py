@@ -0,0 +1,159 @@
+## Completion ledger for the utility lambdas.
+## Finished units of work are recorded under (operation, unit key), e.g. ("purge_user", user_id) or
+## ("disassociate_face", "user_id#face_id"), so a retried event looks its units up in bulk and only
+## redoes the ones that are missing. SQLite backs local runs and tests, DynamoDB backs production.
+## The DynamoDB backend trades cheap DynamoDB writes for the scarce Rekognition TPS a retry would
+## otherwise spend again.
+
+import os
+import random
+import sqlite3
+import threading
+import time
+from botocore.exceptions import ClientError
+from AwsClients import get_client
+from DynamoDBBatchWriter import BatchWriter
+from ThrottleControl import ThrottledClient
+
+# "none", "sqlite" or "dynamodb", overridable per event with "ledger_store"
+LEDGER_STORE = os.environ.get('LEDGER_STORE', 'none')
+LEDGER_SQLITE_PATH = os.environ.get('LEDGER_SQLITE_PATH', '/tmp/completion_ledger.sqlite3')
+LEDGER_TABLE = os.environ.get('LEDGER_TABLE', 'UtilityLambdaLedger')
+
+# Ledger items expire from the DynamoDB table after this long (the table's TTL attribute is expires_at)
+LEDGER_TTL_SECONDS = int(os.environ.get('LEDGER_TTL_SECONDS', str(30 * 24 * 3600)))
+
+# BatchGetItem accepts at most 100 keys, SQLite at least 999 bound parameters per statement
+BATCH_GET_MAX_KEYS = 100
+SQLITE_MAX_KEYS = 500
+
+def unit_key(*parts):
+    return '#'.join(str(part) for part in parts)
+
+class NullLedger:
+    # Used when no ledger is configured: nothing is ever recorded as completed
+    def completed(self, operation, unit_keys):
+        return set()
+
+    def is_completed(self, operation, unit_key):
+        return False
+
+    def mark_completed(self, operation, unit_keys):
+        pass
+
+class SQLiteLedger:
+    def __init__(self, path=LEDGER_SQLITE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS ledger ('
+                'operation TEXT NOT NULL, unit_key TEXT NOT NULL, completed_at INTEGER NOT NULL, '
+                'PRIMARY KEY (operation, unit_key))'
+            )
+
+    def completed(self, operation, unit_keys):
+        unit_keys = list(dict.fromkeys(unit_keys))
+        found = set()
+        with self.lock:
+            for start in range(0, len(unit_keys), SQLITE_MAX_KEYS):
+                chunk = unit_keys[start:start + SQLITE_MAX_KEYS]
+                rows = self.connection.execute(
+                    f"SELECT unit_key FROM ledger WHERE operation = ? AND unit_key IN ({','.join('?' * len(chunk))})",
+                    [operation, *chunk]
+                )
+                found.update(row[0] for row in rows)
+        return found
+
+    def is_completed(self, operation, unit_key):
+        return unit_key in self.completed(operation, [unit_key])
+
+    def mark_completed(self, operation, unit_keys):
+        if not unit_keys:
+            return
+        now = int(time.time())
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO ledger (operation, unit_key, completed_at) VALUES (?, ?, ?)',
+                [(operation, key, now) for key in dict.fromkeys(unit_keys)]
+            )
+
+class DynamoDBLedger:
+    # Table key: operation (hash) + unit_key (range)
+    def __init__(self, table_name=LEDGER_TABLE, dynamodb=None):
+        self.table_name = table_name
+        self.dynamodb = dynamodb or ThrottledClient(get_client('dynamodb'), 'dynamodb')
+
+    def completed(self, operation, unit_keys, max_attempts=5):
+        unit_keys = list(dict.fromkeys(unit_keys))
+        found = set()
+        for start in range(0, len(unit_keys), BATCH_GET_MAX_KEYS):
+            request_items = {
+                self.table_name: {
+                    'Keys': [{'operation': {'S': operation}, 'unit_key': {'S': key}}
+                             for key in unit_keys[start:start + BATCH_GET_MAX_KEYS]],
+                    'ProjectionExpression': 'unit_key'
+                }
+            }
+            attempt = 1
+            while request_items:
+                response = self.dynamodb.batch_get_item(RequestItems=request_items)
+                found.update(item['unit_key']['S'] for item in response.get('Responses', {}).get(self.table_name, []))
+                request_items = response.get('UnprocessedKeys') or {}
+                if request_items:
+                    if attempt >= max_attempts:
+                        raise RuntimeError(f"Ledger keys still unprocessed after {attempt} BatchGetItem attempts")
+                    time.sleep(random.uniform(0, 0.05 * (2 ** attempt)))
+                    attempt += 1
+        return found
+
+    def is_completed(self, operation, unit_key):
+        return unit_key in self.completed(operation, [unit_key])
+
+    def item(self, operation, key, now):
+        return {
+            'operation': {'S': operation},
+            'unit_key': {'S': key},
+            'completed_at': {'N': str(now)},
+            'expires_at': {'N': str(now + LEDGER_TTL_SECONDS)}
+        }
+
+    def mark_completed(self, operation, unit_keys):
+        unit_keys = list(dict.fromkeys(unit_keys))
+        if not unit_keys:
+            return
+        now = int(time.time())
+        if len(unit_keys) == 1:
+            # Conditional write: the first run to finish a unit records it, later ones leave it alone
+            try:
+                self.dynamodb.put_item(
+                    TableName=self.table_name,
+                    Item=self.item(operation, unit_keys[0], now),
+                    ConditionExpression='attribute_not_exists(unit_key)'
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            return
+        # Bulk units (faces, records) go 25 to a BatchWriteItem; re-putting an entry is harmless
+        with BatchWriter(self.dynamodb, self.table_name) as writer:
+            for key in unit_keys:
+                writer.put(self.item(operation, key, now))
+
+def skip_completed(pages, ledger, operation, prefix):
+    # Drops the ids an earlier run completed from each page of ids, one bulk lookup per page
+    for page in pages:
+        keys = {unit_key(prefix, item): item for item in page}
+        completed = ledger.completed(operation, keys) if keys else set()
+        yield [item for key, item in keys.items() if key not in completed]
+
+def get_ledger(event):
+    store_name = event.get('ledger_store', LEDGER_STORE)
+    if store_name == 'none':
+        return NullLedger()
+    if store_name == 'sqlite':
+        return SQLiteLedger(event.get('ledger_sqlite_path', LEDGER_SQLITE_PATH))
+    if store_name == 'dynamodb':
+        return DynamoDBLedger(event.get('ledger_table', LEDGER_TABLE))
+    raise ValueError(f"Unknown ledger store: {store_name}")
@@ -1,44 +1,59 @@
-import boto3
+import json
+import os
 from botocore.exceptions import ClientError
+from RekognitionFaceBatching import disassociate_faces_in_batches
+from UserWorkerPool import RateLimitedClient, rekognition_limiter, configure_rate_limits, process_users, get_worker_count
+from LambdaCheckpointing import Checkpoint, time_is_running_out, continue_later
+from ThrottleControl import ThrottledClient
+from CollectionInventory import build_collection_inventory, list_user_faces, forget_users
+from InvocationMetrics import metrics, debug, instrumented_handler
+from AwsClients import lazy_client
+from CompletionLedger import get_ledger
+from FaceLookupCache import face_cache
 
-# Initialize the Rekognition client
-rekognition = boto3.client('rekognition')
+# Initialize the clients, created on first use from the shared session in AwsClients
+rekognition = ThrottledClient(RateLimitedClient(lazy_client('rekognition'), rekognition_limiter), 'rekognition')
+
+# Optional gzipped inventory snapshot, e.g. /tmp/FlashbackUserDataCollection.inventory.json.gz
+INVENTORY_SNAPSHOT_PATH = os.environ.get('INVENTORY_SNAPSHOT_PATH')
+
+# Completion ledger operation, shared with the DynamoDB-driven purge lambdas: the user is disassociated and deleted
+LEDGER_USER_OPERATION = 'purge_user'
 
 def list_faces_in_collection(collection_id, user_id):
-    face_ids = []
-    try:
-        response = rekognition.list_faces(
-            CollectionId=collection_id,
-            MaxResults=1000  # Adjust as needed
-        )
-        while True:
-            faces = response.get('Faces', [])
-            for face in faces:
-                if face.get('UserId') == user_id:
-                    face_ids.append(face['FaceId'])
-            if 'NextToken' in response:
-                response = rekognition.list_faces(
-                    CollectionId=collection_id,
-                    NextToken=response['NextToken'],
-                    MaxResults=1000
-                )
-            else:
-                break
+    # A warm container serves a user it listed recently from the cache
+    face_ids = face_cache.get(collection_id, user_id)
+    if face_ids is not None:
         return face_ids
+    generation = face_cache.generation(collection_id)
+    try:
+        # Server-side UserId filter, only this user's faces are paged through
+        face_ids = list_user_faces(rekognition, collection_id, user_id)
     except ClientError as e:
         print(f"Error listing faces for user {user_id} in collection {collection_id}: {e}")
         raise
+    face_cache.put(collection_id, user_id, face_ids, generation=generation)
+    return face_ids
+
+def build_inventory(collection_id, user_ids, snapshot_path):
+    # Users listed recently come from the cache, only the rest are listed or scanned
+    inventory = {}
+    for user_id in user_ids:
+        face_ids = face_cache.get(collection_id, user_id)
+        if face_ids is not None:
+            inventory[user_id] = face_ids
+    uncached_user_ids = [user_id for user_id in user_ids if user_id not in inventory]
+    if uncached_user_ids:
+        generation = face_cache.generation(collection_id)
+        listed = build_collection_inventory(rekognition, collection_id, uncached_user_ids, snapshot_path)
+        for user_id, face_ids in listed.items():
+            face_cache.put(collection_id, user_id, face_ids, generation=generation)
+        inventory.update(listed)
+    return inventory
 
 def disassociate_faces_from_collection(collection_id, user_id, face_ids):
     try:
-        for face_id in face_ids:
-            rekognition.disassociate_faces(
-                CollectionId=collection_id,
-                UserId=user_id,
-                FaceIds=[face_id]
-            )
-            print(f"Disassociated face {face_id} from user {user_id}")
-        return True
+        return disassociate_faces_in_batches(rekognition, collection_id, user_id, face_ids)
     except ClientError as e:
         print(f"Error disassociating faces for user {user_id}: {e}")
         raise
@@ -49,40 +64,103 @@ def delete_user_from_collection(collection_id, user_id):
             CollectionId=collection_id,
             UserId=user_id
         )
-        print(f"Deleted user {user_id} from collection {collection_id}")
+        debug(f"Deleted user {user_id} from collection {collection_id}")
         return response
     except ClientError as e:
         print(f"Error deleting user {user_id} from collection {collection_id}: {e}")
         raise
 
-def lambda_handler(event, context):
-    collection_id = 'FlashbackUserDataCollection'
-    user_ids = event.get('user_ids', [])
+def process_user(collection_id, user_id, inventory):
+    debug(f"Processing User ID: {user_id}")
+    errors = []
+    faces_disassociated = 0
     
-    for user_id in user_ids:
-        print(f"Processing User ID: {user_id}")
-        
-        # Get face IDs associated with the user ID from the collection
+    # Get face IDs associated with the user ID from the collection
+    try:
+        if inventory is not None:
+            face_ids = inventory.get(user_id, [])
+        else:
+            with metrics.stage('list_faces'):
+                face_ids = list_faces_in_collection(collection_id, user_id)
+        debug(f"Found {len(face_ids)} face IDs for user {user_id}")
+        metrics.increment('faces.found', len(face_ids))
+    except Exception as e:
+        print(f"An error occurred while listing faces for User ID: {user_id}: {e}")
+        return {'errors': [f"list_faces: {e}"]}
+    
+    # Disassociate face IDs from the Rekognition collection
+    if face_ids:
         try:
-            face_ids = list_faces_in_collection(collection_id, user_id)
-            print(f"Found {len(face_ids)} face IDs for user {user_id}")
+            with metrics.stage('disassociate'):
+                result = disassociate_faces_from_collection(collection_id, user_id, face_ids)
+            faces_disassociated = len(result['DisassociatedFaces'])
         except Exception as e:
-            print(f"An error occurred while listing faces for User ID: {user_id}: {e}")
-            continue
-        
-        # Disassociate face IDs from the Rekognition collection
-        if face_ids:
-            try:
-                disassociate_faces_from_collection(collection_id, user_id, face_ids)
-            except Exception as e:
-                print(f"An error occurred during disassociation for User ID: {user_id}: {e}")
-        
-        # Delete user ID from the collection
-        try:
+            print(f"An error occurred during disassociation for User ID: {user_id}: {e}")
+            errors.append(f"disassociate: {e}")
+    
+    # Delete user ID from the collection
+    try:
+        with metrics.stage('delete_user'):
             delete_user_from_collection(collection_id, user_id)
-        except Exception as e:
-            print(f"An error occurred during deletion for User ID: {user_id}: {e}")
-        
-        print(f"Completed processing for User ID: {user_id}")
-        print("------------------------")
+    except Exception as e:
+        print(f"An error occurred during deletion for User ID: {user_id}: {e}")
+        errors.append(f"delete_user: {e}")
+    
+    # The user's faces in the collection have changed
+    face_cache.invalidate(collection_id, user_id)
+    
+    debug(f"Completed processing for User ID: {user_id}")
+    debug("------------------------")
+    return {
+        'faces_found': len(face_ids),
+        'faces_disassociated': faces_disassociated,
+        'errors': errors
+    }
 
+@instrumented_handler('DisassociateAndDeleteFacesAfterListingFromCollection')
+def lambda_handler(event, context):
+    collection_id = 'FlashbackUserDataCollection'
+    user_ids = event.get('user_ids', [])
+    snapshot_path = event.get('inventory_snapshot_path', INVENTORY_SNAPSHOT_PATH)
+    
+    try:
+        ledger = get_ledger(event)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': str(e)
+        }
+    
+    # Shards of an orchestrated run carry their share of the TPS quotas
+    configure_rate_limits(event)
+    
+    # Resume from an earlier invocation when the event carries a continuation_token
+    checkpoint = Checkpoint.resume(event)
+    
+    # List the faces of every user in the event at once instead of scanning the collection per user.
+    # Users an earlier run already completed are left out of the inventory as well.
+    try:
+        pending_user_ids = [user_id for user_id in user_ids if not checkpoint.is_user_done(user_id)]
+        completed_user_ids = ledger.completed(LEDGER_USER_OPERATION, pending_user_ids)
+        pending_user_ids = [user_id for user_id in pending_user_ids if user_id not in completed_user_ids]
+        with metrics.stage('inventory'):
+            inventory = build_inventory(collection_id, pending_user_ids, snapshot_path)
+    except Exception as e:
+        print(f"An error occurred while building the collection inventory, listing faces per user: {e}")
+        inventory = None
+    
+    # Optional "workers" in the event processes users in parallel
+    report = process_users(user_ids, lambda user_id: process_user(collection_id, user_id, inventory), get_worker_count(event),
+                           checkpoint, lambda: time_is_running_out(context), ledger, LEDGER_USER_OPERATION)
+    
+    if snapshot_path:
+        forget_users(snapshot_path, collection_id, report['succeeded'])
+    
+    if report['pending']:
+        return continue_later(checkpoint, event, context, {'completed': len(report['succeeded']) + len(report['failed']), 'pending': len(report['pending'])})
+    checkpoint.finish()
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps(report)
+    }
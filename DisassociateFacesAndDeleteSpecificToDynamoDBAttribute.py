@@ -1,89 +1,190 @@
 ## This code gets faces from dynamodb -> diassociate the face from user_id in the collection -> delete faces from the collection.
 import json
-import boto3
 from botocore.exceptions import ClientError
+from RekognitionFaceBatching import disassociate_faces_in_batches, delete_faces_in_batches, DELETE_FACES_MAX_BATCH
+from UserWorkerPool import RateLimitedClient, rekognition_limiter, dynamodb_limiter, configure_rate_limits, process_users, get_worker_count
+from LambdaCheckpointing import Checkpoint, time_is_running_out, continue_later
+from ThrottleControl import ThrottledClient
+from InvocationMetrics import metrics, debug, instrumented_handler
+from AwsClients import lazy_client
+from CompletionLedger import get_ledger, skip_completed, unit_key
+from FaceLookupCache import face_cache
 
-# Initialize the Rekognition client
-rekognition = boto3.client('rekognition')
-dynamodb = boto3.client('dynamodb')
+# Initialize the clients, created on first use from the shared session in AwsClients
+rekognition = ThrottledClient(RateLimitedClient(lazy_client('rekognition'), rekognition_limiter), 'rekognition')
+dynamodb = ThrottledClient(RateLimitedClient(lazy_client('dynamodb'), dynamodb_limiter), 'dynamodb')
 
-def get_face_data_from_dynamodb(user_id):
-    try:
-        response = dynamodb.query(
-            TableName='indexed_data',
-            IndexName='user_id-index',
-            KeyConditionExpression='user_id = :uid',
-            ExpressionAttributeValues={
-                ':uid': {'S': user_id}
-            }
-        )
-        return [(item['face_id']['S'], item['folder_name']['S']) for item in response['Items']]
-    except ClientError as e:
-        print(f"An error occurred while querying DynamoDB: {e}")
-        return []
+# Completion ledger operations: faces deleted from the collection, and users whose folder is done
+LEDGER_FACE_OPERATION = 'delete_face'
+LEDGER_FOLDER_OPERATION = 'purge_folder'
+
+# Face lists of recently looked up users are kept by the container under this table name
+FACES_TABLE = 'indexed_data'
+
+# A face DeleteFaces reports with only this reason is already gone from the collection
+FACE_NOT_FOUND_REASON = 'FACE_NOT_FOUND'
+
+def query_folder_face_id_pages(user_id, folder_name):
+    # Only this folder's items are read, and only their face_id, page by page
+    query_params = {
+        'TableName': FACES_TABLE,
+        'IndexName': 'folder_name-user_id-index',
+        'KeyConditionExpression': 'folder_name = :folder_name AND user_id = :uid',
+        'ExpressionAttributeValues': {
+            ':folder_name': {'S': folder_name},
+            ':uid': {'S': user_id}
+        },
+        'ProjectionExpression': 'face_id'
+    }
+    while True:
+        with metrics.stage('query_faces'):
+            response = dynamodb.query(**query_params)
+        yield [item['face_id']['S'] for item in response['Items']]
+        if 'LastEvaluatedKey' in response:
+            query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        else:
+            break
+
+def get_folder_face_id_pages(user_id, folder_name):
+    # A warm container serves a folder it looked up recently from the cache, in one page
+    return face_cache.cached_pages(FACES_TABLE, user_id, query_folder_face_id_pages(user_id, folder_name), folder_name)
 
 def disassociate_faces_from_collection(collection_id, face_ids, user_id):
     try:
-        for face_id in face_ids:
-            response = rekognition.disassociate_faces(
-                CollectionId=collection_id,
-                UserId=user_id,
-                FaceIds=[face_id]  # Pass face_id as a list
-            )
-            print(f"Disassociated face {face_id} from user {user_id}")
-        return True
+        # Disassociate in batches of up to 100 face ids per call
+        return disassociate_faces_in_batches(rekognition, collection_id, user_id, face_ids)
     except ClientError as e:
         print(f"An error occurred while disassociating faces: {e}")
-        return False
+        return None
 
-def delete_faces_from_collection(collection_id, user_id):
-    # Get all face data associated with the user ID from DynamoDB
-    face_data = get_face_data_from_dynamodb(user_id)
-    
-    # Filter face data based on folder name
-    filtered_face_data = [(face_id, folder_name) for face_id, folder_name in face_data if folder_name == 'Venky_Spandana_Reception_06022022']
-    
-    # Extract face IDs
-    face_ids = [face_id for face_id, _ in filtered_face_data]
-    
-    if not face_ids:
-        print(f"No faces found for user {user_id} in the specified folder.")
-        return []
-
-    # Disassociate the face IDs from the collection
-    if not disassociate_faces_from_collection(collection_id, face_ids, user_id):
+def purge_face_chunk(collection_id, user_id, face_ids, totals, ledger=None):
+    # Disassociate the face IDs from the collection, then delete them
+    with metrics.stage('disassociate'):
+        disassociated = disassociate_faces_from_collection(collection_id, face_ids, user_id)
+    if disassociated is None:
         print(f"Failed to disassociate faces for user {user_id}.")
-        return []
+        totals['errors'].append(f"disassociate: {len(face_ids)} faces")
+        return
+    totals['faces_disassociated'] += len(disassociated['DisassociatedFaces'])
+    totals['faces_not_disassociated'] += len(disassociated['UnsuccessfulFaceDisassociations'])
 
-    # Delete the faces
     try:
-        response = rekognition.delete_faces(CollectionId=collection_id, FaceIds=face_ids)
-        return response['DeletedFaces']
+        with metrics.stage('delete_faces'):
+            deleted = delete_faces_in_batches(rekognition, collection_id, face_ids)
+        totals['faces_deleted'] += len(deleted['DeletedFaces'])
+        # Faces that failed to disassociate come back here as ASSOCIATED_TO_AN_EXISTING_USER and are
+        # still in the collection, so the user must not be reported done
+        remaining = []
+        gone = list(deleted['DeletedFaces'])
+        for failure in deleted['UnsuccessfulFaceDeletions']:
+            if set(failure.get('Reasons', [])) == {FACE_NOT_FOUND_REASON}:
+                gone.append(failure['FaceId'])
+            else:
+                remaining.append(failure)
+        if ledger is not None and gone:
+            ledger.mark_completed(LEDGER_FACE_OPERATION, [unit_key(collection_id, face_id) for face_id in gone])
+        if remaining:
+            totals['faces_remaining'] += len(remaining)
+            reasons = sorted({reason for failure in remaining for reason in failure.get('Reasons', [])})
+            totals['errors'].append(f"delete_faces: {len(remaining)} faces not deleted ({', '.join(reasons)})")
     except ClientError as e:
         print(f"An error occurred while deleting faces: {e}")
-        return []
+        totals['errors'].append(f"delete_faces: {e}")
 
+def delete_faces_from_collection(collection_id, user_id, folder_name, ledger=None):
+    totals = {'faces_found': 0, 'faces_disassociated': 0, 'faces_not_disassociated': 0, 'faces_deleted': 0,
+              'faces_remaining': 0, 'errors': []}
+    pending = []
+    face_id_pages = get_folder_face_id_pages(user_id, folder_name)
+    if ledger is not None:
+        # Faces an earlier run already deleted are dropped before they reach Rekognition
+        face_id_pages = skip_completed(face_id_pages, ledger, LEDGER_FACE_OPERATION, collection_id)
+    try:
+        # Pages stream into full DeleteFaces chunks, at most one chunk plus one page is held
+        for face_ids in face_id_pages:
+            totals['faces_found'] += len(face_ids)
+            pending.extend(face_ids)
+            while len(pending) >= DELETE_FACES_MAX_BATCH:
+                purge_face_chunk(collection_id, user_id, pending[:DELETE_FACES_MAX_BATCH], totals, ledger)
+                pending = pending[DELETE_FACES_MAX_BATCH:]
+    except ClientError as e:
+        print(f"An error occurred while querying DynamoDB: {e}")
+        totals['errors'].append(f"query: {e}")
+    if pending:
+        purge_face_chunk(collection_id, user_id, pending, totals, ledger)
+
+    if not totals['faces_found'] and not totals['errors']:
+        debug(f"No faces found for user {user_id} in the folder {folder_name}.")
+    return totals
+
+def process_user(collection_id, user_id, folder_name, ledger=None):
+    debug(f"Processing User ID: {user_id}")
+    
+    # Delete face IDs associated with the user from the specified folder
+    try:
+        result = delete_faces_from_collection(collection_id, user_id, folder_name, ledger)
+    finally:
+        # The user's faces in the collection have changed, even when only some chunks went through
+        face_cache.invalidate(collection_id, user_id)
+    
+    debug(f"User ID: {user_id}")
+    debug(f"Total FaceIDs Deleted: {result['faces_deleted']}")
+    debug("------------------------")
+    return result
+
+@instrumented_handler('DisassociateFacesAndDeleteSpecificToDynamoDBAttribute')
 def lambda_handler(event, context):
     # Collection ID where faces are stored
     collection_id = 'FlashbackUserDataCollection'
     
-    # User IDs provided in the event
+    # User IDs and the folder whose faces are deleted, both provided in the event
     user_ids = event.get('user_ids', [])
+    folder_name = event.get('folder_name')
+    if not folder_name:
+        print("No folder_name provided")
+        return {
+            'statusCode': 400,
+            'body': 'No folder_name provided'
+        }
+    
+    try:
+        ledger = get_ledger(event)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': str(e)
+        }
+    
+    # Shards of an orchestrated run carry their share of the TPS quotas
+    configure_rate_limits(event)
+    
+    # Resume from an earlier invocation when the event carries a continuation_token
+    checkpoint = Checkpoint.resume(event)
+    
+    # Optional "workers" in the event processes users in parallel, users whose folder an earlier run
+    # completed are skipped
+    report = process_users(user_ids, lambda user_id: process_user(collection_id, user_id, folder_name, ledger), get_worker_count(event),
+                           checkpoint, lambda: time_is_running_out(context), ledger, unit_key(LEDGER_FOLDER_OPERATION, folder_name))
     
-    for user_id in user_ids:
-        print(f"Processing User ID: {user_id}")
-        
-        # Delete face IDs associated with the user from the specified folder
-        deleted_faces = delete_faces_from_collection(collection_id, user_id)
-        total_faces_deleted = len(deleted_faces)
-        
-        print(f"User ID: {user_id}")
-        print(f"Total FaceIDs Deleted: {total_faces_deleted}")
-        print("------------------------")
+    if report['pending']:
+        return continue_later(checkpoint, event, context, {'completed': len(report['succeeded']) + len(report['failed']), 'pending': len(report['pending'])})
+    checkpoint.finish()
     
     return {
         'statusCode': 200,
         'body': json.dumps({
-            'message': 'Deleted face IDs successfully'
+            'message': 'Deleted face IDs successfully',
+            **report
         })
     }
+
+
+## Manual payload
+
+# {
+#   "folder_name": "Venky_Spandana_Reception_06022022",
+#   "user_ids": [
+#     "98baf10c-d825-4e",
+#     "76b3d824-2dc7-41"
+#   ]
+# }
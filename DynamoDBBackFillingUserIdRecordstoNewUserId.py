@@ -1,18 +1,264 @@
 ## This code writes the records from old user_id to new_user_id
 
-import boto3
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from DynamoDBBatchWriter import BatchWriter
+from LambdaCheckpointing import Checkpoint, time_is_running_out, continue_later
+from ThrottleControl import ThrottledClient
+from InvocationMetrics import metrics, instrumented_handler
+from AwsClients import get_client
+from CompletionLedger import get_ledger, unit_key
+from DynamoDBExportFiles import list_export_files, read_export_items, ExportFileWriter
+from FaceLookupCache import face_cache
 
+# Parallel Scan segments used by the bulk remap mode unless the event sets "total_segments"
+DEFAULT_TOTAL_SEGMENTS = 8
+
+# Completion ledger operation, one entry per old -> new user_id pair that was fully rewritten
+LEDGER_OPERATION = 'remap_user_id'
+
+def load_user_id_mapping(event):
+    # old -> new user_id pairs from the event payload or a local .json / .csv file
+    mapping = dict(event.get('user_id_mapping', {}))
+    mapping_file = event.get('user_id_mapping_file')
+    if mapping_file:
+        with open(mapping_file, newline='') as f:
+            if mapping_file.endswith('.csv'):
+                for row in csv.reader(f):
+                    if len(row) >= 2 and row[0] and row[0] != 'user_id':
+                        mapping[row[0].strip()] = row[1].strip()
+            else:
+                mapping.update(json.load(f))
+
+    # Follow chains (a -> b, b -> c) so every item is rewritten once, straight to its final user_id
+    resolved = {}
+    for old_user_id in mapping:
+        new_user_id = mapping[old_user_id]
+        seen = {old_user_id}
+        while new_user_id in mapping and new_user_id not in seen:
+            seen.add(new_user_id)
+            new_user_id = mapping[new_user_id]
+        if new_user_id != old_user_id:
+            resolved[old_user_id] = new_user_id
+    return resolved
+
+def add_stats(*stats):
+    totals = {}
+    for stat in stats:
+        for key, value in stat.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+def remap_segment(dynamodb, table_name, mapping, segment, total_segments, checkpoint, context):
+    scan_params = {
+        'TableName': table_name,
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+
+    # Pick the segment up where an earlier invocation left it
+    progress = checkpoint.get_cursor(f"segment-{segment}", {})
+    if progress.get('done'):
+        return progress['stats'], True
+    if progress.get('last_evaluated_key'):
+        scan_params['ExclusiveStartKey'] = progress['last_evaluated_key']
+    previous_stats = progress.get('stats', {})
+    records_scanned = 0
+    records_matched = 0
+    done = False
+
+    with BatchWriter(dynamodb, table_name) as writer:
+        while True:
+            response = dynamodb.scan(**scan_params)
+            page_matched = 0
+
+            for item in response.get('Items', []):
+                records_scanned += 1
+                new_user_id = mapping.get(item.get('user_id', {}).get('S'))
+                if new_user_id is not None:
+                    item['user_id'] = {'S': new_user_id}
+                    writer.put(item)
+                    page_matched += 1
+            records_matched += page_matched
+            metrics.increment('records.scanned', len(response.get('Items', [])))
+            metrics.increment('records.matched', page_matched)
+
+            if 'LastEvaluatedKey' in response:
+                scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            else:
+                done = True
+
+            # The page is written before its cursor is recorded, so a resume never skips records
+            with metrics.stage('write_page'):
+                writer.flush()
+            stats = add_stats(previous_stats, {'records_scanned': records_scanned, 'records_read': records_matched}, writer.stats())
+            checkpoint.set_cursor(f"segment-{segment}", {
+                'last_evaluated_key': scan_params.get('ExclusiveStartKey'),
+                'done': done,
+                'stats': stats
+            })
+            if done or time_is_running_out(context):
+                break
+
+    return stats, done
+
+def remap_export_items(items, mapping, counts):
+    # Yields (item, remapped) for every exported item, rewriting the user_id of the matching ones
+    for item in items:
+        counts['records_scanned'] += 1
+        new_user_id = mapping.get(item.get('user_id', {}).get('S'))
+        if new_user_id is not None:
+            counts['records_read'] += 1
+            item['user_id'] = {'S': new_user_id}
+        yield item, new_user_id is not None
+
+def remap_export_to_table(dynamodb, s3, table_name, mapping, export_files, checkpoint, context):
+    # Only the rewritten items are written back, the live table is never read. Progress is saved
+    # per export file, a resumed file is written again from its start (the puts are idempotent).
+    progress = checkpoint.get_cursor('export', {})
+    files_done = list(progress.get('files_done', []))
+    stats = progress.get('stats', {})
+    for location in export_files:
+        if location in files_done:
+            continue
+        if time_is_running_out(context):
+            return stats, False
+        counts = {'records_scanned': 0, 'records_read': 0}
+        with metrics.stage('export_file'):
+            with BatchWriter(dynamodb, table_name) as writer:
+                for item, remapped in remap_export_items(read_export_items(location, s3), mapping, counts):
+                    if remapped:
+                        writer.put(item)
+        metrics.increment('records.scanned', counts['records_scanned'])
+        metrics.increment('records.matched', counts['records_read'])
+        files_done.append(location)
+        stats = add_stats(stats, counts, writer.stats())
+        checkpoint.set_cursor('export', {'files_done': files_done, 'stats': stats})
+    return stats, True
+
+def remap_export_to_file(s3, mapping, export_files, destination):
+    # Every item goes to the output, rewritten or not, so it can be imported as a complete table.
+    # The file is written in one go and not resumed, it is meant for offline runs.
+    counts = {'records_scanned': 0, 'records_read': 0}
+    with ExportFileWriter(destination, s3) as writer:
+        for location in export_files:
+            with metrics.stage('export_file'):
+                for item, _ in remap_export_items(read_export_items(location, s3), mapping, counts):
+                    writer.put(item)
+    metrics.increment('records.scanned', counts['records_scanned'])
+    metrics.increment('records.matched', counts['records_read'])
+    return dict(counts, records_written=writer.written, records_failed=0), True
+
+def remap_export(dynamodb, s3, table_name, mapping, export_source, export_output, checkpoint, context):
+    export_files = list_export_files(export_source, s3)
+    print("Remapping {} user_ids from {} export files in {}".format(len(mapping), len(export_files), export_source))
+    if export_output == 'table':
+        totals, done = remap_export_to_table(dynamodb, s3, table_name, mapping, export_files, checkpoint, context)
+    else:
+        totals, done = remap_export_to_file(s3, mapping, export_files, export_output)
+    totals = add_stats({'records_scanned': 0, 'records_read': 0, 'records_written': 0, 'records_failed': 0}, totals)
+    print("Read {} exported records, rewrote {} of {} matching records".format(
+        totals['records_scanned'], totals['records_written'], totals['records_read']))
+    return dict(totals, export_files=len(export_files)), done
+
+def timed_remap_segment(dynamodb, table_name, mapping, segment, total_segments, checkpoint, context):
+    with metrics.stage('scan_segment'):
+        return remap_segment(dynamodb, table_name, mapping, segment, total_segments, checkpoint, context)
+
+def remap_table_user_ids(dynamodb, table_name, mapping, checkpoint, context, total_segments=DEFAULT_TOTAL_SEGMENTS):
+    # One parallel Scan over the whole table serves every pair in the mapping
+    print("Remapping {} user_ids across {} with {} scan segments".format(len(mapping), table_name, total_segments))
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        segment_results = list(executor.map(
+            lambda segment: timed_remap_segment(dynamodb, table_name, mapping, segment, total_segments, checkpoint, context),
+            range(total_segments)
+        ))
+
+    totals = add_stats(*[stats for stats, _ in segment_results])
+    print("Scanned {} records, rewrote {} of {} matching records".format(
+        totals['records_scanned'], totals['records_written'], totals['records_read']))
+    return totals, all(done for _, done in segment_results)
+
+@instrumented_handler('DynamoDBBackFillingUserIdRecordstoNewUserId')
 def lambda_handler(event, context):
-    # Initialize DynamoDB client
-    dynamodb = boto3.client('dynamodb')
+    # Shared DynamoDB client, reused by warm invocations
+    dynamodb = ThrottledClient(get_client('dynamodb'), 'dynamodb')
 
     # Define the table name
     table_name = 'indexed_data'
+    
+    try:
+        ledger = get_ledger(event)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': str(e)
+        }
+
+    # Bulk mode: a whole old -> new mapping in one pass over the table
+    if 'user_id_mapping' in event or 'user_id_mapping_file' in event:
+        try:
+            mapping = load_user_id_mapping(event)
+            if not mapping:
+                print("No user_id mapping provided")
+                return {
+                    'statusCode': 400,
+                    'body': 'No user_id mapping provided'
+                }
+            total_segments = max(1, int(event.get('total_segments', DEFAULT_TOTAL_SEGMENTS)))
+            
+            # Pairs an earlier run already rewrote are left out of the scan
+            completed = ledger.completed(LEDGER_OPERATION, [unit_key(old, new) for old, new in mapping.items()])
+            mapping = {old: new for old, new in mapping.items() if unit_key(old, new) not in completed}
+            if not mapping:
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'message': 'Bulk user_id remap already completed', 'user_ids_skipped': len(completed)})
+                }
+
+            # Resume from an earlier invocation when the event carries a continuation_token
+            checkpoint = Checkpoint.resume(event)
+            try:
+                if event.get('export_source'):
+                    # Offline ingestion: the records come from an export of the table instead of a Scan
+                    s3 = ThrottledClient(get_client('s3'), 's3')
+                    totals, done = remap_export(dynamodb, s3, table_name, mapping, event['export_source'],
+                                                event.get('export_output', 'table'), checkpoint, context)
+                else:
+                    totals, done = remap_table_user_ids(dynamodb, table_name, mapping, checkpoint, context, total_segments)
+            finally:
+                # Cached face lists of both sides of every pair no longer match the table
+                face_cache.invalidate(table_name, [*mapping, *mapping.values()])
+            if not done:
+                return continue_later(checkpoint, event, context, totals)
+            checkpoint.finish()
+            if not totals['records_failed']:
+                ledger.mark_completed(LEDGER_OPERATION, [unit_key(old, new) for old, new in mapping.items()])
+            return {
+                'statusCode': 500 if totals['records_failed'] else 200,
+                'body': json.dumps({'message': 'Bulk user_id remap completed', 'user_ids_mapped': len(mapping),
+                                    'user_ids_skipped': len(completed), **totals})
+            }
+        except Exception as e:
+            print("Error:", e)
+            return {
+                'statusCode': 500,
+                'body': 'Error: {}'.format(e)
+            }
 
     # Extract new unique_uid from the event
     new_user_id = event.get('new_user_id')
 
     try:
+        # A pair an earlier run already rewrote is not queried again
+        if ledger.is_completed(LEDGER_OPERATION, unit_key(event['user_id'], new_user_id)):
+            print("Records of user_id {} were already remapped to {}".format(event['user_id'], new_user_id))
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'message': 'Records already remapped', 'records_read': 0})
+            }
+        
         # Initialize the query parameters
         query_params = {
             'TableName': table_name,
@@ -22,37 +268,68 @@ def lambda_handler(event, context):
             'ExpressionAttributeValues': {':user_id': {'S': event['user_id']}}
         }
 
-        all_items = []
-        
-        # Retrieve records from DynamoDB table with pagination
-        while True:
-            response = dynamodb.query(**query_params)
-            
-            if 'Items' in response:
-                all_items.extend(response['Items'])
-            
-            # Check if there's more data to be fetched
-            if 'LastEvaluatedKey' in response:
-                query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
-            else:
-                break
-        
-        num_records_found = len(all_items)
+        # Resume from an earlier invocation when the event carries a continuation_token
+        checkpoint = Checkpoint.resume(event)
+        progress = checkpoint.get_cursor('query', {})
+        if progress.get('last_evaluated_key'):
+            query_params['ExclusiveStartKey'] = progress['last_evaluated_key']
+        previous_stats = progress.get('stats', {})
+        num_records_found = progress.get('records_read', 0)
+        stopped = False
+
+        # Rewrite every page as soon as it arrives, only one page and one 25-item batch are held at a time
+        try:
+            with BatchWriter(dynamodb, table_name) as writer:
+                while True:
+                    response = dynamodb.query(**query_params)
+
+                    metrics.increment('records.matched', len(response.get('Items', [])))
+                    for item in response.get('Items', []):
+                        item['user_id'] = {'S': new_user_id}
+                        writer.put(item)
+                        num_records_found += 1
+
+                    # Check if there's more data to be fetched
+                    if 'LastEvaluatedKey' in response:
+                        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+                    else:
+                        break
+
+                    # The page is written before its cursor is recorded, so a resume never skips records
+                    with metrics.stage('write_page'):
+                        writer.flush()
+                    checkpoint.set_cursor('query', {
+                        'last_evaluated_key': response['LastEvaluatedKey'],
+                        'records_read': num_records_found,
+                        'stats': add_stats(previous_stats, writer.stats())
+                    })
+                    if time_is_running_out(context):
+                        stopped = True
+                        break
+        finally:
+            # Cached face lists of both users no longer match the table
+            face_cache.invalidate(table_name, [event['user_id'], new_user_id])
+
+        stats = add_stats(previous_stats, writer.stats())
+        if stopped:
+            return continue_later(checkpoint, event, context, {'records_read': num_records_found, **stats})
+        checkpoint.finish()
+
         print("Number of records found with user_id {}: {}".format(event['user_id'], num_records_found))
 
         if num_records_found > 0:
-            # Create new records with updated user_id
-            for item in all_items:
-                item['user_id'] = {'S': new_user_id}
-                response = dynamodb.put_item(
-                    TableName=table_name,
-                    Item=item
-                )
-            print("Number of records created with new_user_id {}: {}".format(new_user_id, num_records_found))
+            print("Number of records created with new_user_id {}: {}".format(new_user_id, stats['records_written']))
+            body = {'records_read': num_records_found, **stats}
 
+            if stats['records_failed']:
+                return {
+                    'statusCode': 500,
+                    'body': json.dumps({'message': 'Some records could not be written', **body})
+                }
+            ledger.mark_completed(LEDGER_OPERATION, [unit_key(event['user_id'], new_user_id)])
             return {
                 'statusCode': 200,
-                'body': 'Records updated and created successfully'
+                'body': json.dumps({'message': 'Records updated and created successfully', **body})
             }
         else:
             print("No records found with user_id:", event['user_id'])
@@ -77,3 +354,22 @@ def lambda_handler(event, context):
 #   "user_id": "6746df08-c5a6-45",
 #   "new_user_id": "030341a4-9e38-43"
 # }
+
+## Bulk remap payload (or "user_id_mapping_file": "/tmp/user_id_mapping.csv")
+
+# {
+#   "user_id_mapping": {
+#     "6746df08-c5a6-45": "030341a4-9e38-43"
+#   },
+#   "total_segments": 8
+# }
+
+## Bulk remap from a DYNAMODB_JSON export of indexed_data (a local directory or file, or an s3:// export
+## prefix), with no reads on the live table. "export_output" is "table" (write the rewritten records
+## back, the default) or a local / s3:// .json.gz path for a complete remapped copy for ImportTable.
+
+# {
+#   "user_id_mapping_file": "/tmp/user_id_mapping.csv",
+#   "export_source": "s3://indexed-data-exports/AWSDynamoDB/01700000000000-abcdef12/",
+#   "export_output": "table"
+# }
@@ -0,0 +1,74 @@
+## Buffered BatchWriteItem writer for the DynamoDB utilities.
+## Items are flushed in 25-item BatchWriteItem requests as soon as a chunk fills up, so callers can
+## stream pages through it without holding them. UnprocessedItems are resubmitted with jittered
+## exponential backoff and the writer keeps counts of what was written, retried and given up on.
+
+import random
+import time
+from InvocationMetrics import metrics
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_MAX_ITEMS = 25
+
+class BatchWriter:
+    def __init__(self, dynamodb, table_name, max_attempts=8, base_delay=0.05, max_delay=5.0):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buffer = []
+        self.written = 0
+        self.retried = 0
+        self.failed_items = []
+        self.requests = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Leave the buffer alone when the caller failed, so no partial page is written behind its back
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def put(self, item):
+        self.buffer.append({'PutRequest': {'Item': item}})
+        if len(self.buffer) >= BATCH_WRITE_MAX_ITEMS:
+            self.flush()
+
+    def flush(self):
+        while self.buffer:
+            chunk = self.buffer[:BATCH_WRITE_MAX_ITEMS]
+            self.buffer = self.buffer[BATCH_WRITE_MAX_ITEMS:]
+            self.write_chunk(chunk)
+
+    def write_chunk(self, requests):
+        attempt = 1
+        while requests:
+            response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+            self.requests += 1
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            self.written += len(requests) - len(unprocessed)
+            metrics.increment('records.written', len(requests) - len(unprocessed))
+            if not unprocessed:
+                return
+            if attempt >= self.max_attempts:
+                print(f"Giving up on {len(unprocessed)} unprocessed items for {self.table_name} after {attempt} attempts")
+                self.failed_items.extend(request['PutRequest']['Item'] for request in unprocessed if 'PutRequest' in request)
+                metrics.increment('records.failed', len(unprocessed))
+                return
+            # Full jitter keeps concurrent writers from retrying in lockstep
+            time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+            self.retried += len(unprocessed)
+            metrics.increment('records.retried', len(unprocessed))
+            requests = unprocessed
+            attempt += 1
+
+    def stats(self):
+        return {
+            'records_written': self.written,
+            'records_retried': self.retried,
+            'records_failed': len(self.failed_items),
+            'batch_requests': self.requests
+        }
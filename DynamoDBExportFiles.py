@@ -0,0 +1,108 @@
+## Streaming access to DynamoDB table exports for the offline utilities.
+## ExportTableToPointInTime in DYNAMODB_JSON format writes gzip-compressed JSON lines, one
+## {"Item": {...}} per line. Export files are read a line at a time from local disk or S3, so an
+## export of any size is processed in constant memory and without a single read against the live
+## table, and items can be written back out in the same format for ImportTable.
+
+import glob
+import gzip
+import io
+import json
+import os
+import tempfile
+from urllib.parse import urlparse
+from botocore.exceptions import ClientError
+
+EXPORT_FILE_SUFFIX = '.json.gz'
+
+# Written next to the data files by every export, one {"dataFileS3Key": ...} line per data file
+MANIFEST_FILES_NAME = 'manifest-files.json'
+
+def parse_s3_url(url):
+    parsed_url = urlparse(url)
+    return parsed_url.netloc, parsed_url.path.lstrip('/')
+
+def list_s3_export_files(s3, bucket, prefix):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=f"{prefix.rstrip('/')}/{MANIFEST_FILES_NAME}")
+        manifest = response['Body'].read().decode('utf-8')
+        return [f"s3://{bucket}/{json.loads(line)['dataFileS3Key']}" for line in manifest.splitlines() if line.strip()]
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+
+    # No manifest: every .json.gz object under the prefix
+    locations = []
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3.list_objects_v2(**params)
+        locations.extend(f"s3://{bucket}/{entry['Key']}" for entry in response.get('Contents', [])
+                         if entry['Key'].endswith(EXPORT_FILE_SUFFIX))
+        if response.get('IsTruncated'):
+            params['ContinuationToken'] = response['NextContinuationToken']
+        else:
+            return sorted(locations)
+
+def list_export_files(source, s3=None):
+    # source is one export file, a directory holding an export, or an s3://bucket/prefix
+    if source.startswith('s3://'):
+        bucket, key = parse_s3_url(source)
+        if key.endswith(EXPORT_FILE_SUFFIX):
+            return [source]
+        return list_s3_export_files(s3, bucket, key)
+    if os.path.isdir(source):
+        return sorted(glob.glob(os.path.join(source, '**', f"*{EXPORT_FILE_SUFFIX}"), recursive=True))
+    return [source]
+
+def open_export_file(location, s3=None):
+    if location.startswith('s3://'):
+        bucket, key = parse_s3_url(location)
+        raw = s3.get_object(Bucket=bucket, Key=key)['Body']
+    else:
+        raw = open(location, 'rb')
+    # GzipFile only reads forward, so the S3 body is decompressed as it streams in
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding='utf-8')
+
+def read_export_items(location, s3=None):
+    # Yields the items of one export file in DynamoDB JSON, one line in memory at a time
+    with open_export_file(location, s3) as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)['Item']
+
+class ExportFileWriter:
+    # Writes items as a gzip DYNAMODB_JSON file that ImportTable accepts. An s3:// destination is
+    # spooled to a local temporary file and uploaded when the writer is closed.
+    def __init__(self, destination, s3=None):
+        self.destination = destination
+        self.s3 = s3
+        self.written = 0
+        if destination.startswith('s3://'):
+            self.path = tempfile.NamedTemporaryFile(suffix=EXPORT_FILE_SUFFIX, delete=False).name
+        else:
+            self.path = destination
+        self.file = gzip.open(self.path, 'wt', encoding='utf-8', compresslevel=6)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(upload=exc_type is None)
+        return False
+
+    def put(self, item):
+        self.file.write(json.dumps({'Item': item}, separators=(',', ':')))
+        self.file.write('\n')
+        self.written += 1
+
+    def close(self, upload=True):
+        self.file.close()
+        if self.path == self.destination:
+            return
+        try:
+            if upload:
+                bucket, key = parse_s3_url(self.destination)
+                with open(self.path, 'rb') as f:
+                    self.s3.put_object(Bucket=bucket, Key=key, Body=f, ContentType='application/gzip')
+        finally:
+            os.remove(self.path)
@@ -0,0 +1,131 @@
+## Warm-container cache of user -> face id lookups.
+## The purge lambdas rebuild a user's face list with paginated DynamoDB queries or ListFaces calls on
+## every invocation, while orchestrated runs often come back to the same users minutes later. Face
+## lists are kept at module level, so warm invocations of a container share them, keyed by
+## (table or collection, user_id, folder). Entries expire after a TTL, the least recently used ones
+## are evicted past an entry count and a memory bound, and a handler that changes a user's faces in a
+## table or collection drops every entry of that user for it.
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from InvocationMetrics import metrics
+
+FACE_CACHE_ENABLED = os.environ.get('FACE_CACHE_ENABLED', 'true').lower() == 'true'
+FACE_CACHE_TTL_SECONDS = float(os.environ.get('FACE_CACHE_TTL_SECONDS', '600'))
+FACE_CACHE_MAX_ENTRIES = int(os.environ.get('FACE_CACHE_MAX_ENTRIES', '10000'))
+FACE_CACHE_MAX_BYTES = int(os.environ.get('FACE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# A single face list larger than this is never cached, so one huge user cannot flush everyone else
+FACE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('FACE_CACHE_MAX_ENTRY_BYTES', str(FACE_CACHE_MAX_BYTES // 4)))
+
+def face_ids_bytes(face_ids):
+    # The strings plus one tuple slot each
+    return sum(sys.getsizeof(face_id) + 8 for face_id in face_ids)
+
+class FaceLookupCache:
+    def __init__(self, ttl_seconds=FACE_CACHE_TTL_SECONDS, max_entries=FACE_CACHE_MAX_ENTRIES,
+                 max_bytes=FACE_CACHE_MAX_BYTES, max_entry_bytes=FACE_CACHE_MAX_ENTRY_BYTES, enabled=FACE_CACHE_ENABLED):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # (source, user_id, folder) -> (expires_at, face_ids, size), least recently used first
+        self.entries = OrderedDict()
+        # (source, user_id) -> keys of every folder cached for that user
+        self.user_keys = {}
+        # Bumped by every invalidation of a source, a lookup that overlaps one is not cached
+        self.generations = {}
+        self.bytes = 0
+
+    def drop(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+        user_keys = self.user_keys[key[:2]]
+        user_keys.discard(key)
+        if not user_keys:
+            del self.user_keys[key[:2]]
+
+    def generation(self, source):
+        with self.lock:
+            return self.generations.get(source, 0)
+
+    def get(self, source, user_id, folder_name=None):
+        if not self.enabled:
+            return None
+        key = (source, user_id, folder_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self.drop(key)
+                entry = None
+            if entry is None:
+                metrics.increment('face_cache.miss')
+                return None
+            self.entries.move_to_end(key)
+        metrics.increment('face_cache.hit')
+        return list(entry[1])
+
+    def put(self, source, user_id, face_ids, folder_name=None, generation=None):
+        if not self.enabled:
+            return
+        face_ids = tuple(face_ids)
+        size = face_ids_bytes(face_ids)
+        if size > self.max_entry_bytes:
+            return
+        key = (source, user_id, folder_name)
+        with self.lock:
+            if generation is not None and generation != self.generations.get(source, 0):
+                # The user may have changed while the lookup was running
+                return
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, face_ids, size)
+            self.user_keys.setdefault(key[:2], set()).add(key)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                metrics.increment('face_cache.evicted')
+
+    def invalidate(self, source, user_ids):
+        if isinstance(user_ids, str):
+            user_ids = [user_ids]
+        with self.lock:
+            self.generations[source] = self.generations.get(source, 0) + 1
+            for user_id in user_ids:
+                for key in list(self.user_keys.get((source, user_id), ())):
+                    self.drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_keys.clear()
+            self.bytes = 0
+
+    def cached_pages(self, source, user_id, pages, folder_name=None):
+        # Serves a cached face list as a single page. Otherwise the pages stream through as before and
+        # are cached once the last one has been read; a list over the entry bound stops being collected.
+        face_ids = self.get(source, user_id, folder_name)
+        if face_ids is not None:
+            yield face_ids
+            return
+        generation = self.generation(source)
+        collected = [] if self.enabled else None
+        collected_bytes = 0
+        for page in pages:
+            if collected is not None:
+                collected_bytes += face_ids_bytes(page)
+                if collected_bytes <= self.max_entry_bytes:
+                    collected.extend(page)
+                else:
+                    collected = None
+            yield page
+        if collected is not None:
+            self.put(source, user_id, collected, folder_name, generation)
+
+# One cache per container, shared by every handler loaded into it
+face_cache = FaceLookupCache()
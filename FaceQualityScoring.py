@@ -0,0 +1,99 @@
+## Batch face quality scoring for the thumbnail backfill.
+## A query page is parsed once into columns (confidence, eyes open, brightness, sharpness, roll, yaw,
+## pitch), the thresholds are applied to whole columns as masks and the best passing face is picked
+## by score instead of taking the first item that happens to pass.
+
+import json
+import os
+
+DEFAULT_THRESHOLDS = {
+    'min_confidence': 98,
+    'min_eyes_open_confidence': 95,
+    'min_brightness': 40,
+    'min_sharpness': 18,
+    'max_abs_roll': 20.0,
+    'max_abs_yaw': 15.0,
+    'max_abs_pitch': 15.0
+}
+
+def load_thresholds(event=None):
+    # Defaults, then FACE_QUALITY_THRESHOLDS (JSON) from the environment, then "thresholds" in the event
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds.update(json.loads(os.environ.get('FACE_QUALITY_THRESHOLDS', '{}')))
+    if event:
+        thresholds.update(event.get('thresholds', {}))
+    unknown = set(thresholds) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise ValueError(f"Unknown face quality thresholds: {sorted(unknown)}")
+    return {name: float(value) for name, value in thresholds.items()}
+
+def parse_json_attribute(value):
+    try:
+        return json.loads(value) if isinstance(value, str) else (value or {})
+    except json.JSONDecodeError:
+        return None
+
+def parse_face_columns(items):
+    columns = {
+        'occluded': [], 'confidence': [], 'eyes_open': [], 'eyes_open_confidence': [],
+        'brightness': [], 'sharpness': [], 'roll': [], 'yaw': [], 'pitch': [], 'parsed': []
+    }
+    for item in items:
+        pose = parse_json_attribute(item.get('Pose', '{}'))
+        quality = parse_json_attribute(item.get('Quality', '{}'))
+        columns['parsed'].append(pose is not None and quality is not None)
+        pose = pose or {}
+        quality = quality or {}
+        columns['occluded'].append(item.get('FaceOccluded_Value', None))
+        columns['confidence'].append(float(item.get('Confidence', 0)))
+        columns['eyes_open'].append(item.get('EyesOpen_Value', None))
+        columns['eyes_open_confidence'].append(float(item.get('EyesOpen_Confidence', 0)))
+        columns['brightness'].append(float(quality.get('Brightness', 0)))
+        columns['sharpness'].append(float(quality.get('Sharpness', 0)))
+        columns['roll'].append(float(pose.get('Roll', 0)))
+        columns['yaw'].append(float(pose.get('Yaw', 0)))
+        columns['pitch'].append(float(pose.get('Pitch', 0)))
+    return columns
+
+def valid_face_mask(columns, thresholds):
+    # Each condition is evaluated over the whole column, the mask is their element-wise AND
+    conditions = [
+        columns['parsed'],
+        [occluded is not None and not occluded for occluded in columns['occluded']],
+        [eyes_open is not None and bool(eyes_open) for eyes_open in columns['eyes_open']],
+        [value > thresholds['min_confidence'] for value in columns['confidence']],
+        [value > thresholds['min_eyes_open_confidence'] for value in columns['eyes_open_confidence']],
+        [value > thresholds['min_brightness'] for value in columns['brightness']],
+        [value > thresholds['min_sharpness'] for value in columns['sharpness']],
+        [abs(value) <= thresholds['max_abs_roll'] for value in columns['roll']],
+        [abs(value) <= thresholds['max_abs_yaw'] for value in columns['yaw']],
+        [abs(value) <= thresholds['max_abs_pitch'] for value in columns['pitch']]
+    ]
+    return [all(row) for row in zip(*conditions)]
+
+def face_quality_scores(columns, thresholds):
+    # Sharper, brighter, more confident and more frontal faces score higher
+    max_roll = max(thresholds['max_abs_roll'], 1.0)
+    max_yaw = max(thresholds['max_abs_yaw'], 1.0)
+    max_pitch = max(thresholds['max_abs_pitch'], 1.0)
+    return [
+        (confidence + eyes_open_confidence + sharpness + brightness) / 100
+        - (abs(roll) / max_roll + abs(yaw) / max_yaw + abs(pitch) / max_pitch) / 3
+        for confidence, eyes_open_confidence, sharpness, brightness, roll, yaw, pitch in zip(
+            columns['confidence'], columns['eyes_open_confidence'], columns['sharpness'],
+            columns['brightness'], columns['roll'], columns['yaw'], columns['pitch']
+        )
+    ]
+
+def select_best_face(items, thresholds):
+    # Returns (item, score) for the best face passing every threshold, or (None, None)
+    if not items:
+        return None, None
+    columns = parse_face_columns(items)
+    mask = valid_face_mask(columns, thresholds)
+    scores = face_quality_scores(columns, thresholds)
+    candidates = [index for index, valid in enumerate(mask) if valid]
+    if not candidates:
+        return None, None
+    best_index = max(candidates, key=lambda index: scores[index])
+    return items[best_index], scores[best_index]
@@ -0,0 +1,181 @@
+## Structured metrics for the utility lambdas.
+## Counters and latency histograms are collected for every throttled API call and every pipeline
+## stage and written once per invocation as a CloudWatch embedded-metric (EMF) JSON line, instead of
+## one print per face. Per-item log lines only show up with LOG_LEVEL=DEBUG.
+
+import functools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from InvocationProfiling import profiled
+
+# ERROR, INFO or DEBUG; per-face / per-user progress lines are DEBUG
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = {'ERROR': 40, 'INFO': 20, 'DEBUG': 10}
+
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'UtilityLambdas')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# An EMF metric takes at most 100 values, longer series are reservoir-sampled down to this
+EMF_MAX_VALUES = 100
+
+def log_enabled(level):
+    return LOG_LEVELS.get(level, 20) >= LOG_LEVELS.get(LOG_LEVEL, 20)
+
+def debug(message):
+    if log_enabled('DEBUG'):
+        print(message)
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+        self.samples = []
+
+    def record(self, milliseconds):
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and milliseconds > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        self.min_ms = milliseconds if self.min_ms is None else min(self.min_ms, milliseconds)
+        self.max_ms = milliseconds if self.max_ms is None else max(self.max_ms, milliseconds)
+        # Uniform reservoir sample for the EMF value array
+        if len(self.samples) < EMF_MAX_VALUES:
+            self.samples.append(milliseconds)
+        else:
+            slot = random.randrange(self.count)
+            if slot < EMF_MAX_VALUES:
+                self.samples[slot] = milliseconds
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket the percentile falls in, capped by the largest value seen
+        threshold = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= threshold and bucket_count:
+                bound = LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3) if self.max_ms is not None else None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total_ms, 3),
+            'min_ms': round(self.min_ms, 3) if self.min_ms is not None else None,
+            'max_ms': round(self.max_ms, 3) if self.max_ms is not None else None,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'buckets_ms': {
+                (str(LATENCY_BUCKETS_MS[index]) if index < len(LATENCY_BUCKETS_MS) else 'inf'): bucket_count
+                for index, bucket_count in enumerate(self.counts) if bucket_count
+            }
+        }
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started_at = time.perf_counter()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_latency(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].record(seconds * 1000.0)
+
+    @contextmanager
+    def stage(self, name):
+        # Times a block of work as "stage.<name>", failed blocks are counted too
+        started_at = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(f"stage.{name}.errors")
+            raise
+        finally:
+            self.record_latency(f"stage.{name}", time.perf_counter() - started_at)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'duration_ms': round((time.perf_counter() - self.started_at) * 1000.0, 3),
+                'counters': dict(sorted(self.counters.items())),
+                'latencies': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())}
+            }
+
+    def emf_document(self, dimensions, namespace=METRICS_NAMESPACE):
+        summary = self.summary()
+        with self.lock:
+            samples = {name: list(histogram.samples) for name, histogram in self.histograms.items()}
+        document = dict(dimensions)
+        definitions = [{'Name': 'Duration', 'Unit': 'Milliseconds'}]
+        document['Duration'] = summary['duration_ms']
+        for name, value in summary['counters'].items():
+            definitions.append({'Name': name, 'Unit': 'Bytes' if name.endswith('bytes_fetched') else 'Count'})
+            document[name] = value
+        for name in summary['latencies']:
+            definitions.append({'Name': name, 'Unit': 'Milliseconds'})
+            document[name] = [round(value, 3) for value in samples[name]]
+        # Exact histograms go along as plain properties for Logs Insights
+        document['latency_histograms'] = summary['latencies']
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': definitions
+            }]
+        }
+        return document
+
+    def emit(self, dimensions, namespace=METRICS_NAMESPACE):
+        if METRICS_ENABLED:
+            print(json.dumps(self.emf_document(dimensions, namespace), separators=(',', ':'), default=str))
+
+# One registry per container; instrumented_handler resets it at the start of every invocation
+metrics = Metrics()
+
+def instrumented_handler(handler_name):
+    # Decorator for lambda_handler: resets the metrics, times the invocation and emits the summary.
+    # With profiling switched on (see InvocationProfiling) the invocation is profiled as well.
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            metrics.reset()
+            status_code = None
+            try:
+                with profiled(handler_name, event):
+                    response = handler(event, context)
+                status_code = response.get('statusCode') if isinstance(response, dict) else None
+                return response
+            except Exception:
+                metrics.increment('invocation.errors')
+                raise
+            finally:
+                if status_code is not None:
+                    metrics.increment(f"invocation.status.{status_code}")
+                metrics.emit({'Handler': handler_name})
+        return wrapper
+    return decorator
@@ -0,0 +1,190 @@
+## Opt-in CPU and allocation profiling for the utility lambdas.
+## With PROFILE (or "profile" in the event) set to "cpu", "memory" or "all", instrumented_handler runs
+## the invocation under cProfile and/or tracemalloc and prints one compact JSON report: the top
+## functions by cumulative time and the top allocation sites still held when the handler returns,
+## plus the traced peak. The handler thread and every thread it starts (user workers, pipeline and
+## image I/O threads) are profiled, each by a profiler it enables and disables itself. Threads still
+## running when the handler returns are left out of the report, and the container-lifetime image
+## dispatchers are never profiled; the forked image worker processes are not either, their decode and
+## encode time is in the stage metrics. "profile_path" (or PROFILE_PATH) also writes the raw cProfile
+## stats there, for snakeviz or pstats, and the tracemalloc snapshot next to it.
+##
+## Read a saved profile with:
+##   python -m pstats /tmp/profile.prof
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# "off", "cpu", "memory" or "all", overridable per event with "profile" (true means "all")
+PROFILE = os.environ.get('PROFILE', 'off').lower()
+PROFILE_MODES = ('off', 'cpu', 'memory', 'all')
+PROFILE_PATH = os.environ.get('PROFILE_PATH')
+
+# Entries in each top list of the report
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '20'))
+
+# Stack frames kept per allocation, 1 groups them by the allocating line
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', '1'))
+
+# Worker threads spend most of their wall time blocked in these, which would crowd the real work out
+# of the top list; the raw profile keeps them
+IDLE_SOURCES = ('threading.py', 'queue.py', os.path.join('concurrent', 'futures'))
+IDLE_FUNCTIONS = ("<method 'acquire' of '_thread.lock' objects>", "<method 'acquire' of '_thread.RLock' objects>",
+                  "<method 'get' of '_queue.SimpleQueue' objects>")
+
+# Threads that live as long as the container (ThumbnailImageWorkers' dispatchers) would keep their
+# profiler running long after the invocation, so they are not profiled
+UNPROFILED_THREAD_PREFIXES = ('ImageWorkerDispatch',)
+
+# The profiler's own allocations are left out of the memory report
+PROFILER_SOURCES = (tracemalloc.__file__, __file__, '*/cProfile.py', '*/pstats.py',
+                    '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>')
+
+def get_profile_mode(event):
+    mode = event.get('profile', PROFILE) if isinstance(event, dict) else PROFILE
+    if mode is True:
+        return 'all'
+    if not mode:
+        return 'off'
+    mode = str(mode).lower()
+    if mode not in PROFILE_MODES:
+        print(f"Unknown profile mode {mode}, expected one of {', '.join(PROFILE_MODES)}; not profiling")
+        return 'off'
+    return mode
+
+def is_idle(function):
+    filename, _, name = function
+    return name in IDLE_FUNCTIONS or filename.endswith(IDLE_SOURCES[:2]) or IDLE_SOURCES[2] in filename
+
+def function_label(function):
+    filename, line, name = function
+    if filename == '~':
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+class ThreadProfiles:
+    # One cProfile.Profile per thread: the handler's own, and one for each thread started meanwhile.
+    # A profiler only covers the thread that enabled it, so every thread enables and disables its own
+    # around Thread.run, and only the ones already disabled are read.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler_profile = None
+        # [profile, finished] per thread started while profiling
+        self.thread_profiles = []
+        self.original_run = None
+
+    def run_thread(self, thread):
+        import cProfile
+        if thread.name.startswith(UNPROFILED_THREAD_PREFIXES):
+            return self.original_run(thread)
+        profile = cProfile.Profile()
+        entry = [profile, False]
+        with self.lock:
+            self.thread_profiles.append(entry)
+        profile.enable()
+        try:
+            return self.original_run(thread)
+        finally:
+            profile.disable()
+            with self.lock:
+                entry[1] = True
+
+    def start(self):
+        # cProfile and pstats add to every cold start, so they are only imported when profiling
+        import cProfile
+        self.original_run = threading.Thread.run
+        thread_profiles = self
+
+        def run(thread):
+            return thread_profiles.run_thread(thread)
+        # Threads started from now on go through run_thread; subclasses with their own run are not profiled
+        threading.Thread.run = run
+        self.handler_profile = cProfile.Profile()
+        self.handler_profile.enable()
+
+    def stop(self):
+        import pstats
+        threading.Thread.run = self.original_run
+        self.handler_profile.disable()
+        with self.lock:
+            finished = [profile for profile, done in self.thread_profiles if done]
+            still_running = len(self.thread_profiles) - len(finished)
+        stats = pstats.Stats(self.handler_profile)
+        for profile in finished:
+            stats.add(profile)
+        return stats, 1 + len(finished), still_running
+
+def cpu_report(stats, threads, still_running, top):
+    entries = sorted((entry for entry in stats.stats.items() if not is_idle(entry[0])),
+                     key=lambda entry: entry[1][3], reverse=True)[:top]
+    return {
+        'threads': threads,
+        **({'threads_still_running': still_running} if still_running else {}),
+        'total_seconds': round(stats.total_tt, 4),
+        'top_cumulative': [{
+            'function': function_label(function),
+            'calls': primitive_calls if primitive_calls == calls else f"{calls}/{primitive_calls}",
+            'own_seconds': round(own_seconds, 4),
+            'cumulative_seconds': round(cumulative_seconds, 4)
+        } for function, (primitive_calls, calls, own_seconds, cumulative_seconds, _) in entries]
+    }
+
+def memory_report(snapshot, peak_bytes, top):
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, source) for source in PROFILER_SOURCES])
+    statistics = snapshot.statistics('lineno')
+    return {
+        'peak_kb': round(peak_bytes / 1024, 1),
+        'held_kb': round(sum(stat.size for stat in statistics) / 1024, 1),
+        'top_allocations': [{
+            'site': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count
+        } for stat in statistics[:top]]
+    }
+
+@contextmanager
+def profiled(handler_name, event):
+    mode = get_profile_mode(event)
+    if mode == 'off':
+        yield
+        return
+    profile_path = (event.get('profile_path') if isinstance(event, dict) else None) or PROFILE_PATH
+    profile_cpu = mode in ('cpu', 'all')
+    profile_memory = mode in ('memory', 'all')
+
+    # A run that is already tracing (e.g. the offline benchmark) keeps its tracing afterwards
+    was_tracing = tracemalloc.is_tracing()
+    if profile_memory:
+        if not was_tracing:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+    thread_profiles = ThreadProfiles() if profile_cpu else None
+    if thread_profiles is not None:
+        thread_profiles.start()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        report = {'Handler': handler_name, 'mode': mode, 'wall_seconds': round(time.perf_counter() - started_at, 4)}
+        # The snapshot comes first, before building the CPU report allocates anything
+        if profile_memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            if not was_tracing:
+                tracemalloc.stop()
+        if thread_profiles is not None:
+            stats, threads, still_running = thread_profiles.stop()
+            report['cpu'] = cpu_report(stats, threads, still_running, PROFILE_TOP)
+            if profile_path:
+                stats.dump_stats(profile_path)
+                report['cpu']['raw_profile'] = profile_path
+        if profile_memory:
+            report['memory'] = memory_report(snapshot, peak_bytes, PROFILE_TOP)
+            if profile_path:
+                snapshot.dump(f"{profile_path}.tracemalloc")
+                report['memory']['raw_snapshot'] = f"{profile_path}.tracemalloc"
+        print(json.dumps({'Profile': report}, separators=(',', ':')))
@@ -0,0 +1,225 @@
+## Checkpoint/resume for the utility lambdas.
+## Handlers record which users are done and where their DynamoDB / Rekognition paging stopped in a
+## pluggable store (a local JSON file or a DynamoDB item). Shortly before the Lambda deadline they
+## save the checkpoint and return a continuation token, or re-invoke themselves with it, so the next
+## invocation resumes where this one stopped instead of starting from the first user and page.
+## Only user ids and cursors are kept, never per-user results, so the state stays small.
+
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+from AwsClients import get_client
+from ThrottleControl import ThrottledClient, call_unless_sent
+
+# "file" or "dynamodb", overridable per event with "checkpoint_store". /tmp belongs to one container
+# and a continuation (self-invoked, or re-invoked by the orchestrator or the runner) may land on
+# another one, which then fails loudly on the unknown token; deployments with the CHECKPOINT_TABLE
+# table set "dynamodb" to resume anywhere.
+CHECKPOINT_STORE = os.environ.get('CHECKPOINT_STORE', 'file')
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', '/tmp/checkpoints')
+CHECKPOINT_TABLE = os.environ.get('CHECKPOINT_TABLE', 'UtilityLambdaCheckpoints')
+
+# Checkpoint items expire from the DynamoDB store after this long (the table's TTL attribute is expires_at)
+CHECKPOINT_TTL_SECONDS = int(os.environ.get('CHECKPOINT_TTL_SECONDS', str(7 * 24 * 3600)))
+
+# Completed users are saved at most this often; continue_later always saves
+CHECKPOINT_SAVE_INTERVAL_SECONDS = float(os.environ.get('CHECKPOINT_SAVE_INTERVAL_SECONDS', '10'))
+
+# Stop taking new work once less than this is left before the Lambda timeout
+CHECKPOINT_SAFETY_MARGIN_MS = int(os.environ.get('CHECKPOINT_SAFETY_MARGIN_MS', '30000'))
+
+# Re-invoke the function asynchronously with the continuation token instead of only returning it
+SELF_INVOKE = os.environ.get('CHECKPOINT_SELF_INVOKE', 'false').lower() == 'true'
+
+class FileCheckpointStore:
+    def __init__(self, directory=CHECKPOINT_DIR):
+        self.directory = directory
+
+    def path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def load(self, job_id):
+        try:
+            with open(self.path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, job_id, state):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{self.path(job_id)}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(temp_path, self.path(job_id))
+
+    def delete(self, job_id):
+        try:
+            os.remove(self.path(job_id))
+        except FileNotFoundError:
+            pass
+
+class DynamoDBCheckpointStore:
+    def __init__(self, table_name=CHECKPOINT_TABLE, dynamodb=None):
+        self.table_name = table_name
+        self.dynamodb = dynamodb or ThrottledClient(get_client('dynamodb'), 'dynamodb')
+
+    def load(self, job_id):
+        response = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={'job_id': {'S': job_id}},
+            ConsistentRead=True
+        )
+        if 'Item' not in response:
+            return None
+        state = response['Item']['state']
+        if 'B' in state:
+            return json.loads(zlib.decompress(state['B']))
+        return json.loads(state['S'])
+
+    def save(self, job_id, state):
+        now = int(time.time())
+        # Compressed, the user ids of a few tens of thousands of users fit the 400 KB item limit
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                'job_id': {'S': job_id},
+                'state': {'B': zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'))},
+                'updated_at': {'N': str(now)},
+                'expires_at': {'N': str(now + CHECKPOINT_TTL_SECONDS)}
+            }
+        )
+
+    def delete(self, job_id):
+        self.dynamodb.delete_item(TableName=self.table_name, Key={'job_id': {'S': job_id}})
+
+def get_checkpoint_store(event):
+    store_name = event.get('checkpoint_store', CHECKPOINT_STORE)
+    if store_name == 'dynamodb':
+        return DynamoDBCheckpointStore()
+    if store_name == 'file':
+        return FileCheckpointStore()
+    raise ValueError(f"Unknown checkpoint store: {store_name}")
+
+class CheckpointNotFoundError(LookupError):
+    pass
+
+class Checkpoint:
+    def __init__(self, store, job_id, state=None):
+        self.store = store
+        self.job_id = job_id
+        self.state = state or {}
+        self.state.setdefault('completed_user_ids', [])
+        self.state.setdefault('failed_user_ids', [])
+        self.state.setdefault('cursors', {})
+        # Checkpoints saved before results were dropped from the state
+        self.state.pop('results', None)
+        self.completed_user_ids = set(self.state['completed_user_ids'])
+        self.failed_user_ids = set(self.state['failed_user_ids'])
+        self.lock = threading.Lock()
+        self.saved_at = time.monotonic()
+        # Only a checkpoint that is in the store has anything to delete
+        self.persisted = state is not None
+
+    @classmethod
+    def resume(cls, event, store=None):
+        # A "continuation_token" in the event picks up the saved state of an earlier invocation.
+        # A token without a checkpoint fails the invocation rather than silently redoing the whole job.
+        store = store or get_checkpoint_store(event)
+        job_id = event.get('continuation_token')
+        state = store.load(job_id) if job_id else None
+        if job_id and state is None:
+            raise CheckpointNotFoundError(f"No checkpoint found for continuation token {job_id} in the "
+                                          f"{event.get('checkpoint_store', CHECKPOINT_STORE)} checkpoint store")
+        if state is not None:
+            print(f"Resuming job {job_id} from its saved checkpoint")
+        return cls(store, job_id or str(uuid.uuid4()), state)
+
+    def is_user_done(self, user_id):
+        return user_id in self.completed_user_ids
+
+    def is_user_failed(self, user_id):
+        return user_id in self.failed_user_ids
+
+    def mark_user_done(self, user_id, failed=False, save=True):
+        # With save, the checkpoint is saved when CHECKPOINT_SAVE_INTERVAL_SECONDS have passed
+        with self.lock:
+            if user_id not in self.completed_user_ids:
+                self.completed_user_ids.add(user_id)
+                self.state['completed_user_ids'].append(user_id)
+            if failed and user_id not in self.failed_user_ids:
+                self.failed_user_ids.add(user_id)
+                self.state['failed_user_ids'].append(user_id)
+        if save:
+            self.save_if_due()
+
+    def save_if_due(self):
+        # Periodic saves only protect against a hard timeout, a failed one is retried by the next
+        if time.monotonic() - self.saved_at < CHECKPOINT_SAVE_INTERVAL_SECONDS:
+            return
+        self.save()
+
+    def get_cursor(self, name, default=None):
+        return self.state['cursors'].get(name, default)
+
+    def set_cursor(self, name, value, save=False):
+        # LastEvaluatedKey / NextToken (or any JSON-serialisable progress marker) for a named stream.
+        # Cursors are saved with the rest of the state by continue_later, not on every page.
+        with self.lock:
+            self.state['cursors'][name] = value
+        if save:
+            self.save()
+
+    def save(self):
+        # Returns whether the state reached the store; a store failure never fails the work itself
+        with self.lock:
+            try:
+                self.store.save(self.job_id, self.state)
+            except Exception as e:
+                print(f"Could not save checkpoint {self.job_id}: {e}")
+                return False
+            self.saved_at = time.monotonic()
+            self.persisted = True
+            return True
+
+    def finish(self):
+        if not self.persisted:
+            return
+        try:
+            self.store.delete(self.job_id)
+            self.persisted = False
+        except Exception as e:
+            print(f"Could not delete checkpoint {self.job_id}, it expires on its own: {e}")
+
+def time_is_running_out(context, margin_ms=CHECKPOINT_SAFETY_MARGIN_MS):
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < margin_ms
+
+def continue_later(checkpoint, event, context, body=None):
+    # Save progress and hand the rest of the job to the next invocation. Without a saved checkpoint the
+    # token would only fail the next invocation, so the function is not re-invoked with it.
+    saved = checkpoint.save()
+    continuation_event = dict(event, continuation_token=checkpoint.job_id)
+    self_invoked = False
+    if saved and event.get('self_invoke', SELF_INVOKE) and context is not None:
+        call_unless_sent(
+            get_client('lambda').invoke,
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps(continuation_event).encode()
+        )
+        self_invoked = True
+    print(f"Stopping before the Lambda timeout, continuation token: {checkpoint.job_id}")
+    return {
+        'statusCode': 202,
+        'body': json.dumps({
+            'message': 'Stopped before the Lambda timeout, resume with the continuation token',
+            'continuation_token': checkpoint.job_id,
+            'self_invoked': self_invoked,
+            'checkpoint_saved': saved,
+            **(body or {})
+        })
+    }
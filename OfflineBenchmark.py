@@ -0,0 +1,230 @@
+## Offline benchmark for the utility lambdas.
+## Runs a module's lambda_handler against the in-process fakes from AwsFakes.py with a generated
+## dataset (users x faces, page size, photos shared between users) and reports API calls, wall time,
+## throughput and peak memory, so performance changes to any handler can be compared reproducibly.
+##
+##   python OfflineBenchmark.py --module DisassociateFacesAndDeleteUsers --users 200 --faces 300 --latency-ms 20
+##   python OfflineBenchmark.py --module all --throttle-rate 0.05 --workers 8
+
+import argparse
+import importlib
+import json
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from decimal import Decimal
+from io import BytesIO
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from AwsFakes import FakeRekognition, FakeDynamoDB, FakeS3
+import AwsClients
+import ThrottleControl
+from ThrottleControl import controller_stats
+from InvocationMetrics import metrics
+from FaceLookupCache import face_cache
+
+COLLECTION_ID = 'FlashbackUserDataCollection'
+INDEXED_DATA_TABLE = 'indexed_data'
+REKOGNITION_USERS_DATA_TABLE = 'RekognitionUsersData'
+PHOTO_BUCKET = 'flashbackusercollection'
+
+# Folder each handler reads its indexed_data items from
+SCENARIOS = {
+    'DisassociateFacesAndDeleteUsers': {},
+    'DisassociateFacesDeleteUsersDeleteFaces': {},
+    'DisassociateAndDeleteFacesAfterListingFromCollection': {},
+    'DisassociateFacesAndDeleteSpecificToDynamoDBAttribute': {'folder_name': 'Venky_Spandana_Reception_06022022'},
+    'DynamoDBBackFillingUserIdRecordstoNewUserId': {},
+    'BackfillingThumbnailsOnUserIdBasis': {'folder_name': 'Sithara_Thadem_Birthaday_09062024'}
+}
+
+DEFAULT_FOLDER_NAME = 'benchmark_folder'
+
+class FakeContext:
+    def __init__(self, timeout_seconds):
+        self.deadline = time.monotonic() + timeout_seconds
+        self.invoked_function_arn = 'arn:aws:lambda:us-east-1:000000000000:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+def make_photo(width, height):
+    from PIL import Image
+    buffer = BytesIO()
+    Image.effect_mandelbrot((width, height), (-2, -1.5, 1, 1.5), 64).convert('RGB').save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+def build_fakes(args, folder_name, with_photos):
+    rng = random.Random(args.seed)
+    service_options = {'latency_seconds': args.latency_ms / 1000.0, 'throttle_rate': args.throttle_rate, 'seed': args.seed}
+    rekognition = FakeRekognition(**service_options)
+    dynamodb = FakeDynamoDB(page_size=args.page_size, unprocessed_rate=args.unprocessed_rate, **service_options)
+    s3 = FakeS3(**service_options)
+    indexed_data = dynamodb.create_table(INDEXED_DATA_TABLE, 'face_id')
+    users_data = dynamodb.create_table(REKOGNITION_USERS_DATA_TABLE, 'user_id')
+
+    # Every photo shares the same bytes, only the keys differ, so the dataset itself stays small
+    photo_bytes = make_photo(args.image_width, args.image_height) if with_photos else b''
+    user_ids = [f"user-{user_index:06d}" for user_index in range(args.users)]
+    for user_index, user_id in enumerate(user_ids):
+        for face_index in range(args.faces):
+            face_id = f"{user_id}-face-{face_index:06d}"
+            rekognition.add_face(COLLECTION_ID, face_id, user_id)
+            # Neighbouring users appear in the same group photos
+            photo_key = f"photos/{(face_index * args.users + user_index) // args.faces_per_photo}.jpg"
+            if photo_bytes and (PHOTO_BUCKET, photo_key) not in s3.objects:
+                s3.add_object(PHOTO_BUCKET, photo_key, photo_bytes)
+            indexed_data.put({
+                'face_id': face_id,
+                'user_id': user_id,
+                'folder_name': folder_name,
+                's3_url': f"https://{PHOTO_BUCKET}.s3.amazonaws.com/{photo_key}",
+                'bounding_box': {
+                    'Left': Decimal(str(round(rng.uniform(0.05, 0.8), 4))),
+                    'Top': Decimal(str(round(rng.uniform(0.05, 0.7), 4))),
+                    'Width': Decimal('0.1'),
+                    'Height': Decimal('0.15')
+                },
+                'Confidence': Decimal(str(round(rng.uniform(95, 100), 3))),
+                'FaceOccluded_Value': rng.random() < 0.1,
+                'EyesOpen_Value': rng.random() < 0.9,
+                'EyesOpen_Confidence': Decimal(str(round(rng.uniform(90, 100), 3))),
+                'Pose': json.dumps({'Roll': rng.uniform(-25, 25), 'Yaw': rng.uniform(-20, 20), 'Pitch': rng.uniform(-20, 20)}),
+                'Quality': json.dumps({'Brightness': rng.uniform(30, 90), 'Sharpness': rng.uniform(10, 90)})
+            })
+    for user_id in user_ids[:int(len(user_ids) * args.already_done)]:
+        users_data.put({'user_id': user_id, 'face_url': 'https://example/thumbnail.jpg'})
+    return rekognition, dynamodb, s3, user_ids
+
+def build_event(module_name, args, user_ids):
+    if module_name == 'DynamoDBBackFillingUserIdRecordstoNewUserId':
+        if args.bulk:
+            return with_ledger({'user_id_mapping': {user_id: f"{user_id}-merged" for user_id in user_ids}, 'total_segments': args.segments}, args)
+        return with_ledger({'user_id': user_ids[0], 'new_user_id': f"{user_ids[0]}-merged"}, args)
+    # The handlers set their token buckets from the event, 0 disables them
+    event = {'user_ids': user_ids, 'rekognition_tps': args.rekognition_tps, 'dynamodb_tps': args.dynamodb_tps}
+    if module_name == 'DisassociateFacesAndDeleteSpecificToDynamoDBAttribute':
+        event['folder_name'] = SCENARIOS[module_name]['folder_name']
+    if args.purge_mode and module_name in ('DisassociateFacesAndDeleteUsers', 'DisassociateFacesDeleteUsersDeleteFaces'):
+        event['purge_mode'] = args.purge_mode
+    if args.workers > 1:
+        event['workers'] = args.workers
+    return with_ledger(event, args)
+
+def with_ledger(event, args):
+    # Runs sharing a --ledger-path see each other's completed work, like a retried event would
+    if args.ledger_path:
+        event['ledger_store'] = 'sqlite'
+        event['ledger_sqlite_path'] = args.ledger_path
+    return event
+
+def processed_counts(module_name, args, response):
+    # Users and face records the run actually went through: the remap without --bulk migrates only
+    # the first user, and both remap modes report the records they read
+    if module_name != 'DynamoDBBackFillingUserIdRecordstoNewUserId':
+        return args.users, args.users * args.faces
+    users = args.users if args.bulk else 1
+    try:
+        body = json.loads((response or {}).get('body') or '{}')
+    except ValueError:
+        body = {}
+    records = body.get('records_read', 0) if isinstance(body, dict) else 0
+    return users, records
+
+def install_fakes(rekognition, dynamodb, s3):
+    # The handlers' lazy clients resolve through AwsClients, so the fakes sit under the same wrappers
+    AwsClients.reset_clients()
+    AwsClients.register('client', 'rekognition', rekognition)
+    AwsClients.register('client', 'dynamodb', dynamodb.client())
+    AwsClients.register('resource', 'dynamodb', dynamodb.resource())
+    AwsClients.register('client', 's3', s3)
+
+def run_benchmark(module_name, args):
+    scenario = SCENARIOS[module_name]
+    folder_name = scenario.get('folder_name', DEFAULT_FOLDER_NAME)
+    rekognition, dynamodb, s3, user_ids = build_fakes(args, folder_name, module_name == 'BackfillingThumbnailsOnUserIdBasis')
+
+    module = importlib.import_module(module_name)
+    install_fakes(rekognition, dynamodb, s3)
+    ThrottleControl.controllers.clear()
+    # Every run starts as a cold container, face lists cached by an earlier run describe other fakes
+    face_cache.clear()
+    event = build_event(module_name, args, user_ids)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        started_at = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull if not args.verbose else sys.stdout):
+            response = module.lambda_handler(event, FakeContext(args.timeout_seconds))
+        wall_seconds = time.perf_counter() - started_at
+        python_peak_bytes = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+
+    calls = {}
+    throttled = 0
+    for fake in (rekognition, dynamodb, s3):
+        stats = fake.stats()
+        for operation, count in stats['calls'].items():
+            calls[f"{fake.name}.{operation}"] = count
+        throttled += sum(stats['throttled'].values())
+    users_processed, faces_processed = processed_counts(module_name, args, response)
+    return {
+        'module': module_name,
+        'users': args.users,
+        'faces_per_user': args.faces,
+        'users_processed': users_processed,
+        'faces_processed': faces_processed,
+        'status_code': (response or {}).get('statusCode'),
+        'wall_seconds': round(wall_seconds, 3),
+        'users_per_second': round(users_processed / wall_seconds, 2) if wall_seconds else None,
+        'faces_per_second': round(faces_processed / wall_seconds, 2) if wall_seconds else None,
+        'total_calls': sum(calls.values()),
+        'throttled_calls': throttled,
+        'calls': dict(sorted(calls.items())),
+        'controllers': controller_stats(),
+        'stages': {name: {key: latency[key] for key in ('count', 'sum_ms', 'p50_ms', 'p99_ms')}
+                   for name, latency in metrics.summary()['latencies'].items() if name.startswith('stage.')},
+        'python_peak_bytes': python_peak_bytes,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the utility lambdas against in-process AWS fakes')
+    parser.add_argument('--module', default='all', choices=['all'] + list(SCENARIOS))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--faces', type=int, default=100, help='faces per user')
+    parser.add_argument('--page-size', type=int, default=100, help='DynamoDB items per query/scan page')
+    parser.add_argument('--faces-per-photo', type=int, default=4)
+    parser.add_argument('--image-width', type=int, default=4000)
+    parser.add_argument('--image-height', type=int, default=3000)
+    parser.add_argument('--already-done', type=float, default=0.0, help='fraction of users already in RekognitionUsersData')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added latency per fake API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability a fake API call is throttled')
+    parser.add_argument('--unprocessed-rate', type=float, default=0.0, help='probability a batch item comes back unprocessed')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--purge-mode', choices=['disassociate', 'fast'], help='purge mode for the purge handlers')
+    parser.add_argument('--bulk', action='store_true', help='run the backfill in bulk remap mode')
+    parser.add_argument('--segments', type=int, default=8)
+    parser.add_argument('--ledger-path', help='SQLite completion ledger shared between runs')
+    parser.add_argument('--rekognition-tps', type=float, default=0.0, help='token bucket rate, 0 disables it')
+    parser.add_argument('--dynamodb-tps', type=float, default=0.0, help='token bucket rate, 0 disables it')
+    parser.add_argument('--timeout-seconds', type=float, default=900.0)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false',
+                        help='skip tracemalloc, which slows Python-heavy handlers down')
+    parser.add_argument('--verbose', action='store_true', help='show the handlers\' own logging')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    module_names = list(SCENARIOS) if arguments.module == 'all' else [arguments.module]
+    for name in module_names:
+        print(json.dumps(run_benchmark(name, arguments)))
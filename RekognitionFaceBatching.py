@@ -0,0 +1,208 @@
+## Shared batching for Rekognition face mutations.
+## Face ids are packed into chunks at the API maximum, the per-chunk response is parsed and only
+## the face ids Rekognition did not accept are retried (or reported back to the caller).
+
+import time
+from botocore.exceptions import ClientError
+from InvocationMetrics import metrics, debug
+from StreamingPipeline import run_pipeline, PIPELINE_CONSUMERS
+
+# DisassociateFaces accepts at most 100 FaceIds per call
+DISASSOCIATE_FACES_MAX_BATCH = 100
+
+# DeleteFaces accepts at most 4096 FaceIds per call
+DELETE_FACES_MAX_BATCH = 4096
+
+# ListFaces takes at most 4096 FaceIds as a filter and returns at most 4096 faces per page
+LIST_FACES_MAX_FACE_IDS = 4096
+
+# Reasons in UnsuccessfulFaceDisassociations that will not change on a retry
+PERMANENT_DISASSOCIATION_REASONS = {'FACE_NOT_FOUND', 'ASSOCIATED_TO_A_DIFFERENT_USER'}
+
+# Error codes for which the whole chunk is resubmitted. Throttling and server errors are retried by
+# ThrottleControl.ThrottledClient around the client itself.
+RETRYABLE_ERROR_CODES = {'ConflictException'}
+
+def chunk_face_ids(face_ids, chunk_size=DISASSOCIATE_FACES_MAX_BATCH):
+    # Yield de-duplicated face ids in lists of at most chunk_size, keeping the input order
+    seen = set()
+    chunk = []
+    for face_id in face_ids:
+        if face_id in seen:
+            continue
+        seen.add(face_id)
+        chunk.append(face_id)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def disassociate_face_chunk(rekognition, collection_id, user_id, chunk, max_attempts=3, backoff_seconds=0.5):
+    disassociated = []
+    unsuccessful = []
+    pending = chunk
+    attempt = 1
+
+    while pending:
+        try:
+            response = rekognition.disassociate_faces(
+                CollectionId=collection_id,
+                UserId=user_id,
+                FaceIds=pending
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in RETRYABLE_ERROR_CODES and attempt < max_attempts:
+                time.sleep(backoff_seconds * (2 ** (attempt - 1)))
+                attempt += 1
+                continue
+            raise
+
+        disassociated.extend(face['FaceId'] for face in response.get('DisassociatedFaces', []))
+
+        # Only the face ids that failed for a transient reason go back into the next attempt
+        retry_face_ids = []
+        for failure in response.get('UnsuccessfulFaceDisassociations', []):
+            reasons = set(failure.get('Reasons', []))
+            if reasons - PERMANENT_DISASSOCIATION_REASONS and attempt < max_attempts:
+                retry_face_ids.append(failure['FaceId'])
+            else:
+                unsuccessful.append({'FaceId': failure['FaceId'], 'Reasons': sorted(reasons)})
+
+        if retry_face_ids:
+            time.sleep(backoff_seconds * (2 ** (attempt - 1)))
+        pending = retry_face_ids
+        attempt += 1
+
+    return disassociated, unsuccessful
+
+def disassociate_faces_in_batches(rekognition, collection_id, user_id, face_ids,
+                                  chunk_size=DISASSOCIATE_FACES_MAX_BATCH, max_attempts=3, backoff_seconds=0.5):
+    all_disassociated = []
+    all_unsuccessful = []
+    batches = 0
+
+    for chunk in chunk_face_ids(face_ids, chunk_size):
+        disassociated, unsuccessful = disassociate_face_chunk(
+            rekognition, collection_id, user_id, chunk, max_attempts, backoff_seconds
+        )
+        batches += 1
+        all_disassociated.extend(disassociated)
+        all_unsuccessful.extend(unsuccessful)
+        debug(f"Disassociated {len(disassociated)} of {len(chunk)} faces from user {user_id}")
+
+    metrics.increment('faces.disassociated', len(all_disassociated))
+    metrics.increment('faces.disassociation_failed', len(all_unsuccessful))
+
+    if all_unsuccessful:
+        print(f"Failed to disassociate {len(all_unsuccessful)} faces from user {user_id}: {all_unsuccessful}")
+
+    return {
+        'DisassociatedFaces': all_disassociated,
+        'UnsuccessfulFaceDisassociations': all_unsuccessful,
+        'Batches': batches
+    }
+
+def disassociate_face_pages(rekognition, collection_id, user_id, face_id_pages, chunk_size=DISASSOCIATE_FACES_MAX_BATCH,
+                            consumers=PIPELINE_CONSUMERS, max_attempts=3, backoff_seconds=0.5, on_chunk_done=None):
+    # Streaming variant of disassociate_faces_in_batches: chunks are disassociated by consumer threads
+    # while later pages are still being read. Errors from a chunk are returned, paging errors raised.
+    # on_chunk_done, if given, is called from the consumer thread with each chunk's disassociated face ids.
+    def consume_chunk(chunk):
+        disassociated, unsuccessful = disassociate_face_chunk(rekognition, collection_id, user_id, chunk, max_attempts, backoff_seconds)
+        if on_chunk_done is not None and disassociated:
+            on_chunk_done(disassociated)
+        return disassociated, unsuccessful
+
+    pipeline = run_pipeline(
+        face_id_pages,
+        consume_chunk,
+        chunk_size,
+        consumers,
+        name='pipeline.disassociate'
+    )
+    all_disassociated = [face_id for disassociated, _ in pipeline['results'] for face_id in disassociated]
+    all_unsuccessful = [failure for _, unsuccessful in pipeline['results'] for failure in unsuccessful]
+    debug(f"Disassociated {len(all_disassociated)} of {pipeline['items']} faces from user {user_id} in {pipeline['batches']} batches")
+
+    metrics.increment('faces.disassociated', len(all_disassociated))
+    metrics.increment('faces.disassociation_failed', len(all_unsuccessful))
+    if all_unsuccessful:
+        print(f"Failed to disassociate {len(all_unsuccessful)} faces from user {user_id}: {all_unsuccessful}")
+
+    return {
+        'DisassociatedFaces': all_disassociated,
+        'UnsuccessfulFaceDisassociations': all_unsuccessful,
+        'Batches': pipeline['batches'],
+        'FacesFound': pipeline['items'],
+        'Errors': pipeline['errors']
+    }
+
+def delete_faces_in_batches(rekognition, collection_id, face_ids, chunk_size=DELETE_FACES_MAX_BATCH):
+    # Faces still associated to a user come back in UnsuccessfulFaceDeletions, disassociate them first
+    all_deleted = []
+    all_unsuccessful = []
+    batches = 0
+
+    for chunk in chunk_face_ids(face_ids, chunk_size):
+        response = rekognition.delete_faces(CollectionId=collection_id, FaceIds=chunk)
+        batches += 1
+        all_deleted.extend(response.get('DeletedFaces', []))
+        all_unsuccessful.extend(response.get('UnsuccessfulFaceDeletions', []))
+        debug(f"Deleted {len(response.get('DeletedFaces', []))} of {len(chunk)} faces from collection {collection_id}")
+
+    metrics.increment('faces.deleted', len(all_deleted))
+    metrics.increment('faces.deletion_failed', len(all_unsuccessful))
+    if all_unsuccessful:
+        # Per-reason counts, the face ids themselves are in the returned UnsuccessfulFaceDeletions
+        reasons = {}
+        for failure in all_unsuccessful:
+            for reason in failure.get('Reasons', []):
+                reasons[reason] = reasons.get(reason, 0) + 1
+        print(f"Failed to delete {len(all_unsuccessful)} faces from collection {collection_id}: {reasons}")
+
+    return {
+        'DeletedFaces': all_deleted,
+        'UnsuccessfulFaceDeletions': all_unsuccessful,
+        'Batches': batches
+    }
+
+def list_remaining_faces(rekognition, collection_id, face_ids):
+    # Which of the given face ids are still in the collection
+    remaining = []
+    for chunk in chunk_face_ids(face_ids, LIST_FACES_MAX_FACE_IDS):
+        params = {'CollectionId': collection_id, 'FaceIds': chunk, 'MaxResults': LIST_FACES_MAX_FACE_IDS}
+        while True:
+            response = rekognition.list_faces(**params)
+            remaining.extend(face['FaceId'] for face in response.get('Faces', []))
+            if response.get('NextToken'):
+                params['NextToken'] = response['NextToken']
+            else:
+                break
+    return remaining
+
+def fast_purge_user(rekognition, collection_id, user_id, face_ids):
+    # DeleteFaces refuses faces still associated to a user and DeleteUser drops all of the user's
+    # associations itself, so the minimal sequence is DeleteUser, DeleteFaces in 4096-face chunks
+    # and one ListFaces check, instead of a DisassociateFaces call per 100 faces.
+    user_deleted = True
+    try:
+        rekognition.delete_user(CollectionId=collection_id, UserId=user_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        user_deleted = False
+        debug(f"User {user_id} was already deleted from collection {collection_id}")
+
+    deleted = delete_faces_in_batches(rekognition, collection_id, face_ids)
+    remaining = list_remaining_faces(rekognition, collection_id, face_ids)
+    metrics.increment('faces.remaining_after_purge', len(remaining))
+    if remaining:
+        print(f"{len(remaining)} faces of user {user_id} are still in collection {collection_id} after the purge")
+
+    return {
+        'UserDeleted': user_deleted,
+        'DeletedFaces': deleted['DeletedFaces'],
+        'UnsuccessfulFaceDeletions': deleted['UnsuccessfulFaceDeletions'],
+        'RemainingFaces': remaining
+    }
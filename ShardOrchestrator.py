@@ -0,0 +1,399 @@
+## Shard-and-fan-out orchestrator for the user-list lambdas.
+## One invocation can only get through as many users as a single Lambda timeout allows. The
+## orchestrator estimates every user's face count, packs the users into shards of roughly equal
+## work, runs one worker invocation of the target handler per shard and merges their reports.
+## Workers are Lambda invocations of the deployed function ("lambda" backend) or, for local and
+## test runs, a process pool on this machine ("process" backend). A shard that stops before its
+## timeout is resumed with its continuation token until it finishes.
+## The orchestrator keeps an eye on its own timeout too: once the longest shard round so far would no
+## longer fit, it starts no new shards or rounds and returns 202 with the shards still to run under
+## "remaining_shards", which a later event resumes by passing them back as "shards". A round that is
+## already running cannot be cut short, so inside Lambda the orchestrator needs a longer timeout than
+## its target.
+##
+## Run a sharded job locally with:
+##   python ShardOrchestrator.py event.json
+
+import functools
+import heapq
+import importlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from UserWorkerPool import RateLimitedClient, dynamodb_limiter, REKOGNITION_TPS, DYNAMODB_TPS
+from ThrottleControl import ThrottledClient, call_unless_sent
+from InvocationMetrics import metrics, debug, instrumented_handler
+from AwsClients import CLIENT_CONFIG, get_session, lazy_client
+from LambdaCheckpointing import CHECKPOINT_SAFETY_MARGIN_MS, time_is_running_out
+
+# Initialize the clients, created on first use from the shared session in AwsClients
+dynamodb = ThrottledClient(RateLimitedClient(lazy_client('dynamodb'), dynamodb_limiter), 'dynamodb')
+
+# Handlers that take a "user_ids" list and can be sharded
+SHARDABLE_HANDLERS = (
+    'DisassociateFacesAndDeleteUsers',
+    'DisassociateFacesDeleteUsersDeleteFaces',
+    'DisassociateAndDeleteFacesAfterListingFromCollection',
+    'DisassociateFacesAndDeleteSpecificToDynamoDBAttribute',
+    'BackfillingThumbnailsOnUserIdBasis'
+)
+
+# "lambda" or "process", overridable per event with "backend"
+SHARD_BACKEND = os.environ.get('SHARD_BACKEND', 'lambda')
+SHARD_BACKENDS = ('lambda', 'process')
+
+# A shard gets at most this many estimated faces and users, unless the event sets "shard_count"
+SHARD_MAX_FACES = int(os.environ.get('SHARD_MAX_FACES', '20000'))
+SHARD_MAX_USERS = int(os.environ.get('SHARD_MAX_USERS', '500'))
+SHARD_MAX_SHARDS = int(os.environ.get('SHARD_MAX_SHARDS', '100'))
+
+# Shards running at once, overridable per event with "max_concurrency". The account TPS quotas are
+# split evenly between them.
+SHARD_CONCURRENCY = int(os.environ.get('SHARD_CONCURRENCY', '8'))
+
+# Continuation rounds per shard before its remaining users are reported as pending
+SHARD_MAX_ROUNDS = int(os.environ.get('SHARD_MAX_ROUNDS', '20'))
+
+# Deadline given to a shard run by the process backend
+LOCAL_TIMEOUT_SECONDS = float(os.environ.get('SHARD_LOCAL_TIMEOUT_SECONDS', '900'))
+
+# Parallel COUNT queries while estimating face counts
+ESTIMATE_WORKERS = 16
+
+# Synchronous invokes wait for a whole shard, far longer than the shared clients' read timeout
+INVOKE_READ_TIMEOUT_SECONDS = 910
+
+# Event keys that configure the orchestrator itself and are not passed on to the shards
+ORCHESTRATOR_KEYS = {'target', 'target_function', 'backend', 'shard_count', 'max_concurrency',
+                     'face_counts', 'estimate_face_counts', 'shards'}
+
+lambda_client = None
+
+class LocalContext:
+    # Just enough of the Lambda context for time_is_running_out
+    def __init__(self, timeout_seconds):
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+class ShardDeadline:
+    # Stops new shards and rounds once the longest round so far would not finish before the timeout
+    def __init__(self, context, margin_ms=CHECKPOINT_SAFETY_MARGIN_MS):
+        self.context = context
+        self.margin_ms = margin_ms
+        self.longest_round_ms = 0
+        self.lock = threading.Lock()
+
+    def record_round(self, seconds):
+        with self.lock:
+            self.longest_round_ms = max(self.longest_round_ms, int(seconds * 1000))
+
+    def is_running_out(self):
+        with self.lock:
+            margin_ms = self.margin_ms + self.longest_round_ms
+        return time_is_running_out(self.context, margin_ms)
+
+def count_user_faces(user_id, folder_name=None):
+    query_params = {
+        'TableName': 'indexed_data',
+        'Select': 'COUNT'
+    }
+    if folder_name:
+        query_params['IndexName'] = 'folder_name-user_id-index'
+        query_params['KeyConditionExpression'] = 'folder_name = :folder_name AND user_id = :uid'
+        query_params['ExpressionAttributeValues'] = {':folder_name': {'S': folder_name}, ':uid': {'S': user_id}}
+    else:
+        query_params['IndexName'] = 'user_id-index'
+        query_params['KeyConditionExpression'] = 'user_id = :uid'
+        query_params['ExpressionAttributeValues'] = {':uid': {'S': user_id}}
+
+    count = 0
+    while True:
+        response = dynamodb.query(**query_params)
+        count += response['Count']
+        if 'LastEvaluatedKey' in response:
+            query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        else:
+            return count
+
+def estimate_face_counts(user_ids, folder_name=None, workers=ESTIMATE_WORKERS):
+    def estimate(user_id):
+        try:
+            return count_user_faces(user_id, folder_name)
+        except ClientError as e:
+            print(f"Could not count the faces of user {user_id}, estimating 0: {e}")
+            return 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(user_ids, executor.map(estimate, user_ids)))
+
+def get_user_weights(event, user_ids):
+    # Estimated faces plus one for the per-user calls (query, DeleteUser, ...)
+    face_counts = dict(event.get('face_counts', {}))
+    missing = [user_id for user_id in user_ids if user_id not in face_counts]
+    if missing and event.get('estimate_face_counts', True):
+        face_counts.update(estimate_face_counts(missing, event.get('folder_name')))
+    return {user_id: int(face_counts.get(user_id, 0)) + 1 for user_id in user_ids}
+
+def plan_shard_count(user_count, total_weight, requested=None):
+    if requested:
+        return max(1, min(int(requested), user_count))
+    shard_count = max(1, math.ceil(total_weight / SHARD_MAX_FACES), math.ceil(user_count / SHARD_MAX_USERS))
+    return min(shard_count, SHARD_MAX_SHARDS, user_count)
+
+def balance_shards(user_ids, weights, shard_count):
+    # Longest-processing-time first: the heaviest remaining user goes to the lightest shard
+    heap = [(0, index) for index in range(shard_count)]
+    shards = [[] for _ in range(shard_count)]
+    for user_id in sorted(user_ids, key=lambda user_id: weights[user_id], reverse=True):
+        load, index = heapq.heappop(heap)
+        shards[index].append(user_id)
+        heapq.heappush(heap, (load + weights[user_id], index))
+    # Users keep their event order inside a shard
+    order = {user_id: position for position, user_id in enumerate(user_ids)}
+    return [sorted(shard, key=order.get) for shard in shards if shard]
+
+def build_shard_event(event, user_ids, concurrency, continuation_token=None):
+    shard_event = {key: value for key, value in event.items() if key not in ORCHESTRATOR_KEYS}
+    shard_event['user_ids'] = user_ids
+    if continuation_token:
+        shard_event['continuation_token'] = continuation_token
+    # The orchestrator follows the continuation tokens itself
+    shard_event['self_invoke'] = False
+    shard_event['rekognition_tps'] = float(event.get('rekognition_tps', REKOGNITION_TPS)) / concurrency
+    shard_event['dynamodb_tps'] = float(event.get('dynamodb_tps', DYNAMODB_TPS)) / concurrency
+    return shard_event
+
+def get_invoke_client():
+    global lambda_client
+    if lambda_client is None:
+        lambda_client = get_session().client('lambda', config=CLIENT_CONFIG.merge(Config(read_timeout=INVOKE_READ_TIMEOUT_SECONDS)))
+    return lambda_client
+
+def invoke_lambda(function_name, event):
+    # Concurrency-limit throttles (TooManyRequestsException) are retried with backoff instead of
+    # failing the whole shard; a shard whose response was lost is not invoked again
+    response = call_unless_sent(
+        get_invoke_client().invoke,
+        FunctionName=function_name,
+        InvocationType='RequestResponse',
+        Payload=json.dumps(event).encode()
+    )
+    payload = json.loads(response['Payload'].read() or b'null')
+    if response.get('FunctionError'):
+        raise RuntimeError(f"{function_name} failed: {payload}")
+    return payload
+
+def invoke_locally(target, timeout_seconds, event):
+    # Runs in a pool process; the handler module is imported there on first use
+    return importlib.import_module(target).lambda_handler(event, LocalContext(timeout_seconds))
+
+def parse_body(body):
+    try:
+        return json.loads(body) if isinstance(body, str) else body
+    except json.JSONDecodeError:
+        return body
+
+def run_shard(invoke, event, max_rounds=SHARD_MAX_ROUNDS, deadline=None):
+    # Follows the shard's continuation tokens until it finishes, runs out of rounds or the deadline
+    # leaves no room for another round
+    started_at = time.perf_counter()
+    rounds = 0
+    while True:
+        round_started_at = time.perf_counter()
+        response = invoke(event) or {}
+        rounds += 1
+        if deadline is not None:
+            deadline.record_round(time.perf_counter() - round_started_at)
+        body = parse_body(response.get('body'))
+        if response.get('statusCode') != 202 or rounds >= max_rounds or not isinstance(body, dict):
+            break
+        if deadline is not None and deadline.is_running_out():
+            break
+        event = dict(event, continuation_token=body['continuation_token'])
+    return {
+        'status_code': response.get('statusCode'),
+        'body': body,
+        'rounds': rounds,
+        'seconds': round(time.perf_counter() - started_at, 3)
+    }
+
+def fan_out(target, function_name, backend, shard_events, concurrency, deadline, timeout_seconds=LOCAL_TIMEOUT_SECONDS):
+    # Threads here drive the shards' rounds and watch the deadline; with the process backend each
+    # round runs in the process pool
+    process_pool = None
+    if backend == 'process':
+        process_pool = ProcessPoolExecutor(max_workers=concurrency)
+        invoke_locally_once = functools.partial(invoke_locally, target, timeout_seconds)
+        invoke = lambda shard_event: process_pool.submit(invoke_locally_once, shard_event).result()
+    else:
+        get_invoke_client()
+        invoke = functools.partial(invoke_lambda, function_name)
+
+    # Shards are started as slots free up, so the ones the deadline leaves out are never started
+    outcomes = [{'status_code': None, 'body': None, 'not_started': True} for _ in shard_events]
+    next_index = 0
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {}
+            while futures or next_index < len(shard_events):
+                while len(futures) < concurrency and next_index < len(shard_events) and not deadline.is_running_out():
+                    futures[executor.submit(run_shard, invoke, shard_events[next_index], SHARD_MAX_ROUNDS, deadline)] = next_index
+                    next_index += 1
+                if not futures:
+                    break
+                future = next(as_completed(futures))
+                index = futures.pop(future)
+                try:
+                    outcomes[index] = future.result()
+                except Exception as e:
+                    print(f"Shard {index} of {target} failed: {e}")
+                    outcomes[index] = {'status_code': None, 'body': None, 'error': str(e)}
+                debug(f"Shard {index} finished: {outcomes[index].get('status_code')}")
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+    metrics.increment('shards.started', next_index)
+    if next_index < len(shard_events):
+        print(f"Stopping before the Lambda timeout, {len(shard_events) - next_index} shards not started")
+    return outcomes
+
+def merge_reports(shards, weights, outcomes):
+    # Per-user results are left out, a report for tens of thousands of users would not fit the response
+    merged = {'succeeded': [], 'failed': [], 'pending': [], 'skipped': []}
+    summaries = []
+    for index, (user_ids, outcome) in enumerate(zip(shards, outcomes)):
+        body = outcome.get('body')
+        if outcome.get('error') or (outcome.get('status_code') or 0) >= 500:
+            merged['failed'].extend(user_ids)
+        elif outcome.get('not_started') or outcome.get('status_code') == 202:
+            merged['pending'].extend(user_ids)
+        elif isinstance(body, dict) and any(key in body for key in merged):
+            for key in merged:
+                merged[key].extend(body.get(key, []))
+        else:
+            # No per-user report (e.g. a handler that returned None): its users cannot be accounted for
+            merged['failed'].extend(user_ids)
+        summaries.append({
+            'shard': index,
+            'users': len(user_ids),
+            'estimated_weight': sum(weights[user_id] for user_id in user_ids),
+            'status_code': outcome.get('status_code'),
+            'rounds': outcome.get('rounds'),
+            'seconds': outcome.get('seconds'),
+            **({'error': outcome['error']} if outcome.get('error') else {}),
+            **({'not_started': True} if outcome.get('not_started') else {}),
+            **({'continuation_token': body['continuation_token']}
+               if outcome.get('status_code') == 202 and isinstance(body, dict) else {})
+        })
+    metrics.increment('shards.failed', sum(1 for summary in summaries if 'error' in summary))
+    return merged, summaries
+
+def remaining_shards(shards, outcomes):
+    # Shards never started, and stopped ones with their continuation token, to pass back as "shards"
+    remaining = []
+    for user_ids, outcome in zip(shards, outcomes):
+        if outcome.get('not_started'):
+            remaining.append({'user_ids': user_ids})
+        elif outcome.get('status_code') == 202 and isinstance(outcome.get('body'), dict):
+            remaining.append({'user_ids': user_ids, 'continuation_token': outcome['body']['continuation_token']})
+    return remaining
+
+@instrumented_handler('ShardOrchestrator')
+def lambda_handler(event, context):
+    target = event.get('target')
+    if target not in SHARDABLE_HANDLERS:
+        return {
+            'statusCode': 400,
+            'body': f"Unknown target {target}, expected one of {', '.join(SHARDABLE_HANDLERS)}"
+        }
+    backend = event.get('backend', SHARD_BACKEND)
+    if backend not in SHARD_BACKENDS:
+        return {
+            'statusCode': 400,
+            'body': f"Unknown backend {backend}, expected one of {', '.join(SHARD_BACKENDS)}"
+        }
+    # Shards passed back from an earlier run's "remaining_shards" are run as they are
+    planned_shards = event.get('shards')
+    if planned_shards:
+        user_ids = [user_id for shard in planned_shards for user_id in shard['user_ids']]
+    else:
+        user_ids = list(dict.fromkeys(event.get('user_ids', [])))
+    if not user_ids:
+        print("No user_ids provided")
+        return {
+            'statusCode': 400,
+            'body': 'No user_ids provided'
+        }
+
+    if planned_shards:
+        weights = get_user_weights(dict(event, estimate_face_counts=False), user_ids)
+        shards = [shard['user_ids'] for shard in planned_shards]
+        continuation_tokens = [shard.get('continuation_token') for shard in planned_shards]
+    else:
+        with metrics.stage('estimate'):
+            weights = get_user_weights(event, user_ids)
+        shard_count = plan_shard_count(len(user_ids), sum(weights.values()), event.get('shard_count'))
+        shards = balance_shards(user_ids, weights, shard_count)
+        continuation_tokens = [None] * len(shards)
+    concurrency = max(1, min(int(event.get('max_concurrency', SHARD_CONCURRENCY)), len(shards)))
+    print(f"Running {target} over {len(user_ids)} users in {len(shards)} shards, {concurrency} at a time on the {backend} backend")
+
+    shard_events = [build_shard_event(event, shard, concurrency, continuation_token)
+                    for shard, continuation_token in zip(shards, continuation_tokens)]
+    with metrics.stage('fan_out'):
+        outcomes = fan_out(target, event.get('target_function', target), backend, shard_events, concurrency,
+                           ShardDeadline(context))
+    merged, summaries = merge_reports(shards, weights, outcomes)
+    remaining = remaining_shards(shards, outcomes)
+
+    if any('error' in summary for summary in summaries):
+        status_code = 500
+    elif merged['pending']:
+        status_code = 202
+    else:
+        status_code = 200
+    return {
+        'statusCode': status_code,
+        'body': json.dumps({'target': target, 'backend': backend, **merged, 'shards': summaries,
+                            **({'remaining_shards': remaining} if remaining else {})})
+    }
+
+if __name__ == '__main__':
+    # Local runs default to the process backend
+    with open(sys.argv[1]) as f:
+        local_event = dict({'backend': 'process'}, **json.load(f))
+    print(json.dumps(lambda_handler(local_event, LocalContext(LOCAL_TIMEOUT_SECONDS)), indent=2))
+
+
+## Manual payload ("face_counts" is optional, missing users are counted in indexed_data)
+
+# {
+#   "target": "DisassociateFacesAndDeleteUsers",
+#   "target_function": "DisassociateFacesAndDeleteUsers",
+#   "user_ids": [
+#     "98baf10c-d825-4e",
+#     "76b3d824-2dc7-41"
+#   ],
+#   "max_concurrency": 8,
+#   "purge_mode": "fast"
+# }
+
+## Resuming payload (the same event with "shards" set to the "remaining_shards" of a 202 response)
+
+# {
+#   "target": "DisassociateFacesAndDeleteUsers",
+#   "shards": [
+#     {"user_ids": ["98baf10c-d825-4e"], "continuation_token": "3f1c9a2e0b7d4c5e8a6f1b2c3d4e5f60"},
+#     {"user_ids": ["76b3d824-2dc7-41"]}
+#   ],
+#   "max_concurrency": 8,
+#   "purge_mode": "fast"
+# }
@@ -0,0 +1,104 @@
+## Bounded producer/consumer pipeline for the purge lambdas.
+## The calling thread pages through DynamoDB and packs the ids into fixed-size batches, consumer
+## threads run the batched Rekognition mutations. A bounded queue sits between them, so mutations
+## start with the first page instead of after the last one, and a full queue blocks the pager
+## when the consumers fall behind: at most queue_batches + consumers batches and one page are held.
+
+import os
+import queue
+import threading
+import time
+from InvocationMetrics import metrics
+
+# Consumer threads per pipeline, and batches allowed to wait between the pager and the consumers
+PIPELINE_CONSUMERS = int(os.environ.get('PIPELINE_CONSUMERS', '2'))
+PIPELINE_QUEUE_BATCHES = int(os.environ.get('PIPELINE_QUEUE_BATCHES', '4'))
+
+STOP = object()
+
+def batch_pages(pages, batch_size):
+    # Re-chunk pages of ids into batches of batch_size, dropping ids already seen
+    seen = set()
+    batch = []
+    for page in pages:
+        for item in page:
+            if item in seen:
+                continue
+            seen.add(item)
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def run_pipeline(pages, consume_batch, batch_size, consumers=PIPELINE_CONSUMERS,
+                 queue_batches=PIPELINE_QUEUE_BATCHES, name='pipeline'):
+    # Returns the consume_batch results in completion order together with the consumer errors.
+    # An error while paging is raised once the consumers have finished the batches already queued.
+    batches = queue.Queue(maxsize=max(1, queue_batches))
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = []
+    errors = []
+    first_batch_started = []
+    items = 0
+    batch_count = 0
+    started_at = time.perf_counter()
+
+    def consume():
+        while True:
+            batch = batches.get()
+            if batch is STOP:
+                return
+            # After a failure the remaining batches are only drained, so the pager never blocks forever
+            if stop.is_set():
+                continue
+            with lock:
+                if not first_batch_started:
+                    first_batch_started.append(True)
+                    metrics.record_latency(f"{name}.time_to_first_mutation", time.perf_counter() - started_at)
+            try:
+                result = consume_batch(batch)
+                with lock:
+                    results.append(result)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                stop.set()
+
+    threads = [threading.Thread(target=consume, daemon=True) for _ in range(max(1, consumers))]
+    for thread in threads:
+        thread.start()
+
+    paging_error = None
+    try:
+        for batch in batch_pages(pages, batch_size):
+            items += len(batch)
+            batch_count += 1
+            # Backpressure: wait for room in the queue, but give up once a consumer has failed
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                break
+    except Exception as e:
+        paging_error = e
+    finally:
+        for _ in threads:
+            batches.put(STOP)
+        for thread in threads:
+            thread.join()
+        metrics.record_latency(f"{name}.duration", time.perf_counter() - started_at)
+
+    if paging_error is not None:
+        raise paging_error
+    return {
+        'results': results,
+        'errors': errors,
+        'items': items,
+        'batches': batch_count
+    }
@@ -0,0 +1,188 @@
+## Throttle-aware call wrapper for Rekognition, DynamoDB and S3.
+## Throttling errors (ThrottlingException, ProvisionedThroughputExceededException, ...) are classified
+## and retried with decorrelated-jitter backoff instead of being printed and skipped. Every API
+## operation also gets an AIMD controller: in-flight calls grow by one per window of successful
+## calls and halve on a throttle, so concurrent workers settle just under the quota ceiling.
+## Transient server errors and dropped or timed-out connections are retried the same way, since
+## botocore's own retries are turned off for these clients.
+
+import os
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+from InvocationMetrics import metrics
+
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'Throttling',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'LimitExceededException',
+    'SlowDown'
+}
+
+# Server-side errors that are worth retrying but say nothing about the quota
+TRANSIENT_ERROR_CODES = {
+    'InternalError',
+    'InternalServerError',
+    'InternalServerErrorException',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout'
+}
+
+# Connection failures and read timeouts (EndpointConnectionError, ConnectTimeoutError,
+# ReadTimeoutError, ConnectionClosedError, ...) never reach the service's quota either
+TRANSIENT_EXCEPTIONS = (BotocoreConnectionError, HTTPClientError)
+
+# Failures that happen before the request reaches the service; an HTTPClientError such as a read
+# timeout may come after it has run
+UNSENT_EXCEPTIONS = (BotocoreConnectionError,)
+
+MAX_ATTEMPTS = int(os.environ.get('THROTTLE_MAX_ATTEMPTS', '8'))
+BACKOFF_BASE_SECONDS = float(os.environ.get('THROTTLE_BACKOFF_BASE_SECONDS', '0.1'))
+BACKOFF_CAP_SECONDS = float(os.environ.get('THROTTLE_BACKOFF_CAP_SECONDS', '10'))
+
+AIMD_INITIAL_CONCURRENCY = float(os.environ.get('AIMD_INITIAL_CONCURRENCY', '4'))
+AIMD_MAX_CONCURRENCY = float(os.environ.get('AIMD_MAX_CONCURRENCY', '64'))
+
+# botocore's own retries would hide throttles from the controller, so the wrapper does all retrying
+NO_RETRY_CONFIG = Config(retries={'mode': 'standard', 'total_max_attempts': 1})
+
+def error_code(error):
+    return error.response.get('Error', {}).get('Code', '') if isinstance(error, ClientError) else ''
+
+def is_throttling_error(error):
+    return error_code(error) in THROTTLING_ERROR_CODES
+
+def is_retryable_error(error):
+    if isinstance(error, TRANSIENT_EXCEPTIONS):
+        return True
+    return error_code(error) in THROTTLING_ERROR_CODES or error_code(error) in TRANSIENT_ERROR_CODES
+
+def decorrelated_jitter(previous_delay, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_CAP_SECONDS):
+    return min(cap, random.uniform(base, previous_delay * 3))
+
+class AIMDController:
+    def __init__(self, name, initial_limit=AIMD_INITIAL_CONCURRENCY, min_limit=1.0, max_limit=AIMD_MAX_CONCURRENCY,
+                 decrease_factor=0.5, decrease_cooldown_seconds=1.0):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self.last_decrease_at = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome):
+        # outcome is 'success', 'throttled' or 'error'; errors leave the limit alone
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == 'throttled':
+                self.throttles += 1
+                # One burst of throttles from calls already in flight only counts as one decrease
+                now = time.monotonic()
+                if now - self.last_decrease_at >= self.decrease_cooldown_seconds:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease_at = now
+                    print(f"Throttled on {self.name}, concurrency limit lowered to {int(self.limit)}")
+            elif outcome == 'success':
+                self.successes += 1
+                # +1 per window of "limit" successful calls
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'successes': self.successes,
+            'throttles': self.throttles
+        }
+
+controllers = {}
+controllers_lock = threading.Lock()
+
+def get_controller(service_name, operation_name):
+    key = f"{service_name}.{operation_name}"
+    with controllers_lock:
+        if key not in controllers:
+            controllers[key] = AIMDController(key)
+        return controllers[key]
+
+def controller_stats():
+    with controllers_lock:
+        return {key: controller.stats() for key, controller in controllers.items()}
+
+def call_with_backoff(controller, function, *args, **kwargs):
+    delay = BACKOFF_BASE_SECONDS
+    attempt = 1
+    while True:
+        controller.acquire()
+        outcome = 'error'
+        started_at = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+            outcome = 'success'
+            return result
+        except (ClientError,) + TRANSIENT_EXCEPTIONS as e:
+            if is_throttling_error(e):
+                outcome = 'throttled'
+            if not is_retryable_error(e) or attempt >= MAX_ATTEMPTS:
+                raise
+        finally:
+            controller.release(outcome)
+            # Per attempt, so retried calls show up as extra throttled/error attempts
+            metrics.record_latency(f"api.{controller.name}", time.perf_counter() - started_at)
+            metrics.increment(f"api.{controller.name}.{outcome}")
+        delay = decorrelated_jitter(delay)
+        time.sleep(delay)
+        attempt += 1
+
+def call_unless_sent(function, *args, **kwargs):
+    # For calls that must not run twice (Lambda invokes): throttles, server errors and connection
+    # failures before the request was sent are retried with backoff, a lost response is not
+    delay = BACKOFF_BASE_SECONDS
+    attempt = 1
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except (ClientError,) + UNSENT_EXCEPTIONS as e:
+            if (isinstance(e, ClientError) and not is_retryable_error(e)) or attempt >= MAX_ATTEMPTS:
+                raise
+            metrics.increment('api.unsent.retried')
+        delay = decorrelated_jitter(delay)
+        time.sleep(delay)
+        attempt += 1
+
+class ThrottledClient:
+    # Wraps a boto3 client, resource or Table; operations limits which methods count as API calls
+    def __init__(self, target, service_name, operations=None):
+        self._target = target
+        self._service_name = service_name
+        self._operations = operations
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute) or name in ('get_paginator', 'can_paginate', 'get_waiter', 'close'):
+            return attribute
+        if self._operations is not None and name not in self._operations:
+            return attribute
+
+        controller = get_controller(self._service_name, name)
+
+        def call(*args, **kwargs):
+            return call_with_backoff(controller, attribute, *args, **kwargs)
+        return call
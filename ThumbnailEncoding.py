@@ -0,0 +1,145 @@
+## Byte-budgeted, multi-resolution thumbnail encoding for the thumbnail backfill.
+## Each face crop is encoded once per variant (64, 256 and 1024 px on the longest side by default),
+## largest first, every variant resized from the one before it. Size and quality are picked up front
+## from a bytes-per-pixel estimate so each variant lands inside its byte budget on the first encode;
+## the estimate is corrected with the measured size of every variant encoded so far, and only a
+## variant that still overshoots is encoded again, at the same quality and proportionally fewer pixels.
+##
+## Try the budgets on a local crop with:
+##   python ThumbnailEncoding.py face.jpg
+
+import json
+import math
+import os
+import sys
+import time
+from io import BytesIO
+
+# Longest side of every variant -> its byte budget. Overridable as JSON through THUMBNAIL_VARIANTS
+# or "thumbnail_variants" in the event, e.g. {"64": 6144, "256": 49152, "1024": 307200}
+DEFAULT_VARIANTS = {64: 6 * 1024, 256: 48 * 1024, 1024: 300 * 1024}
+
+# "JPEG" or "WEBP", overridable per event with "thumbnail_format"
+THUMBNAIL_FORMAT = os.environ.get('THUMBNAIL_FORMAT', 'JPEG').upper()
+THUMBNAIL_FORMATS = {'JPEG': ('jpg', 'image/jpeg'), 'WEBP': ('webp', 'image/webp')}
+
+# Progressive JPEG only pays off above this size, a 64 px progressive file is larger than a baseline one
+def parse_flag(value):
+    # Environment variables and string event values (runner --event, CSV-driven config) say "true"/"false"
+    return str(value).lower() == 'true'
+
+THUMBNAIL_PROGRESSIVE = parse_flag(os.environ.get('THUMBNAIL_PROGRESSIVE', 'true'))
+PROGRESSIVE_MIN_SIZE = 256
+
+# Qualities tried from the top, and the compressed bytes per pixel they are expected to need.
+# The estimates are for 4:2:0 JPEG face crops; WebP needs about 0.7 of that.
+QUALITY_BYTES_PER_PIXEL = ((90, 0.40), (85, 0.30), (75, 0.21), (65, 0.16), (50, 0.12), (40, 0.10))
+FORMAT_BYTES_FACTOR = {'JPEG': 1.0, 'WEBP': 0.7}
+
+# Encodes per variant at most; a crop that is still over budget after them is stored as it is
+MAX_ENCODES = 3
+
+# Re-encodes aim this far below the budget, since the size does not shrink exactly with the area
+SHRINK_HEADROOM = 0.95
+
+def load_encoding_options(event=None):
+    # Defaults, then THUMBNAIL_VARIANTS / THUMBNAIL_FORMAT from the environment, then the event
+    variants = dict(DEFAULT_VARIANTS)
+    variants.update({int(size): int(budget) for size, budget in json.loads(os.environ.get('THUMBNAIL_VARIANTS', '{}')).items()})
+    image_format = THUMBNAIL_FORMAT
+    progressive = THUMBNAIL_PROGRESSIVE
+    if event:
+        if 'thumbnail_variants' in event:
+            variants = {int(size): int(budget) for size, budget in event['thumbnail_variants'].items()}
+        image_format = event.get('thumbnail_format', image_format).upper()
+        progressive = parse_flag(event.get('thumbnail_progressive', progressive))
+    if image_format not in THUMBNAIL_FORMATS:
+        raise ValueError(f"Unknown thumbnail format {image_format}, expected one of {', '.join(THUMBNAIL_FORMATS)}")
+    if image_format == 'WEBP':
+        from PIL import features
+        if not features.check('webp'):
+            print("Pillow was built without WebP support, encoding thumbnails as JPEG")
+            image_format = 'JPEG'
+    return {'variants': dict(sorted(variants.items(), reverse=True)), 'format': image_format, 'progressive': progressive}
+
+def fit_size(width, height, longest_side):
+    # Never upscales: a crop smaller than the variant is encoded at its own size
+    scale = min(1.0, longest_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def plan_variant(width, height, budget, image_format, correction=1.0):
+    # Highest quality whose estimated size fits the budget; below the lowest one, shrink instead
+    pixels = width * height
+    factor = FORMAT_BYTES_FACTOR[image_format] * correction
+    for quality, bytes_per_pixel in QUALITY_BYTES_PER_PIXEL:
+        if pixels * bytes_per_pixel * factor <= budget:
+            return width, height, quality
+    quality, bytes_per_pixel = QUALITY_BYTES_PER_PIXEL[-1]
+    scale = math.sqrt(budget / (pixels * bytes_per_pixel * factor))
+    return max(1, int(width * scale)), max(1, int(height * scale)), quality
+
+def encode(img, image_format, quality, progressive):
+    buffer = BytesIO()
+    options = {'quality': quality}
+    if image_format == 'JPEG' and progressive and max(img.size) >= PROGRESSIVE_MIN_SIZE:
+        options['progressive'] = True
+    if image_format == 'WEBP':
+        options['method'] = 4
+    img.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+def encode_variants(crop, options):
+    # Returns one entry per configured size, largest first, each with its encoded body
+    from PIL import Image
+    if crop.mode not in ('RGB', 'L'):
+        crop = crop.convert('RGB')
+    image_format = options['format']
+    extension, content_type = THUMBNAIL_FORMATS[image_format]
+    correction = 1.0
+    source = crop
+    variants = []
+
+    for size, budget in options['variants'].items():
+        width, height, quality = plan_variant(*fit_size(*source.size, size), budget, image_format, correction)
+        if (width, height) != source.size:
+            source = source.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+        body = encode(source, image_format, quality, options['progressive'])
+        encodes = 1
+
+        # Measured against estimated size, carried on to the smaller variants of the same crop
+        estimated_bytes = width * height * dict(QUALITY_BYTES_PER_PIXEL)[quality] * FORMAT_BYTES_FACTOR[image_format]
+        correction = len(body) / estimated_bytes
+
+        # Compressed size follows the pixel count far more closely than the quality setting
+        while len(body) > budget and encodes < MAX_ENCODES:
+            scale = math.sqrt(budget / len(body)) * SHRINK_HEADROOM
+            source = source.resize((max(1, int(source.width * scale)), max(1, int(source.height * scale))), Image.LANCZOS)
+            body = encode(source, image_format, quality, options['progressive'])
+            encodes += 1
+
+        variants.append({
+            'size': size,
+            'width': source.width,
+            'height': source.height,
+            'quality': quality,
+            'bytes': len(body),
+            'budget': budget,
+            'encodes': encodes,
+            'extension': extension,
+            'content_type': content_type,
+            'body': body
+        })
+    return variants
+
+if __name__ == '__main__':
+    from PIL import Image
+    with Image.open(sys.argv[1]) as face:
+        face.load()
+        for encoding_format in ('JPEG', 'WEBP'):
+            started_at = time.perf_counter()
+            encoded = encode_variants(face, load_encoding_options({'thumbnail_format': encoding_format}))
+            print(json.dumps({
+                'format': encoding_format,
+                'seconds': round(time.perf_counter() - started_at, 4),
+                'variants': [{key: value for key, value in variant.items() if key != 'body'} for variant in encoded]
+            }))
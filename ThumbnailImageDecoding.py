@@ -0,0 +1,116 @@
+## Reduced-resolution decoding for the thumbnail backfill.
+## Source photos are fetched with a byte cap and JPEGs are decoded through PIL's draft mode at the
+## smallest 1/2, 1/4 or 1/8 scale that still gives the face crop THUMBNAIL_TARGET_SIZE pixels, so a
+## 24MP event photo is no longer fully decoded to cut out a small face region.
+##
+## Compare against the full-resolution path with:
+##   python ThumbnailImageDecoding.py photo.jpg '{"Left": 0.4, "Top": 0.3, "Width": 0.1, "Height": 0.15}'
+
+import json
+import os
+import sys
+import time
+from io import BytesIO
+
+# Longest side the face crop needs after decoding
+THUMBNAIL_TARGET_SIZE = int(os.environ.get('THUMBNAIL_TARGET_SIZE', '1024'))
+
+# Per-image caps: compressed bytes fetched from S3 and pixels decoded into memory
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', str(50 * 1024 * 1024)))
+MAX_DECODED_PIXELS = int(os.environ.get('MAX_DECODED_PIXELS', str(16 * 1000 * 1000)))
+
+# Scales the libjpeg decoder can produce directly
+JPEG_DRAFT_SCALES = (1, 2, 4, 8)
+
+# Pixels added around the bounding box by store_face_thumbnail, on each side
+CROP_MARGIN = 25
+
+class ImageTooLargeError(Exception):
+    pass
+
+def fetch_image_bytes(s3, bucket_name, key, max_bytes=MAX_IMAGE_BYTES):
+    response = s3.get_object(Bucket=bucket_name, Key=key)
+    content_length = response.get('ContentLength')
+    if content_length is not None and content_length > max_bytes:
+        response['Body'].close()
+        raise ImageTooLargeError(f"{key} is {content_length} bytes, over the {max_bytes} byte limit")
+
+    # Never read more than the cap even if ContentLength was missing
+    image_bytes = response['Body'].read(max_bytes + 1)
+    if len(image_bytes) > max_bytes:
+        raise ImageTooLargeError(f"{key} is over the {max_bytes} byte limit")
+    return image_bytes
+
+def choose_draft_scale(width, height, bounding_box, target_size=THUMBNAIL_TARGET_SIZE, max_pixels=MAX_DECODED_PIXELS):
+    crop_longest_side = max(bounding_box['Width'] * width, bounding_box['Height'] * height) + 2 * CROP_MARGIN
+
+    # Largest reduction that keeps the crop at or above the target size
+    scale = 1
+    for candidate in JPEG_DRAFT_SCALES:
+        if crop_longest_side / candidate >= target_size:
+            scale = candidate
+
+    # Reduce further if the decoded image would still break the memory cap
+    for candidate in JPEG_DRAFT_SCALES:
+        if candidate >= scale and (width // candidate) * (height // candidate) <= max_pixels:
+            return candidate
+    return JPEG_DRAFT_SCALES[-1]
+
+def open_image_for_crops(image_bytes, bounding_boxes, target_size=THUMBNAIL_TARGET_SIZE, max_pixels=MAX_DECODED_PIXELS):
+    # Image.open only parses the header, draft() then tells libjpeg to decode at the reduced scale.
+    # With several faces in one photo the scale is chosen for the crop that needs the most pixels.
+    # PIL is imported here rather than at module level so handlers that never decode skip its import.
+    from PIL import Image
+    img = Image.open(BytesIO(image_bytes))
+    if img.format == 'JPEG':
+        scale = min(choose_draft_scale(img.width, img.height, bounding_box, target_size, max_pixels)
+                    for bounding_box in bounding_boxes)
+        if scale > 1:
+            img.draft('RGB', (img.width // scale, img.height // scale))
+    elif img.width * img.height > max_pixels:
+        img.close()
+        raise ImageTooLargeError(f"{img.width}x{img.height} {img.format} image is over the {max_pixels} pixel limit")
+    return img
+
+def open_image_for_crop(image_bytes, bounding_box, target_size=THUMBNAIL_TARGET_SIZE, max_pixels=MAX_DECODED_PIXELS):
+    return open_image_for_crops(image_bytes, [bounding_box], target_size, max_pixels)
+
+def measure_decode(open_image, image_bytes, bounding_box):
+    started_at = time.perf_counter()
+    with open_image(image_bytes) as img:
+        img.load()
+        decoded_size = img.size
+        decoded_bytes = img.width * img.height * len(img.getbands())
+        left = int(bounding_box['Left'] * img.width)
+        top = int(bounding_box['Top'] * img.height)
+        right = int((bounding_box['Left'] + bounding_box['Width']) * img.width)
+        bottom = int((bounding_box['Top'] + bounding_box['Height']) * img.height)
+        crop_size = img.crop((left, top, right, bottom)).size
+    return {
+        'seconds': round(time.perf_counter() - started_at, 4),
+        'decoded_size': decoded_size,
+        'decoded_bytes': decoded_bytes,
+        'crop_size': crop_size
+    }
+
+def compare_decode_paths(image_bytes, bounding_box, target_size=THUMBNAIL_TARGET_SIZE, repeat=5):
+    from PIL import Image
+
+    # Today's path: full decode at native resolution
+    def full_resolution(data):
+        return Image.open(BytesIO(data))
+
+    def reduced_resolution(data):
+        return open_image_for_crop(data, bounding_box, target_size)
+
+    results = {}
+    for name, open_image in (('full_resolution', full_resolution), ('reduced_resolution', reduced_resolution)):
+        runs = [measure_decode(open_image, image_bytes, bounding_box) for _ in range(repeat)]
+        results[name] = dict(runs[-1], seconds=min(run['seconds'] for run in runs))
+    return results
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'rb') as image_file:
+        source_bytes = image_file.read()
+    box = json.loads(sys.argv[2]) if len(sys.argv) > 2 else {'Left': 0.4, 'Top': 0.3, 'Width': 0.1, 'Height': 0.15}
+    print(json.dumps(compare_decode_paths(source_bytes, box), indent=2))
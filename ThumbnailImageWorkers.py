@@ -0,0 +1,150 @@
+## Process-pool image stage for the thumbnail backfill.
+## Decoding, cropping and encoding are CPU-bound and hold the GIL, so on the same threads as the S3 and
+## DynamoDB calls they serialise all image work and leave the network idle during every encode. Here
+## they run in worker processes: the handler's I/O threads fetch the photo, hand the raw bytes and the
+## bounding boxes to a worker and upload the encoded variants it sends back, while other I/O threads
+## keep fetching. Lambda has no /dev/shm, so ProcessPoolExecutor (which needs POSIX semaphores) is
+## not an option; every worker is a forked process behind a Pipe, driven by its own dispatcher thread.
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from ThumbnailImageDecoding import open_image_for_crops, CROP_MARGIN
+from ThumbnailEncoding import encode_variants
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Worker processes for the image stage; 1 or less keeps the image work on the calling thread
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', str(available_cpus())))
+
+STOP = None
+
+def crop_box(img, bounding_box):
+    left = max(0, int(bounding_box['Left'] * img.width) - CROP_MARGIN)
+    top = max(0, int(bounding_box['Top'] * img.height) - CROP_MARGIN)
+    right = min(img.width, int((bounding_box['Left'] + bounding_box['Width']) * img.width) + CROP_MARGIN)
+    bottom = min(img.height, int((bounding_box['Top'] + bounding_box['Height']) * img.height) + CROP_MARGIN)
+    return left, top, right, bottom
+
+def render_thumbnails(image_bytes, faces, encoding):
+    # faces is [(user_id, bounding_box)]. Returns the encoded variants per user and the time spent,
+    # since metrics recorded inside a worker process never reach the invocation's metrics.
+    started_at = time.perf_counter()
+    thumbnails = {}
+    failures = {}
+    with open_image_for_crops(image_bytes, [bounding_box for _, bounding_box in faces]) as img:
+        img.load()
+        decode_seconds = time.perf_counter() - started_at
+        for user_id, bounding_box in faces:
+            try:
+                thumbnails[user_id] = encode_variants(img.crop(crop_box(img, bounding_box)), encoding)
+            except Exception as e:
+                failures[user_id] = str(e)
+    return {
+        'thumbnails': thumbnails,
+        'failures': failures,
+        'decode_seconds': decode_seconds,
+        'encode_seconds': time.perf_counter() - started_at - decode_seconds
+    }
+
+def worker_loop(connection):
+    while True:
+        task = connection.recv()
+        if task is STOP:
+            return
+        function, args = task
+        try:
+            connection.send((True, function(*args)))
+        except Exception as e:
+            connection.send((False, e))
+
+class InlineImageWorkers:
+    # Same interface as ImageWorkerPool for single-vCPU containers, where a process only adds overhead
+    workers = 1
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self):
+        pass
+
+class ImageWorkerPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.tasks = queue.Queue()
+        self.context = multiprocessing.get_context('fork')
+        # Fork every worker up front from this thread, before the I/O threads exist
+        processes = [self.start_process() for _ in range(workers)]
+        # The name keeps InvocationProfiling off these container-lifetime threads
+        self.threads = [threading.Thread(target=self.dispatch, args=(process,), name=f"ImageWorkerDispatch-{index}", daemon=True)
+                        for index, process in enumerate(processes)]
+        for thread in self.threads:
+            thread.start()
+
+    def start_process(self):
+        parent_connection, child_connection = self.context.Pipe()
+        process = self.context.Process(target=worker_loop, args=(child_connection,), daemon=True)
+        process.start()
+        child_connection.close()
+        return process, parent_connection
+
+    def dispatch(self, worker):
+        process, connection = worker
+        while True:
+            task = self.tasks.get()
+            if task is STOP:
+                connection.send(STOP)
+                process.join()
+                return
+            future, function, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                connection.send((function, args))
+                succeeded, value = connection.recv()
+            except (EOFError, OSError) as e:
+                # The worker died (e.g. out of memory on a huge photo); replace it and carry on
+                future.set_exception(RuntimeError(f"Image worker exited with code {process.exitcode}: {e}"))
+                process.join()
+                process, connection = self.start_process()
+                continue
+            if succeeded:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def submit(self, function, *args):
+        future = Future()
+        self.tasks.put((future, function, args))
+        return future
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.tasks.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+# One pool per container, reused by warm invocations
+image_workers = None
+image_workers_lock = threading.Lock()
+
+def get_image_workers(workers=IMAGE_WORKERS):
+    global image_workers
+    with image_workers_lock:
+        if image_workers is None or image_workers.workers != max(1, workers):
+            if image_workers is not None:
+                image_workers.shutdown()
+            image_workers = ImageWorkerPool(workers) if workers > 1 else InlineImageWorkers()
+        return image_workers
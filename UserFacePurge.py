@@ -0,0 +1,197 @@
+## Shared purge flow of DisassociateFacesAndDeleteUsers and DisassociateFacesDeleteUsersDeleteFaces.
+## A user's face ids are read from indexed_data and either disassociated in batches before the user is
+## deleted ("disassociate"), or deleted along with the user ("fast"). The handlers only differ in name.
+
+import json
+import os
+from botocore.exceptions import ClientError
+from RekognitionFaceBatching import disassociate_face_pages, fast_purge_user
+from UserWorkerPool import RateLimitedClient, rekognition_limiter, dynamodb_limiter, configure_rate_limits, process_users, get_worker_count
+from LambdaCheckpointing import Checkpoint, time_is_running_out, continue_later
+from ThrottleControl import ThrottledClient
+from InvocationMetrics import metrics, debug
+from AwsClients import lazy_client
+from CompletionLedger import get_ledger, skip_completed, unit_key
+from FaceLookupCache import face_cache
+
+# Initialize the clients, created on first use from the shared session in AwsClients
+rekognition = ThrottledClient(RateLimitedClient(lazy_client('rekognition'), rekognition_limiter), 'rekognition')
+dynamodb = ThrottledClient(RateLimitedClient(lazy_client('dynamodb'), dynamodb_limiter), 'dynamodb')
+
+# "disassociate" keeps the faces in the collection, "fast" deletes them along with the user.
+# Overridable per event with "purge_mode".
+PURGE_MODE = os.environ.get('PURGE_MODE', 'disassociate')
+PURGE_MODES = ('disassociate', 'fast')
+
+# Completion ledger operations: finished users per purge mode, and faces disassociated so far
+LEDGER_USER_OPERATIONS = {'disassociate': 'purge_user', 'fast': 'fast_purge_user'}
+LEDGER_FACE_OPERATION = 'disassociate_face'
+
+# Face lists of recently looked up users are kept by the container under this table name
+FACES_TABLE = 'indexed_data'
+
+def query_face_id_pages(user_id):
+    # Yields the face IDs of one query page at a time
+    last_evaluated_key = None
+    
+    while True:
+        # Initialize query parameters
+        query_params = {
+            'TableName': FACES_TABLE,
+            'IndexName': 'user_id-index',
+            'KeyConditionExpression': 'user_id = :uid',
+            'ExpressionAttributeValues': {
+                ':uid': {'S': user_id}
+            }
+        }
+        
+        # Add the ExclusiveStartKey to the query parameters if it's not the first request
+        if last_evaluated_key:
+            query_params['ExclusiveStartKey'] = last_evaluated_key
+        
+        # Execute the query
+        with metrics.stage('query_faces'):
+            response = dynamodb.query(**query_params)
+        
+        # Hand the face IDs of this page on before the next page is requested
+        yield [item['face_id']['S'] for item in response['Items']]
+        
+        # Check if there is more data to be fetched
+        if 'LastEvaluatedKey' in response:
+            last_evaluated_key = response['LastEvaluatedKey']
+        else:
+            break
+
+def get_face_id_pages(user_id):
+    # A warm container serves a user it looked up recently from the cache, in one page
+    return face_cache.cached_pages(FACES_TABLE, user_id, query_face_id_pages(user_id))
+
+def get_face_ids_from_dynamodb(user_id):
+    return [face_id for face_ids in get_face_id_pages(user_id) for face_id in face_ids]
+
+def disassociate_faces_from_collection(collection_id, user_id, face_id_pages, on_chunk_done=None):
+    # Disassociate the faces in batches of up to 100 face ids per call, while later pages are still being read
+    return disassociate_face_pages(rekognition, collection_id, user_id, face_id_pages, on_chunk_done=on_chunk_done)
+
+def delete_user_from_collection(collection_id, user_id):
+    debug(f"Deleting user: {user_id} from collection: {collection_id}")
+    try:
+        response = rekognition.delete_user(
+            CollectionId=collection_id,
+            UserId=user_id
+        )
+        debug(f"Deleted user {user_id} from collection {collection_id}")
+        return response
+    except ClientError as e:
+        print(f"Failed to delete user {user_id} from collection {collection_id}: {e}")
+        raise
+
+def fast_purge_user_faces(collection_id, user_id, face_ids):
+    # DeleteUser, DeleteFaces in 4096-face chunks and a ListFaces check, no per-100 DisassociateFaces
+    try:
+        with metrics.stage('fast_purge'):
+            result = fast_purge_user(rekognition, collection_id, user_id, face_ids)
+    except Exception as e:
+        print(f"An error occurred during the fast purge for User ID: {user_id}: {e}")
+        return {'faces_found': len(face_ids), 'faces_deleted': 0, 'errors': [f"fast_purge: {e}"]}
+
+    errors = []
+    if result['RemainingFaces']:
+        errors.append(f"{len(result['RemainingFaces'])} faces still in the collection")
+    return {
+        'faces_found': len(face_ids),
+        'faces_deleted': len(result['DeletedFaces']),
+        'user_deleted': result['UserDeleted'],
+        'faces_remaining': result['RemainingFaces'],
+        'errors': errors
+    }
+
+def purge_user(collection_id, user_id, purge_mode=PURGE_MODE, ledger=None):
+    debug(f"Processing User ID: {user_id}")
+    errors = []
+    
+    if purge_mode == 'fast':
+        # Get all face IDs associated with the user ID from DynamoDB, the final check needs them all
+        return fast_purge_user_faces(collection_id, user_id, get_face_ids_from_dynamodb(user_id))
+    
+    # Face IDs stream from the DynamoDB pages straight into DisassociateFaces batches. A failed
+    # query still fails the whole user before delete_user, as before.
+    face_id_pages = get_face_id_pages(user_id)
+    on_chunk_done = None
+    if ledger is not None:
+        # A retry only disassociates the faces no earlier run got to, every finished chunk is recorded
+        face_id_pages = skip_completed(face_id_pages, ledger, LEDGER_FACE_OPERATION, user_id)
+        on_chunk_done = lambda face_ids: ledger.mark_completed(LEDGER_FACE_OPERATION, [unit_key(user_id, face_id) for face_id in face_ids])
+    debug(f"Disassociating faces from collection for User ID: {user_id}")
+    with metrics.stage('disassociate'):
+        result = disassociate_faces_from_collection(collection_id, user_id, face_id_pages, on_chunk_done)
+    total_faces_found = result['FacesFound']
+    total_faces_disassociated = len(result['DisassociatedFaces'])
+    for e in result['Errors']:
+        print(f"An error occurred during disassociation for User ID: {user_id}: {e}")
+        errors.append(f"disassociate: {e}")
+    
+    # Delete user ID from the collection
+    try:
+        debug(f"Deleting {total_faces_found} faces from collection for User ID: {user_id}")
+        with metrics.stage('delete_user'):
+            delete_user_from_collection(collection_id, user_id)
+    except Exception as e:
+        print(f"An error occurred during deletion for User ID: {user_id}: {e}")
+        errors.append(f"delete_user: {e}")
+    
+    metrics.increment('faces.found', total_faces_found)
+    debug(f"User ID: {user_id}")
+    debug(f"Total FaceIDs Found: {total_faces_found}")
+    debug(f"Total FaceIDs Disassociated: {total_faces_disassociated}")
+    debug("------------------------")
+    return {
+        'faces_found': total_faces_found,
+        'faces_disassociated': total_faces_disassociated,
+        'errors': errors
+    }
+
+def process_user(collection_id, user_id, purge_mode=PURGE_MODE, ledger=None):
+    try:
+        return purge_user(collection_id, user_id, purge_mode, ledger)
+    finally:
+        # Whatever part of the purge went through, the user's faces in the collection have changed
+        face_cache.invalidate(collection_id, user_id)
+
+def run_purge(event, context, collection_id):
+    # User IDs provided in the event
+    user_ids = event.get('user_ids', [])
+    
+    purge_mode = event.get('purge_mode', PURGE_MODE)
+    if purge_mode not in PURGE_MODES:
+        return {
+            'statusCode': 400,
+            'body': f"Unknown purge_mode {purge_mode}, expected one of {', '.join(PURGE_MODES)}"
+        }
+    
+    try:
+        ledger = get_ledger(event)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'body': str(e)
+        }
+    
+    # Shards of an orchestrated run carry their share of the TPS quotas
+    configure_rate_limits(event)
+    
+    # Resume from an earlier invocation when the event carries a continuation_token
+    checkpoint = Checkpoint.resume(event)
+    
+    # Optional "workers" in the event processes users in parallel, users completed by an earlier run are skipped
+    report = process_users(user_ids, lambda user_id: process_user(collection_id, user_id, purge_mode, ledger), get_worker_count(event),
+                           checkpoint, lambda: time_is_running_out(context), ledger, LEDGER_USER_OPERATIONS[purge_mode])
+    
+    if report['pending']:
+        return continue_later(checkpoint, event, context, {'completed': len(report['succeeded']) + len(report['failed']), 'pending': len(report['pending'])})
+    checkpoint.finish()
+    
+    return {
+        'statusCode': 200,
+        'body': json.dumps(report)
+    }
@@ -0,0 +1,254 @@
+## Streaming user-id runner for the utility lambdas.
+## Every handler takes its users as a list inside the event, so a single event is capped by the Lambda
+## payload limit. This runner reads the user ids from a JSONL or CSV file instead, local or on S3 (an
+## S3 stand-in such as MinIO is reached through AWS_ENDPOINT_URL_S3), drops duplicates as they stream
+## in and feeds the handler one bounded chunk at a time, in this process or through the deployed
+## function. Only the current chunk and a digest per user seen so far are held, and a progress line
+## with the throughput and an ETA (from the share of the input read so far) is printed as it goes.
+##
+## JSONL lines are a bare user id ("98baf10c-d825-4e") or an object with "user_id"; CSV rows have a
+## user_id column, or the user id first. The user_id remap also needs "new_user_id" (the second CSV
+## column) and runs one pair at a time through its single-user mode.
+## Users that fail or are still pending are written to --failures as their input rows in JSONL, with
+## a "status" added, so the file can be fed back to the runner as it is.
+##
+## Run a campaign locally with:
+##   python UserIdStreamRunner.py DisassociateFacesAndDeleteUsers users.jsonl --event '{"purge_mode": "fast"}'
+##   python UserIdStreamRunner.py BackfillingThumbnailsOnUserIdBasis s3://campaigns/users.csv.gz --chunk-size 200
+
+import argparse
+import csv
+import functools
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+from AwsClients import get_client
+from ThrottleControl import ThrottledClient
+from DynamoDBExportFiles import parse_s3_url
+from ShardOrchestrator import SHARDABLE_HANDLERS, SHARD_MAX_ROUNDS, LOCAL_TIMEOUT_SECONDS, LocalContext, invoke_lambda, run_shard
+
+REMAP_HANDLER = 'DynamoDBBackFillingUserIdRecordstoNewUserId'
+RUNNABLE_HANDLERS = SHARDABLE_HANDLERS + (REMAP_HANDLER,)
+
+# Users per handler event, the same bound the orchestrator puts on a shard
+DEFAULT_CHUNK_SIZE = 500
+
+# Bytes read from the input at a time
+READ_BLOCK_BYTES = 64 * 1024
+
+class CountingReader:
+    # Counts the raw (still compressed) bytes read, the ETA is the share of them still ahead
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.raw.close()
+
+def open_source(source, s3=None):
+    # Returns the counting reader and the total size of the input in bytes
+    if source.startswith('s3://'):
+        bucket, key = parse_s3_url(source)
+        response = s3.get_object(Bucket=bucket, Key=key)
+        return CountingReader(response['Body']), response.get('ContentLength')
+    return CountingReader(open(source, 'rb')), os.path.getsize(source)
+
+def read_lines(reader, compressed):
+    stream = gzip.GzipFile(fileobj=reader) if compressed else reader
+    remainder = b''
+    while True:
+        block = stream.read(READ_BLOCK_BYTES)
+        if not block:
+            break
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if remainder:
+        yield remainder.decode('utf-8')
+
+def parse_jsonl_rows(lines, counts):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            counts['invalid'] += 1
+            continue
+        if isinstance(row, str):
+            yield {'user_id': row}
+        elif isinstance(row, dict) and row.get('user_id'):
+            yield row
+        else:
+            counts['invalid'] += 1
+
+def parse_csv_rows(lines, counts):
+    header = None
+    for row in csv.reader(lines):
+        if not row or not row[0].strip():
+            continue
+        if header is None and 'user_id' in row:
+            header = [column.strip() for column in row]
+            continue
+        if header is not None:
+            row = dict(zip(header, (value.strip() for value in row)))
+        else:
+            row = {'user_id': row[0].strip(), **({'new_user_id': row[1].strip()} if len(row) > 1 else {})}
+        if row.get('user_id'):
+            yield row
+        else:
+            counts['invalid'] += 1
+
+def read_rows(reader, source, input_format, counts):
+    name = source[:-3] if source.endswith('.gz') else source
+    input_format = input_format or ('csv' if name.endswith('.csv') else 'jsonl')
+    lines = read_lines(reader, source.endswith('.gz'))
+    return parse_csv_rows(lines, counts) if input_format == 'csv' else parse_jsonl_rows(lines, counts)
+
+def remap_rows(rows, counts):
+    for row in rows:
+        if row.get('new_user_id'):
+            yield row
+        else:
+            counts['invalid'] += 1
+
+def unique_rows(rows, counts):
+    # 64-bit digests instead of the ids themselves, about 60 MB per million users seen
+    seen = set()
+    for row in rows:
+        digest = int.from_bytes(hashlib.blake2b(row['user_id'].encode('utf-8'), digest_size=8).digest(), 'big')
+        if digest in seen:
+            counts['duplicates'] += 1
+            continue
+        seen.add(digest)
+        yield row
+
+def chunked(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def build_chunk_events(target, base_event, chunk):
+    # The runner follows the continuation tokens itself
+    if target == REMAP_HANDLER:
+        # One pair per event: the bulk mode would scan the whole table for every chunk
+        return [(dict(base_event, user_id=row['user_id'], new_user_id=row['new_user_id'], self_invoke=False), [row['user_id']])
+                for row in chunk]
+    user_ids = [row['user_id'] for row in chunk]
+    return [(dict(base_event, user_ids=user_ids, self_invoke=False), user_ids)]
+
+def invoke_in_process(target, timeout_seconds, event):
+    return importlib.import_module(target).lambda_handler(event, LocalContext(timeout_seconds))
+
+def tally_outcome(outcome, user_ids):
+    # Returns {status: [user_id, ...]} for the users of one event
+    body = outcome.get('body')
+    status_code = outcome.get('status_code')
+    if outcome.get('error') or (status_code or 0) >= 500:
+        return {'failed': user_ids}
+    if status_code == 202:
+        return {'pending': user_ids}
+    if isinstance(body, dict) and 'succeeded' in body:
+        return {key: body.get(key, []) for key in ('succeeded', 'failed', 'pending', 'skipped')}
+    if status_code == 404:
+        return {'skipped': user_ids}
+    # The remap has no per-user report and succeeds as a whole; a handler that returned nothing
+    # cannot vouch for its users
+    if status_code is not None and 200 <= status_code < 300:
+        return {'succeeded': user_ids}
+    return {'failed': user_ids}
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def progress_line(counts, started_at, reader, total_bytes):
+    elapsed = time.perf_counter() - started_at
+    rate = counts['users'] / elapsed if elapsed else 0.0
+    line = (f"{counts['users']} users in {format_seconds(elapsed)} ({rate:.1f}/s): {counts['succeeded']} succeeded, "
+            f"{counts['failed']} failed, {counts['pending']} pending, {counts['skipped']} skipped, "
+            f"{counts['duplicates']} duplicates")
+    if total_bytes:
+        done = min(1.0, reader.bytes_read / total_bytes)
+        line += f", {done:.1%} of the input"
+        if 0 < done < 1 and elapsed:
+            line += f", ETA {format_seconds(elapsed * (1 - done) / done)}"
+    return line
+
+def run(args):
+    base_event = json.loads(args.event) if args.event else {}
+    if args.backend == 'lambda':
+        invoke = functools.partial(invoke_lambda, args.function_name or args.target)
+    else:
+        invoke = functools.partial(invoke_in_process, args.target, args.timeout_seconds)
+
+    counts = {'users': 0, 'chunks': 0, 'succeeded': 0, 'failed': 0, 'pending': 0, 'skipped': 0, 'duplicates': 0, 'invalid': 0}
+    s3 = ThrottledClient(get_client('s3'), 's3') if args.source.startswith('s3://') else None
+    reader, total_bytes = open_source(args.source, s3)
+    failures = open(args.failures, 'w') if args.failures else None
+    started_at = time.perf_counter()
+    reported_at = started_at
+    try:
+        rows = read_rows(reader, args.source, args.format, counts)
+        if args.target == REMAP_HANDLER:
+            rows = remap_rows(rows, counts)
+        for chunk in chunked(unique_rows(rows, counts), args.chunk_size):
+            rows_by_user_id = {row['user_id']: row for row in chunk}
+            for event, user_ids in build_chunk_events(args.target, base_event, chunk):
+                statuses = tally_outcome(run_shard(invoke, event, args.max_rounds), user_ids)
+                for status, status_user_ids in statuses.items():
+                    counts[status] += len(status_user_ids)
+                    if failures and status in ('failed', 'pending'):
+                        for user_id in status_user_ids:
+                            row = rows_by_user_id.get(user_id, {'user_id': user_id})
+                            failures.write(json.dumps(dict(row, status=status)) + '\n')
+            counts['users'] += len(chunk)
+            counts['chunks'] += 1
+            if failures:
+                failures.flush()
+            if time.perf_counter() - reported_at >= args.progress_seconds:
+                print(progress_line(counts, started_at, reader, total_bytes), file=sys.stderr, flush=True)
+                reported_at = time.perf_counter()
+    finally:
+        reader.close()
+        if failures:
+            failures.close()
+    print(progress_line(counts, started_at, reader, total_bytes), file=sys.stderr, flush=True)
+    return dict(counts, seconds=round(time.perf_counter() - started_at, 3))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Stream user ids from a JSONL/CSV file through a utility handler in chunks')
+    parser.add_argument('target', choices=RUNNABLE_HANDLERS)
+    parser.add_argument('source', help='local path or s3://bucket/key, optionally .gz')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='defaults to csv for .csv files, jsonl otherwise')
+    parser.add_argument('--event', help='JSON object with the other event keys, e.g. \'{"purge_mode": "fast"}\'')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='users per handler event')
+    parser.add_argument('--backend', choices=['local', 'lambda'], default='local',
+                        help='run the handler in this process or invoke the deployed function')
+    parser.add_argument('--function-name', help='deployed function for the lambda backend, defaults to the target')
+    parser.add_argument('--timeout-seconds', type=float, default=LOCAL_TIMEOUT_SECONDS, help='deadline per local invocation')
+    parser.add_argument('--max-rounds', type=int, default=SHARD_MAX_ROUNDS, help='continuation rounds per chunk')
+    parser.add_argument('--failures', help='JSONL file for the users that failed or are still pending')
+    parser.add_argument('--progress-seconds', type=float, default=10.0)
+    args = parser.parse_args(argv)
+    args.chunk_size = max(1, args.chunk_size)
+    return args
+
+if __name__ == '__main__':
+    print(json.dumps(run(parse_args())), flush=True)
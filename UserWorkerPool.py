@@ -0,0 +1,150 @@
+## Shared worker pool for the purge lambdas.
+## Users are independent, so an event can opt in to processing them on a thread pool. Every
+## Rekognition and DynamoDB call goes through a shared token bucket sized to the account TPS quotas,
+## so adding workers never pushes the account past its limits.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from InvocationMetrics import metrics
+
+# Account quotas, override per deployment through the Lambda environment
+REKOGNITION_TPS = float(os.environ.get('REKOGNITION_TPS', '5'))
+DYNAMODB_TPS = float(os.environ.get('DYNAMODB_TPS', '100'))
+
+# Workers used when the event does not ask for a specific count; 1 keeps the sequential behaviour
+DEFAULT_USER_WORKERS = int(os.environ.get('USER_WORKERS', '1'))
+MAX_USER_WORKERS = 64
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # A non-positive rate disables limiting
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_seconds = (tokens - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+class RateLimitedClient:
+    # Wraps a boto3 client so that every API call takes a token from the shared bucket first
+    def __init__(self, client, bucket):
+        self._client = client
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith('get_paginator') or name.startswith('can_'):
+            return attribute
+
+        def call(*args, **kwargs):
+            self._bucket.acquire()
+            return attribute(*args, **kwargs)
+        return call
+
+rekognition_limiter = TokenBucket(REKOGNITION_TPS)
+dynamodb_limiter = TokenBucket(DYNAMODB_TPS)
+
+def configure_rate_limits(event):
+    # A sharded run hands every shard its share of the account TPS through the event; without
+    # one the quotas from the environment apply again, also in a warm container
+    rekognition_limiter.rate = float(event.get('rekognition_tps', REKOGNITION_TPS))
+    dynamodb_limiter.rate = float(event.get('dynamodb_tps', DYNAMODB_TPS))
+
+def get_worker_count(event):
+    workers = int(event.get('workers', DEFAULT_USER_WORKERS) or 1)
+    return max(1, min(workers, MAX_USER_WORKERS))
+
+def run_user(process_user, user_id):
+    try:
+        with metrics.stage('user'):
+            result = process_user(user_id) or {}
+    except Exception as e:
+        print(f"An error occurred while processing User ID: {user_id}: {e}")
+        result = {'errors': [str(e)]}
+    result['user_id'] = user_id
+    result['status'] = 'failed' if result.get('errors') else 'succeeded'
+    metrics.increment(f"users.{result['status']}")
+    return result
+
+def process_users(user_ids, process_user, workers=1, checkpoint=None, should_stop=None, ledger=None, operation=None):
+    # Runs process_user(user_id) for every user and aggregates the per-user results.
+    # Users already completed in the checkpoint are skipped, and no new user is started once
+    # should_stop() returns True; those users are reported as pending.
+    # With a CompletionLedger, users an earlier run already completed under "operation" are looked
+    # up in one bulk call and reported as skipped, and every user that succeeds is recorded.
+    user_ids = list(dict.fromkeys(user_ids))
+    results = {}
+    # Users an earlier invocation finished only keep their status in the checkpoint, not their result
+    statuses = {}
+    if checkpoint is not None:
+        statuses = {user_id: 'failed' if checkpoint.is_user_failed(user_id) else 'succeeded'
+                    for user_id in user_ids if checkpoint.is_user_done(user_id)}
+    remaining = [user_id for user_id in user_ids if user_id not in statuses]
+    skipped = []
+    if ledger is not None and remaining:
+        completed = ledger.completed(operation, remaining)
+        skipped = [user_id for user_id in remaining if user_id in completed]
+        remaining = [user_id for user_id in remaining if user_id not in completed]
+        metrics.increment('users.skipped', len(skipped))
+    stopped = False
+
+    def record(result):
+        results[result['user_id']] = result
+        statuses[result['user_id']] = result['status']
+        if checkpoint is not None:
+            checkpoint.mark_user_done(result['user_id'], failed=result['status'] == 'failed')
+        if ledger is not None and result['status'] == 'succeeded':
+            ledger.mark_completed(operation, [result['user_id']])
+
+    if workers <= 1 or len(remaining) <= 1:
+        for user_id in remaining:
+            if should_stop is not None and should_stop():
+                stopped = True
+                break
+            record(run_user(process_user, user_id))
+    else:
+        print(f"Processing {len(remaining)} users with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Keep at most "workers" users in flight so the deadline check happens before every submit
+            queue = iter(remaining)
+            in_flight = set()
+            while True:
+                while len(in_flight) < workers and not stopped:
+                    if should_stop is not None and should_stop():
+                        stopped = True
+                        break
+                    user_id = next(queue, None)
+                    if user_id is None:
+                        break
+                    in_flight.add(executor.submit(run_user, process_user, user_id))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(future.result())
+
+    # Keep the report in event order regardless of completion order
+    skipped_user_ids = set(skipped)
+    return {
+        'succeeded': [user_id for user_id in user_ids if statuses.get(user_id) == 'succeeded'],
+        'failed': [user_id for user_id in user_ids if statuses.get(user_id) == 'failed'],
+        'pending': [user_id for user_id in user_ids if user_id not in statuses and user_id not in skipped_user_ids],
+        'skipped': skipped,
+        # Per-user results of this invocation only
+        'results': [results[user_id] for user_id in user_ids if user_id in results]
+    }
@@ -0,0 +1,528 @@
+## Smoke tests of the utility lambdas against the in-memory fakes in AwsFakes.
+## Run with:
+##   python -m unittest test_smoke
+
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout, redirect_stderr
+from AwsFakes import FakeRekognition, FakeDynamoDB, FakeS3
+import AwsClients
+
+def install_fakes():
+    rekognition = FakeRekognition()
+    dynamodb = FakeDynamoDB()
+    s3 = FakeS3()
+    AwsClients.reset_clients()
+    AwsClients.register('client', 'rekognition', rekognition)
+    AwsClients.register('client', 'dynamodb', dynamodb.client())
+    AwsClients.register('resource', 'dynamodb', dynamodb.resource())
+    AwsClients.register('client', 's3', s3)
+    return rekognition, dynamodb, s3
+
+class StoreUserDataTest(unittest.TestCase):
+    def test_stores_every_variant_and_the_user_item(self):
+        import BackfillingThumbnailsOnUserIdBasis as thumbnails
+        _, dynamodb, s3 = install_fakes()
+        users_data = dynamodb.create_table(thumbnails.REKOGNITION_USERS_DATA_TABLE, 'user_id')
+        variants = [{'size': size, 'extension': 'jpg', 'content_type': 'image/jpeg', 'body': b'x' * size, 'bytes': size}
+                    for size in (1024, 256, 64)]
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            thumbnails.store_user_data('user-1', variants)
+
+        self.assertNotIn('error occurred', output.getvalue())
+        self.assertEqual({key for _, key in s3.objects}, {f"thumbnails/user-1_{size}.jpg" for size in (1024, 256, 64)})
+        item = users_data.items['user-1']
+        self.assertTrue(item['face_url'].endswith('thumbnails/user-1_1024.jpg'))
+        self.assertEqual(set(item['face_urls']), {'1024', '256', '64'})
+
+    def test_unknown_ledger_store_is_a_bad_request(self):
+        import BackfillingThumbnailsOnUserIdBasis as thumbnails
+        install_fakes()
+        with redirect_stdout(io.StringIO()):
+            response = thumbnails.lambda_handler({'user_ids': ['user-1'], 'ledger_store': 'nope'}, None)
+        self.assertEqual(response['statusCode'], 400)
+
+class ThumbnailEncodingTest(unittest.TestCase):
+    def test_every_variant_fits_its_byte_budget(self):
+        from PIL import Image
+        from ThumbnailEncoding import encode_variants, load_encoding_options
+        crop = Image.effect_mandelbrot((1200, 1600), (-2, -1.5, 1, 1.5), 64).convert('RGB')
+        variants = encode_variants(crop, load_encoding_options({}))
+        self.assertEqual([variant['size'] for variant in variants], [1024, 256, 64])
+        for variant in variants:
+            self.assertLessEqual(variant['bytes'], variant['budget'])
+            self.assertLessEqual(max(variant['width'], variant['height']), variant['size'])
+
+    def test_string_flags_from_the_event(self):
+        from ThumbnailEncoding import load_encoding_options
+        self.assertFalse(load_encoding_options({'thumbnail_progressive': 'false'})['progressive'])
+        self.assertTrue(load_encoding_options({'thumbnail_progressive': 'true'})['progressive'])
+
+def quality_face(face_id, sharpness=60, yaw=0.0, **attributes):
+    face = {
+        'face_id': face_id, 'Confidence': '99.9', 'FaceOccluded_Value': False,
+        'EyesOpen_Value': True, 'EyesOpen_Confidence': '99',
+        'Pose': json.dumps({'Roll': 0.0, 'Yaw': yaw, 'Pitch': 0.0}),
+        'Quality': json.dumps({'Brightness': 70, 'Sharpness': sharpness})
+    }
+    face.update(attributes)
+    return face
+
+class FaceQualityScoringTest(unittest.TestCase):
+    def test_best_passing_face_wins_over_the_first(self):
+        from FaceQualityScoring import DEFAULT_THRESHOLDS, select_best_face
+        thresholds = {name: float(value) for name, value in DEFAULT_THRESHOLDS.items()}
+        items = [
+            quality_face('soft', sharpness=20),
+            quality_face('sharp-turned', sharpness=90, yaw=14.0),
+            quality_face('sharp', sharpness=90),
+            quality_face('occluded', sharpness=99, FaceOccluded_Value=True),
+            quality_face('profile', sharpness=99, yaw=40.0),
+            quality_face('broken', sharpness=99, Pose='{not json')
+        ]
+        face, score = select_best_face(items, thresholds)
+        self.assertEqual(face['face_id'], 'sharp')
+        self.assertGreater(score, select_best_face(items[:2], thresholds)[1])
+
+    def test_no_passing_face(self):
+        from FaceQualityScoring import load_thresholds, select_best_face
+        thresholds = load_thresholds({'thresholds': {'min_sharpness': 95}})
+        self.assertEqual(select_best_face([quality_face('sharp', sharpness=90)], thresholds), (None, None))
+        self.assertEqual(select_best_face([], thresholds), (None, None))
+        with self.assertRaises(ValueError):
+            load_thresholds({'thresholds': {'min_sharpnes': 95}})
+
+class CompletionLedgerTest(unittest.TestCase):
+    def test_completed_units_are_skipped_on_a_retry(self):
+        from CompletionLedger import get_ledger, skip_completed, unit_key
+        with tempfile.TemporaryDirectory() as directory:
+            event = {'ledger_store': 'sqlite', 'ledger_sqlite_path': os.path.join(directory, 'ledger.sqlite3')}
+            ledger = get_ledger(event)
+            ledger.mark_completed('disassociate_face', [unit_key('user-1', 'face-1'), unit_key('user-1', 'face-3')])
+            ledger.mark_completed('disassociate_face', [unit_key('user-1', 'face-1')])
+            ledger.mark_completed('purge_user', ['user-1'])
+
+            pages = [['face-1', 'face-2'], ['face-3'], ['face-4', 'face-4']]
+            remaining = list(skip_completed(pages, get_ledger(event), 'disassociate_face', 'user-1'))
+            self.assertEqual(remaining, [['face-2'], [], ['face-4']])
+            self.assertTrue(ledger.is_completed('purge_user', 'user-1'))
+            self.assertFalse(ledger.is_completed('purge_user', 'user-2'))
+            self.assertEqual(ledger.completed('purge_user', [f"user-{index}" for index in range(1200)]), {'user-1'})
+
+    def test_default_ledger_records_nothing(self):
+        from CompletionLedger import get_ledger, skip_completed
+        ledger = get_ledger({'ledger_store': 'none'})
+        ledger.mark_completed('purge_user', ['user-1'])
+        self.assertFalse(ledger.is_completed('purge_user', 'user-1'))
+        self.assertEqual(list(skip_completed([['face-1']], ledger, 'disassociate_face', 'user-1')), [['face-1']])
+        with self.assertRaises(ValueError):
+            get_ledger({'ledger_store': 'redis'})
+
+class RekognitionFaceBatchingTest(unittest.TestCase):
+    def test_faces_are_disassociated_in_chunks_of_100_and_transient_failures_retried(self):
+        from RekognitionFaceBatching import disassociate_faces_in_batches
+        rekognition = FakeRekognition()
+        face_ids = [f"face-{index}" for index in range(250)]
+        for face_id in face_ids:
+            rekognition.add_face('collection-1', face_id, 'user-1')
+        rekognition.add_face('collection-1', 'face-other', 'user-2')
+        calls = []
+        disassociate_faces = rekognition.disassociate_faces
+        def flaky_disassociate_faces(**params):
+            calls.append(len(params['FaceIds']))
+            if len(calls) == 1:
+                # The first face of the first call fails for a reason a retry can fix
+                response = disassociate_faces(**dict(params, FaceIds=params['FaceIds'][1:]))
+                response['UnsuccessfulFaceDisassociations'].append({'FaceId': params['FaceIds'][0], 'Reasons': ['INVALID_FACE_STATE']})
+                return response
+            return disassociate_faces(**params)
+        rekognition.disassociate_faces = flaky_disassociate_faces
+
+        with redirect_stdout(io.StringIO()):
+            result = disassociate_faces_in_batches(rekognition, 'collection-1', 'user-1', face_ids + face_ids[:10] + ['face-other'],
+                                                   backoff_seconds=0)
+
+        self.assertEqual(calls, [100, 1, 100, 51])
+        self.assertEqual(sorted(result['DisassociatedFaces']), sorted(face_ids))
+        self.assertEqual(result['UnsuccessfulFaceDisassociations'], [{'FaceId': 'face-other', 'Reasons': ['ASSOCIATED_TO_A_DIFFERENT_USER']}])
+        self.assertEqual(result['Batches'], 3)
+
+    def test_face_id_pages_are_rebatched_and_streamed_to_consumers(self):
+        from RekognitionFaceBatching import disassociate_face_pages
+        rekognition = FakeRekognition()
+        face_ids = [f"face-{index}" for index in range(240)]
+        for face_id in face_ids:
+            rekognition.add_face('collection-1', face_id, 'user-1')
+        pages = [face_ids[start:start + 40] for start in range(0, 240, 40)]
+        done = []
+
+        with redirect_stdout(io.StringIO()):
+            result = disassociate_face_pages(rekognition, 'collection-1', 'user-1', iter(pages), consumers=2,
+                                             backoff_seconds=0, on_chunk_done=done.extend)
+
+        self.assertEqual((result['FacesFound'], result['Batches'], result['Errors']), (240, 3, []))
+        self.assertEqual(sorted(result['DisassociatedFaces']), sorted(face_ids))
+        self.assertEqual(sorted(done), sorted(face_ids))
+        self.assertEqual(rekognition.stats()['calls']['DisassociateFaces'], 3)
+
+    def test_paging_error_is_raised_after_the_queued_chunks(self):
+        from RekognitionFaceBatching import disassociate_face_pages
+        rekognition = FakeRekognition()
+        for index in range(100):
+            rekognition.add_face('collection-1', f"face-{index}", 'user-1')
+        def pages():
+            yield [f"face-{index}" for index in range(100)]
+            raise RuntimeError('query failed')
+
+        with self.assertRaises(RuntimeError):
+            disassociate_face_pages(rekognition, 'collection-1', 'user-1', pages(), backoff_seconds=0)
+        self.assertEqual(set(rekognition.collections['collection-1'].values()), {None})
+
+class BatchWriterTest(unittest.TestCase):
+    def test_unprocessed_items_are_resubmitted_until_written(self):
+        from DynamoDBBatchWriter import BatchWriter
+        dynamodb = FakeDynamoDB(unprocessed_rate=0.3, seed=3)
+        table = dynamodb.create_table('indexed_data', 'face_id')
+        with BatchWriter(dynamodb.client(), 'indexed_data', max_attempts=20, base_delay=0) as writer:
+            for index in range(60):
+                writer.put({'face_id': {'S': f"face-{index}"}, 'user_id': {'S': 'user-1'}})
+
+        stats = writer.stats()
+        self.assertEqual(len(table.items), 60)
+        self.assertEqual((stats['records_written'], stats['records_failed']), (60, 0))
+        self.assertGreater(stats['records_retried'], 0)
+        self.assertGreater(stats['batch_requests'], 3)
+
+    def test_items_still_unprocessed_after_the_last_attempt_are_reported(self):
+        from DynamoDBBatchWriter import BatchWriter
+        dynamodb = FakeDynamoDB(unprocessed_rate=1.0)
+        dynamodb.create_table('indexed_data', 'face_id')
+        with redirect_stdout(io.StringIO()):
+            with BatchWriter(dynamodb.client(), 'indexed_data', max_attempts=2, base_delay=0) as writer:
+                writer.put({'face_id': {'S': 'face-1'}})
+        self.assertEqual(writer.stats()['records_failed'], 1)
+        self.assertEqual(writer.failed_items, [{'face_id': {'S': 'face-1'}}])
+
+class BulkRemapTest(unittest.TestCase):
+    def test_segmented_scan_rewrites_every_mapped_item_once(self):
+        import DynamoDBBackFillingUserIdRecordstoNewUserId as remap
+        _, dynamodb, _ = install_fakes()
+        dynamodb.page_size = 7
+        indexed_data = dynamodb.create_table('indexed_data', 'face_id')
+        for index in range(90):
+            indexed_data.put({'face_id': f"face-{index:03d}", 'user_id': ('user-a', 'user-b', 'user-keep')[index % 3]})
+
+        with redirect_stdout(io.StringIO()):
+            response = remap.lambda_handler({'user_id_mapping': {'user-a': 'user-b', 'user-b': 'user-c'}, 'total_segments': 4},
+                                            CountdownContext(1000))
+
+        body = json.loads(response['body'])
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual((body['records_scanned'], body['records_read'], body['records_written']), (90, 60, 60))
+        user_ids = [item['user_id'] for item in indexed_data.items.values()]
+        self.assertEqual((user_ids.count('user-c'), user_ids.count('user-keep')), (60, 30))
+
+class ExportFilesTest(unittest.TestCase):
+    def test_written_export_reads_back_from_s3_through_the_manifest(self):
+        from DynamoDBExportFiles import ExportFileWriter, list_export_files, read_export_items
+        s3 = FakeS3()
+        items = [{'face_id': {'S': f"face-{index}"}, 'user_id': {'S': 'user-1'}} for index in range(5)]
+        with ExportFileWriter('s3://exports/table/data/part-0.json.gz', s3) as writer:
+            for item in items[:3]:
+                writer.put(item)
+        with ExportFileWriter('s3://exports/table/data/part-1.json.gz', s3) as writer:
+            for item in items[3:]:
+                writer.put(item)
+        s3.add_object('exports', 'table/manifest-files.json',
+                      b'{"dataFileS3Key": "table/data/part-0.json.gz"}\n\n{"dataFileS3Key": "table/data/part-1.json.gz"}\n')
+
+        locations = list_export_files('s3://exports/table', s3)
+        self.assertEqual(locations, ['s3://exports/table/data/part-0.json.gz', 's3://exports/table/data/part-1.json.gz'])
+        self.assertEqual([item for location in locations for item in read_export_items(location, s3)], items)
+        self.assertEqual(list_export_files('s3://exports/table/data/part-1.json.gz', s3), locations[1:])
+
+    def test_local_export_directory_lists_only_data_files(self):
+        from DynamoDBExportFiles import ExportFileWriter, list_export_files, read_export_items
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(os.path.join(directory, 'data'))
+            path = os.path.join(directory, 'data', 'part-0.json.gz')
+            with ExportFileWriter(path) as writer:
+                writer.put({'face_id': {'S': 'face-1'}})
+            with open(os.path.join(directory, 'manifest-summary.json'), 'w') as f:
+                f.write('{}')
+
+            self.assertEqual(list_export_files(directory), [path])
+            self.assertEqual(list_export_files(path), [path])
+            self.assertEqual(list(read_export_items(path)), [{'face_id': {'S': 'face-1'}}])
+
+class FaceLookupCacheTest(unittest.TestCase):
+    def test_entries_expire_after_the_ttl(self):
+        from FaceLookupCache import FaceLookupCache
+        cache = FaceLookupCache(ttl_seconds=60, enabled=True)
+        with mock.patch('FaceLookupCache.time.monotonic', return_value=1000.0):
+            cache.put('indexed_data', 'user-1', ['face-1', 'face-2'])
+        with mock.patch('FaceLookupCache.time.monotonic', return_value=1059.0):
+            self.assertEqual(cache.get('indexed_data', 'user-1'), ['face-1', 'face-2'])
+        with mock.patch('FaceLookupCache.time.monotonic', return_value=1060.0):
+            self.assertIsNone(cache.get('indexed_data', 'user-1'))
+        self.assertEqual((len(cache.entries), cache.bytes), (0, 0))
+
+    def test_invalidate_drops_every_folder_of_the_user(self):
+        from FaceLookupCache import FaceLookupCache
+        cache = FaceLookupCache(enabled=True)
+        cache.put('indexed_data', 'user-1', ['face-1'])
+        cache.put('indexed_data', 'user-1', ['face-2'], folder_name='folder-a')
+        cache.put('indexed_data', 'user-2', ['face-3'])
+        cache.put('collection-1', 'user-1', ['face-4'])
+        cache.invalidate('indexed_data', 'user-1')
+
+        self.assertIsNone(cache.get('indexed_data', 'user-1'))
+        self.assertIsNone(cache.get('indexed_data', 'user-1', 'folder-a'))
+        self.assertEqual(cache.get('indexed_data', 'user-2'), ['face-3'])
+        self.assertEqual(cache.get('collection-1', 'user-1'), ['face-4'])
+
+    def test_lookup_overlapping_an_invalidation_is_not_cached(self):
+        from FaceLookupCache import FaceLookupCache
+        cache = FaceLookupCache(enabled=True)
+        pages = cache.cached_pages('indexed_data', 'user-1', iter([['face-1'], ['face-2']]))
+        self.assertEqual(next(pages), ['face-1'])
+        cache.invalidate('indexed_data', 'user-1')
+        self.assertEqual(list(pages), [['face-2']])
+        self.assertIsNone(cache.get('indexed_data', 'user-1'))
+
+        self.assertEqual(list(cache.cached_pages('indexed_data', 'user-1', iter([['face-1'], ['face-2']]))),
+                         [['face-1'], ['face-2']])
+        self.assertEqual(list(cache.cached_pages('indexed_data', 'user-1', iter([]))), [['face-1', 'face-2']])
+
+    def test_least_recently_used_entry_is_evicted(self):
+        from FaceLookupCache import FaceLookupCache
+        cache = FaceLookupCache(max_entries=2, enabled=True)
+        cache.put('indexed_data', 'user-1', ['face-1'])
+        cache.put('indexed_data', 'user-2', ['face-2'])
+        cache.get('indexed_data', 'user-1')
+        cache.put('indexed_data', 'user-3', ['face-3'])
+
+        self.assertIsNone(cache.get('indexed_data', 'user-2'))
+        self.assertEqual(cache.get('indexed_data', 'user-1'), ['face-1'])
+        self.assertEqual(cache.get('indexed_data', 'user-3'), ['face-3'])
+        self.assertNotIn(('indexed_data', 'user-2'), cache.user_keys)
+
+class CountdownContext:
+    # get_remaining_time_in_millis drops below the checkpoint margin after "calls" deadline checks
+    def __init__(self, calls):
+        self.calls = calls
+
+    def get_remaining_time_in_millis(self):
+        self.calls -= 1
+        return 900000 if self.calls >= 0 else 0
+
+class CheckpointTest(unittest.TestCase):
+    def test_resumed_run_reports_users_of_earlier_invocations(self):
+        from LambdaCheckpointing import Checkpoint, FileCheckpointStore, time_is_running_out
+        from UserWorkerPool import process_users
+        store = FileCheckpointStore(tempfile.mkdtemp())
+        user_ids = [f"user-{index}" for index in range(5)]
+        process_user = lambda user_id: {'errors': ['boom']} if user_id == 'user-1' else {}
+
+        checkpoint = Checkpoint.resume({}, store)
+        context = CountdownContext(3)
+        first = process_users(user_ids, process_user, 1, checkpoint, lambda: time_is_running_out(context))
+        checkpoint.save()
+        self.assertEqual(first['pending'], user_ids[3:])
+
+        resumed = Checkpoint.resume({'continuation_token': checkpoint.job_id}, store)
+        second = process_users(user_ids, process_user, 1, resumed)
+        self.assertEqual(second['succeeded'], ['user-0', 'user-2', 'user-3', 'user-4'])
+        self.assertEqual(second['failed'], ['user-1'])
+        self.assertEqual(second['pending'], [])
+        self.assertEqual([result['user_id'] for result in second['results']], user_ids[3:])
+        self.assertNotIn('results', json.load(open(store.path(checkpoint.job_id))))
+
+    def test_unknown_continuation_token_fails(self):
+        from LambdaCheckpointing import Checkpoint, CheckpointNotFoundError, FileCheckpointStore
+        with self.assertRaises(CheckpointNotFoundError):
+            Checkpoint.resume({'continuation_token': 'missing'}, FileCheckpointStore(tempfile.mkdtemp()))
+
+    def test_missing_checkpoint_table_does_not_fail_finished_work(self):
+        import DisassociateFacesAndDeleteUsers as purge
+        import DynamoDBBackFillingUserIdRecordstoNewUserId as remap
+        from FaceLookupCache import face_cache
+        rekognition, dynamodb, _ = install_fakes()
+        face_cache.clear()
+        indexed_data = dynamodb.create_table('indexed_data', 'face_id')
+        for face_id, user_id in (('face-1', 'user-1'), ('face-2', 'user-2')):
+            rekognition.add_face('FlashbackUserDataCollection', face_id, user_id)
+            indexed_data.put({'face_id': face_id, 'user_id': user_id})
+
+        with redirect_stdout(io.StringIO()):
+            purged = purge.lambda_handler({'user_ids': ['user-1'], 'checkpoint_store': 'dynamodb'}, CountdownContext(100))
+            remapped = remap.lambda_handler({'user_id': 'user-2', 'new_user_id': 'user-3', 'checkpoint_store': 'dynamodb'},
+                                            CountdownContext(100))
+
+        self.assertEqual(purged['statusCode'], 200)
+        self.assertEqual(remapped['statusCode'], 200)
+        self.assertEqual(indexed_data.items['face-2']['user_id'], 'user-3')
+
+    def test_dynamodb_store_round_trip(self):
+        from LambdaCheckpointing import Checkpoint, DynamoDBCheckpointStore, CHECKPOINT_TABLE
+        _, dynamodb, _ = install_fakes()
+        dynamodb.create_table(CHECKPOINT_TABLE, 'job_id')
+        store = DynamoDBCheckpointStore(dynamodb=dynamodb.client())
+        checkpoint = Checkpoint.resume({}, store)
+        for index in range(2000):
+            checkpoint.mark_user_done(f"98baf10c-d825-4e-{index:06d}", failed=index % 7 == 0, save=False)
+        checkpoint.set_cursor('query', {'last_evaluated_key': {'face_id': {'S': 'f'}}})
+        checkpoint.save()
+        resumed = Checkpoint.resume({'continuation_token': checkpoint.job_id}, store)
+        self.assertTrue(resumed.is_user_done('98baf10c-d825-4e-001999'))
+        self.assertTrue(resumed.is_user_failed('98baf10c-d825-4e-000007'))
+        self.assertEqual(resumed.get_cursor('query'), {'last_evaluated_key': {'face_id': {'S': 'f'}}})
+
+class MergeReportsTest(unittest.TestCase):
+    def test_shard_without_a_report_counts_as_failed(self):
+        from ShardOrchestrator import merge_reports
+        shards = [['user-0', 'user-1'], ['user-2']]
+        weights = {'user-0': 1, 'user-1': 1, 'user-2': 1}
+        outcomes = [{'status_code': 200, 'body': {'succeeded': ['user-0'], 'failed': ['user-1']}},
+                    {'status_code': None, 'body': None}]
+        merged, _ = merge_reports(shards, weights, outcomes)
+        self.assertEqual(merged['succeeded'], ['user-0'])
+        self.assertEqual(merged['failed'], ['user-1', 'user-2'])
+
+    def test_deadline_stops_rounds_and_keeps_the_continuation(self):
+        from ShardOrchestrator import ShardDeadline, run_shard, remaining_shards
+        continuation = {'statusCode': 202, 'body': json.dumps({'continuation_token': 'job-1'})}
+        deadline = ShardDeadline(CountdownContext(1))
+        outcome = run_shard(lambda event: continuation, {'user_ids': ['user-0']}, 20, deadline)
+        self.assertEqual(outcome['rounds'], 2)
+        not_started = {'status_code': None, 'body': None, 'not_started': True}
+        self.assertEqual(remaining_shards([['user-0'], ['user-1']], [outcome, not_started]),
+                         [{'user_ids': ['user-0'], 'continuation_token': 'job-1'}, {'user_ids': ['user-1']}])
+
+    def test_throttled_shard_invokes_are_retried(self):
+        import ShardOrchestrator
+        from botocore.exceptions import ClientError
+        responses = [ClientError({'Error': {'Code': 'TooManyRequestsException'}}, 'Invoke'),
+                     {'Payload': io.BytesIO(json.dumps({'statusCode': 200}).encode())}]
+        def invoke(**params):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        with mock.patch.object(ShardOrchestrator, 'lambda_client', mock.Mock(invoke=invoke)), \
+                mock.patch('ThrottleControl.time.sleep'):
+            self.assertEqual(ShardOrchestrator.invoke_lambda('target', {}), {'statusCode': 200})
+
+class CallWithBackoffTest(unittest.TestCase):
+    def test_connection_errors_and_internal_errors_are_retried(self):
+        from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+        from ThrottleControl import AIMDController, call_with_backoff
+        errors = [EndpointConnectionError(endpoint_url='https://dynamodb'), ReadTimeoutError(endpoint_url='https://dynamodb'),
+                  ClientError({'Error': {'Code': 'InternalError'}}, 'PutObject')]
+        def flaky():
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+        with mock.patch('ThrottleControl.time.sleep') as sleep:
+            self.assertEqual(call_with_backoff(AIMDController('test.flaky'), flaky), 'ok')
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_lambda_invokes_are_only_retried_before_they_were_sent(self):
+        from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+        from ThrottleControl import call_unless_sent
+        errors = [ClientError({'Error': {'Code': 'TooManyRequestsException'}}, 'Invoke'),
+                  EndpointConnectionError(endpoint_url='https://lambda'), ReadTimeoutError(endpoint_url='https://lambda')]
+        def invoke():
+            raise errors.pop(0)
+        with mock.patch('ThrottleControl.time.sleep'):
+            with self.assertRaises(ReadTimeoutError):
+                call_unless_sent(invoke)
+        self.assertEqual(errors, [])
+
+class FolderPurgeTest(unittest.TestCase):
+    def test_faces_left_in_the_collection_fail_the_user(self):
+        import DisassociateFacesAndDeleteSpecificToDynamoDBAttribute as purge
+        from FaceLookupCache import face_cache
+        rekognition, dynamodb, _ = install_fakes()
+        face_cache.clear()
+        indexed_data = dynamodb.create_table(purge.FACES_TABLE, 'face_id')
+        collection_id = 'FlashbackUserDataCollection'
+        for face_id, user_id, owner in (('face-1', 'user-1', 'user-1'), ('face-2', 'user-1', 'user-2'), ('face-3', 'user-3', 'user-3')):
+            rekognition.add_face(collection_id, face_id, owner)
+            indexed_data.put({'face_id': face_id, 'user_id': user_id, 'folder_name': 'folder-1'})
+
+        with redirect_stdout(io.StringIO()):
+            response = purge.lambda_handler({'user_ids': ['user-1', 'user-3'], 'folder_name': 'folder-1'}, None)
+
+        body = json.loads(response['body'])
+        self.assertEqual(body['succeeded'], ['user-3'])
+        self.assertEqual(body['failed'], ['user-1'])
+        self.assertIn('face-2', rekognition.collections[collection_id])
+
+class CollectionInventoryTest(unittest.TestCase):
+    def test_fresh_snapshot_serves_its_users_and_lists_the_others(self):
+        from CollectionInventory import build_collection_inventory
+        rekognition = FakeRekognition()
+        for index in range(6):
+            rekognition.add_face('collection-1', f"face-{index}", f"user-{index % 3}")
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'inventory.json.gz')
+        with redirect_stdout(io.StringIO()):
+            build_collection_inventory(rekognition, 'collection-1', ['user-0', 'user-1', 'user-2'], snapshot_path)
+            calls = dict(rekognition.stats()['calls'])
+            served = build_collection_inventory(rekognition, 'collection-1', ['user-1'], snapshot_path)
+            self.assertEqual(rekognition.stats()['calls'], calls)
+            rekognition.add_face('collection-1', 'face-6', 'user-3')
+            listed = build_collection_inventory(rekognition, 'collection-1', ['user-2', 'user-3'], snapshot_path)
+        self.assertEqual(served, {'user-1': ['face-1', 'face-4']})
+        self.assertEqual(listed, {'user-2': ['face-2', 'face-5'], 'user-3': ['face-6']})
+
+class UserIdStreamRunnerTest(unittest.TestCase):
+    def test_failures_file_can_be_fed_back(self):
+        import UserIdStreamRunner as runner
+        install_fakes()
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, 'pairs.csv')
+        failures = os.path.join(directory, 'failures.jsonl')
+        with open(source, 'w') as f:
+            f.write('user_id,new_user_id\nuser-1,user-1-merged\nuser-2,user-2-merged\n')
+
+        # No indexed_data table, so every remap fails
+        with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+            counts = runner.run(runner.parse_args([runner.REMAP_HANDLER, source, '--failures', failures]))
+            retried = runner.run(runner.parse_args([runner.REMAP_HANDLER, failures]))
+
+        self.assertEqual(counts['failed'], 2)
+        with open(failures) as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(rows, [{'user_id': 'user-1', 'new_user_id': 'user-1-merged', 'status': 'failed'},
+                                {'user_id': 'user-2', 'new_user_id': 'user-2-merged', 'status': 'failed'}])
+        self.assertEqual((retried['invalid'], retried['failed']), (0, 2))
+
+class InvocationProfilingTest(unittest.TestCase):
+    def test_threads_still_running_are_left_out(self):
+        import threading
+        from InvocationProfiling import profiled
+        release = threading.Event()
+        lingering = threading.Thread(target=release.wait)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            with profiled('test', {'profile': 'cpu'}):
+                finished = threading.Thread(target=sum, args=(range(1000),))
+                finished.start()
+                finished.join()
+                lingering.start()
+        release.set()
+        lingering.join()
+
+        cpu = json.loads(output.getvalue())['Profile']['cpu']
+        self.assertEqual((cpu['threads'], cpu['threads_still_running']), (2, 1))
+        self.assertEqual(threading.Thread.run.__qualname__, 'Thread.run')
+
+if __name__ == '__main__':
+    unittest.main()